@@ -55,6 +55,10 @@ apps_permissions = [
     admin_per, user_per, guest_per, blogger_per
 ]
 
+# query counts and timings of every request when SQL_INSTRUMENTATION is on, served to the admins
+from app.instrumentation import instrument
+instrument(app, admin_per)
+
 Principal(app)
 
 
@@ -62,6 +66,10 @@ from app.users.models import User
 
 #create diagnostics table
 from app.diagnostic.models import *
+# table versions bumped on every flush, used for the API ETags
+from app.cache import TableVersion
+# gas generation rates refreshed on every flush of dissolved gas tests
+from app.diagnostic import gas_rates
 # db.create_all(app=app)
 
 
@@ -92,6 +100,10 @@ def error_403(error):
     return render_template('403.html'), 403
 
 
+# the user of a request, loaded once with its roles
+from app.users import identity
+
+
 # Initialize flask-login
 def init_login():
     login_manager = login.LoginManager()
@@ -101,7 +113,7 @@ def init_login():
     @login_manager.user_loader
     @blog.user_loader
     def load_user(user_id):
-        return db.session.query(User).get(user_id)
+        return identity.load_user(user_id)
 
 
 # Initialize flask-login
@@ -111,6 +123,14 @@ from app.users.models import User, Role
 
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
 security = Security(app, user_datastore)
+# Flask-Security replaces the loader with a query of its datastore on every request
+app.login_manager.user_loader(identity.load_user)
+
+# mail is spooled in the outbox and sent by a thread of each process, requests don't wait for SMTP
+from app import outbox
+security.send_mail_task(outbox.enqueue_security_mail)
+if app.config.get('MAIL_WORKER', True):
+    app.before_first_request(outbox.start_worker)
 
 from app.home.views import mod as homeModule
 from app.users.views import mod as userModule
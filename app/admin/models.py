@@ -16,6 +16,11 @@ class File(db.Model):
 
 
 class Image(db.Model):
+    __table_args__ = (
+        # LIKE 'prefix%' of the image picker, whatever the collation of the database
+        db.Index('ix_image_name', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Unicode(64))
     path = db.Column(db.Unicode(128))
@@ -1,7 +1,16 @@
 from app import db
 from .models import MenuItemsNode, MenuItemsNodeTranslation
-from sqlalchemy.orm import joinedload_all
+from sqlalchemy import and_
+from sqlalchemy.orm import joinedload_all, aliased
 from flask import url_for
+from collections import defaultdict
+from app.cache import get_versions
+
+FALLBACK_LOCALE = 'en'
+# a rendered menu is reused while the versions of these tables don't change
+MENU_TABLES = ('menu_items', 'menu_items_translation')
+# (menu text, locale, use_ul) -> (table versions, menu html)
+_menu_cache = {}
 
 
 def get_menu():
@@ -86,6 +95,7 @@ def create_node(parent, text, type):
         # parent.append(node)
         # parent.children[text + str(node.id)] = node
         db.session.commit()
+        invalidate_menu()
         res = node.id
     except Exception as e:
         import logging
@@ -101,6 +111,7 @@ def delete_node(id):
         node = db.session.query(MenuItemsNode).filter(MenuItemsNode.id == id).first()
         db.session.delete(node)
         db.session.commit()
+        invalidate_menu()
         res = node.id
     except Exception as e:
         import logging
@@ -116,6 +127,7 @@ def rename_node(id, text):
         node = db.session.query(MenuItemsNode).filter(MenuItemsNode.id == id).first()
         node.text = text
         db.session.commit()
+        invalidate_menu()
         res = True
     except Exception as e:
         import logging
@@ -129,6 +141,7 @@ def move_node(node_id, parent_id):
     try:
         db.session.query(MenuItemsNode).filter(MenuItemsNode.id == node_id).update({'parent_id': parent_id})
         db.session.commit()
+        invalidate_menu()
         res = True
     except Exception as e:
         import logging
@@ -152,6 +165,7 @@ def update_node(node_id, page_view):
             node.tag = ''
             node.page_id = 0
             db.session.commit()
+            invalidate_menu()
         else:
             page = db.session.query(Pages).options(sqla.orm.joinedload(Pages.current_translation)).filter(
                 Pages.id == int(page_view)).first()
@@ -162,6 +176,7 @@ def update_node(node_id, page_view):
                 node.page_id = page.id
 
                 db.session.commit()
+                invalidate_menu()
 
         # page  = db.session.query(Pages).options(sqla.orm.joinedload(Pages.current_translation)).filter(Pages.title == page_view).first()
         # page =  db.session.query(Pages).options(sqla.orm.joinedload(Pages.translations['en'])).filter(Pages.title == page_view).first()
@@ -191,32 +206,80 @@ def get_view_by_id(node_id):
     return res
 
 
-def ul_menu_creation(text=u'Top Menu', use_ul=True):
-    try:
-        tree = db.session.query(MenuItemsNode).options(joinedload_all("children", "children", "children", "children")) \
-            .filter(MenuItemsNode.text == text).first()
-        res = None
-
-        if tree is not None:
-            make_node = None
-            for node in tree.children:
-                if tree.children[node].translations[tree.children[node].get_locale()].text == text:
-                    make_node = tree.children[node]
-                    # print(make_node.dump())
-
-            if make_node is not None:
-                res = ''
-                if use_ul:
-                    res += '<ul class="nav navbar-nav">'
+def invalidate_menu():
+    _menu_cache.clear()
+
+
+def load_menu(locale):
+    """Return the menu nodes as {id: dict} linked through their 'children' lists, ordered by id.
+
+    The nodes and their translations come from one flat query and are linked in memory,
+    a missing or empty text falls back to the FALLBACK_LOCALE one like sqlalchemy_i18n does.
+    """
+    current = aliased(MenuItemsNodeTranslation)
+    fallback = aliased(MenuItemsNodeTranslation)
+    rows = db.session.query(MenuItemsNode.id, MenuItemsNode.parent_id, MenuItemsNode.tag, MenuItemsNode.slug,
+                            current.text.label('text'), fallback.text.label('fallback_text')) \
+        .outerjoin(current, and_(current.id == MenuItemsNode.id, current.locale == locale)) \
+        .outerjoin(fallback, and_(fallback.id == MenuItemsNode.id, fallback.locale == FALLBACK_LOCALE)) \
+        .order_by(MenuItemsNode.id)
+
+    nodes = {}
+    children = defaultdict(list)
+    for row in rows:
+        node = {
+            'id': row.id,
+            'parent_id': row.parent_id,
+            'text': row.text or row.fallback_text or u'',
+            'fallback_text': row.fallback_text,
+            'tag': row.tag,
+            'slug': row.slug,
+            'children': []
+        }
+        nodes[row.id] = node
+        children[row.parent_id].append(node)
+    for node_id, node in nodes.items():
+        node['children'] = children.get(node_id, [])
+    return nodes
+
+
+def render_menu(nodes, text, use_ul):
+    """HTML of the menu named text: the children of its child with the same FALLBACK_LOCALE text, or None"""
+    tree = None
+    for node in sorted(nodes.values(), key=lambda node: node['id']):
+        if node['text'] == text:
+            tree = node
+            break
+    if tree is None:
+        return None
+
+    make_node = None
+    for node in tree['children']:
+        if node['fallback_text'] == text:
+            make_node = node
+    if make_node is None:
+        return None
+
+    res = []
+    if use_ul:
+        res.append('<ul class="nav navbar-nav">')
+    for chd in make_node['children']:
+        create_menu_ul(chd, res, root=False, first=True, use_ul=use_ul)
+    if use_ul:
+        res.append('</ul>')
+    return u''.join(res)
 
-                for chd in make_node.children:
-                    res += create_menu_ul(make_node.children[chd], root=False, first=True, use_ul=use_ul)
 
-                if use_ul:
-                    res += '</ul>'
-
-                    # print(tree.dump())
-                    # print(res)
+def ul_menu_creation(text=u'Top Menu', use_ul=True):
+    """Rendered menu named text for the current locale, cached while menu_items doesn't change"""
+    try:
+        key = (text, get_locale(), use_ul)
+        versions = get_versions(db.session, MENU_TABLES)
+        cached = _menu_cache.get(key)
+        if cached is None or cached[0] != versions:
+            cached = (versions, render_menu(load_menu(key[1]), text, use_ul))
+            _menu_cache[key] = cached
+        res = cached[1]
     except Exception as e:
         import logging
         logging.error(e)
@@ -225,45 +288,42 @@ def ul_menu_creation(text=u'Top Menu', use_ul=True):
     return res
 
 
-def render_menu_li(tree, root=False, first=False, use_ul=True):
-    if use_ul is False and tree.children:
-        return ' '
+def render_menu_li(tree, res, root=False, first=False, use_ul=True):
+    if use_ul is False and tree['children']:
+        res.append(' ')
+        return
 
     if root and use_ul:
-        data = '<li class="dropdown-submenu">'
+        res.append('<li class="dropdown-submenu">')
     else:
-        data = '<li>'
+        res.append('<li>')
 
-    if tree.children:
-        data += '<a href="#" class="dropdown-toggle active" data-toggle="dropdown">'
+    if tree['children']:
+        res.append('<a href="#" class="dropdown-toggle active" data-toggle="dropdown">')
     else:
-        data += '<a href="' + url_for('home.show_page_tag', tag=tree.tag, slug=tree.slug) + '">'
+        res.append('<a href="' + url_for('home.show_page_tag', tag=tree['tag'], slug=tree['slug']) + '">')
 
-    data += tree.text
+    res.append(tree['text'])
     if first:
-        data += '<span class="caret"></span>'
+        res.append('<span class="caret"></span>')
 
-    data += '</a>'
+    res.append('</a>')
 
-    return data
 
-
-def create_menu_ul(tree, root=False, first=False, use_ul=True):
-    data = render_menu_li(tree=tree, root=root, first=first, use_ul=use_ul)
-    if tree.children:
+def create_menu_ul(tree, res, root=False, first=False, use_ul=True):
+    render_menu_li(tree, res, root=root, first=first, use_ul=use_ul)
+    if tree['children']:
         if use_ul:
-            data += "<ul class='dropdown-menu multi-level'>"
+            res.append("<ul class='dropdown-menu multi-level'>")
 
-        for chd in tree.children:
-            if tree.children[chd].children:
-                data += create_menu_ul(tree.children[chd], root=True, first=False, use_ul=use_ul)
+        for chd in tree['children']:
+            if chd['children']:
+                create_menu_ul(chd, res, root=True, first=False, use_ul=use_ul)
             else:
-                data += render_menu_li(tree.children[chd], use_ul=use_ul)
-                data += '</li>'
+                render_menu_li(chd, res, use_ul=use_ul)
+                res.append('</li>')
 
         if use_ul:
-            data += "</ul>"
+            res.append("</ul>")
 
-    data += '</li>'
-
-    return data
+    res.append('</li>')
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Thumbnails of the uploaded images, cached on disk under the content hash of the image  """
+
+import hashlib
+import logging
+import os
+import os.path as op
+import threading
+from multiprocessing.pool import ThreadPool
+from flask import url_for
+from app import app
+
+# name -> (width, height, crop to the exact size)
+THUMBNAIL_SIZES = app.config.get('THUMBNAIL_SIZES', {
+    'small': (100, 100, True),
+    'medium': (320, 320, False),
+    'large': (1024, 1024, False),
+})
+# threads of each process generating the sizes of new uploads
+THUMBNAIL_WORKERS = app.config.get('THUMBNAIL_WORKERS', 2)
+# a thumbnail URL carries the hash of its image, so browsers may keep it for a year
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+UPLOAD_FOLDER = op.join(app.static_folder, 'img', 'uploads')
+THUMBNAIL_FOLDER = app.config.get('THUMBNAIL_FOLDER', op.join(app.static_folder, 'img', 'thumbs'))
+
+logger = logging.getLogger('app.thumbnails')
+_lock = threading.Lock()
+# variant file -> Event set once the thread generating it is done
+_inflight = {}
+# image path -> ((mtime, size), sha1 of the content)
+_hashes = {}
+_pool = None
+
+
+def source_path(path):
+    """Absolute path of an uploaded image, None for a path out of the upload folder"""
+    full = op.normpath(op.join(UPLOAD_FOLDER, path))
+    if not full.startswith(op.join(UPLOAD_FOLDER, '')):
+        return None
+    return full
+
+
+def content_hash(path):
+    """sha1 of the image, read again only when its mtime or size changes"""
+    full = source_path(path)
+    stat = os.stat(full)
+    key = (stat.st_mtime, stat.st_size)
+    cached = _hashes.get(path)
+    if cached is None or cached[0] != key:
+        sha1 = hashlib.sha1()
+        with open(full, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha1.update(block)
+        cached = (key, sha1.hexdigest())
+        _hashes[path] = cached
+    return cached[1]
+
+
+def variant_path(path, size):
+    """File of the size variant of an image, named after the content so a new upload gets new files"""
+    ext = op.splitext(path)[1].lower()
+    return op.join(THUMBNAIL_FOLDER, '{}_{}{}'.format(content_hash(path), size, ext))
+
+
+def render(source, target, size):
+    """Write the thumbnail of source to target, resized like flask_admin ImageUploadField does"""
+    from PIL import Image, ImageOps
+
+    width, height, crop = THUMBNAIL_SIZES[size]
+    image = Image.open(source)
+    image_format = image.format
+    if image.size[0] > width or image.size[1] > height:
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.ANTIALIAS)
+        else:
+            image = image.copy()
+            image.thumbnail((width, height), Image.ANTIALIAS)
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    if not op.isdir(THUMBNAIL_FOLDER):
+        try:
+            os.makedirs(THUMBNAIL_FOLDER)
+        except OSError:
+            # created by another process meanwhile
+            pass
+    # readers of target never see a partly written file
+    tmp = '{}.{}.{}.tmp'.format(target, os.getpid(), threading.current_thread().ident)
+    image.save(tmp, image_format)
+    os.rename(tmp, target)
+
+
+def variant(path, size):
+    """Return the file of the size variant of an image, generated on the first call.
+
+    Concurrent calls for the same variant wait for the thread generating it instead of
+    generating it again. Returns None when the image can't be read.
+    """
+    if size not in THUMBNAIL_SIZES or source_path(path) is None:
+        return None
+    try:
+        target = variant_path(path, size)
+    except (IOError, OSError):
+        return None
+    if op.exists(target):
+        return target
+
+    with _lock:
+        event = _inflight.get(target)
+        # generated by another thread since the check above
+        if event is None and op.exists(target):
+            return target
+        owner = event is None
+        if owner:
+            event = _inflight[target] = threading.Event()
+    if not owner:
+        event.wait()
+        return target if op.exists(target) else None
+
+    try:
+        render(source_path(path), target, size)
+    except Exception as e:
+        logger.error('thumbnail {} of {}: {}'.format(size, path, e))
+        return None
+    finally:
+        with _lock:
+            _inflight.pop(target, None)
+        event.set()
+    return target
+
+
+def generate(path):
+    for size in THUMBNAIL_SIZES:
+        variant(path, size)
+
+
+def pregenerate(path):
+    """Generate every size of a new upload in the thumbnail threads, without waiting for them"""
+    global _pool
+    with _lock:
+        # created by the first upload, after the uWSGI fork
+        if _pool is None:
+            _pool = ThreadPool(THUMBNAIL_WORKERS)
+    _pool.apply_async(generate, (path,))
+
+
+def remove(path):
+    """Delete the variants of an image, before the image itself"""
+    for size in THUMBNAIL_SIZES:
+        try:
+            os.remove(variant_path(path, size))
+        except (IOError, OSError):
+            pass
+    _hashes.pop(path, None)
+
+
+def thumbnail_url(path, size):
+    """URL of the size variant of an image, with the content hash so it can be cached for good"""
+    try:
+        version = content_hash(path)[:12]
+    except (IOError, OSError, TypeError):
+        return url_for('static', filename='img/uploads/' + path)
+    return url_for('home.thumbnail', size=size, filename=path, v=version)
@@ -284,6 +284,7 @@ class UserAdmin(MyModelView):
 
 from sqlalchemy.event import listens_for
 from flask_admin.form import ImageUploadField, FileUploadField, thumbgen_filename
+from .thumbnails import thumbnail_url, pregenerate, remove as remove_thumbnails
 
 PROJECT = 'vision'
 env_dir = '/home/%s/www' % PROJECT
@@ -314,8 +315,7 @@ class ImageView(ModelView):
         if not model.path:
             return ''
 
-        prefix = 'img/uploads/'
-        return Markup('<img src="%s">' % url_for('static', filename=thumbgen_filename(prefix + model.path)))
+        return Markup('<img src="%s">' % thumbnail_url(model.path, 'small'))
 
     column_formatters = {
         'path': _list_thumbnail
@@ -324,9 +324,14 @@ class ImageView(ModelView):
     # Alternative way to contribute field is to override it completely.
     # In this case, Flask-Admin won't attempt to merge various parameters for the field.
     form_extra_fields = {
-        'path': ImageUploadField('Image', base_path=file_path, thumbnail_size=(100, 100, True))
+        # the thumbnails are generated by app.admin.thumbnails, off the request
+        'path': ImageUploadField('Image', base_path=file_path)
     }
 
+    def after_model_change(self, form, model, is_created):
+        if model.path:
+            pregenerate(model.path)
+
     def __init__(self, dbsession):
         super(ImageView, self).__init__(Image, dbsession, name="Image", category='CMS')
 
@@ -344,13 +349,16 @@ def del_file(mapper, connection, target):
 @listens_for(Image, 'after_delete')
 def del_image(mapper, connection, target):
     if target.path:
+        # Delete the thumbnails, named after the content of the image
+        remove_thumbnails(target.path)
+
         # Delete image
         try:
             os.remove(op.join(file_path, target.path))
         except OSError:
             pass
 
-        # Delete thumbnail
+        # Delete the thumbnail of an image uploaded with a thumbnail_size
         try:
             os.remove(op.join(file_path,
                               thumbgen_filename(target.path)))
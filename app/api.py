@@ -1,11 +1,19 @@
-from flask import Flask, Blueprint, jsonify, abort, make_response, request
+from flask import Flask, Blueprint, jsonify, abort, make_response, request, Response, json, stream_with_context
 from flask.ext.sqlalchemy import SQLAlchemy
-from api_utility import MyValidator as Validator
-from api_utility import model_dict, eq_type_dict, Tree, TreeTranslation
-from app.diagnostic.models import Equipment, EquipmentType, TestResult, Campaign, FluidProfile
-from app.diagnostic.models import ElectricalProfile
-from collections import Iterable
+from api_utility import model_dict, eq_type_dict, validate, Tree, TreeTranslation
+from api_fields import SparseFields, split_names
+from api_filters import build_filters, build_order
+from app.cache import LRUCache, bump_versions, conditional
+from app.instrumentation import instrument
+from app.diagnostic.models import Equipment, EquipmentType, FluidProfile
+from app.diagnostic.models import ElectricalProfile, eager_load_options
+from app.diagnostic.models import DissolvedGasTest, TestResult, NormGas, GasGenerationRate, Campaign, NormFlag
+from app.diagnostic.models import GasSensor, GasSensorReading, ImportJob
+from app.diagnostic import dga, gas_rates, norms, readings, export, lab_import
+from collections import Iterable, defaultdict
+from itertools import islice
 from sqlalchemy import create_engine, MetaData
+from sqlalchemy.orm import class_mapper
 from flask.ext.blogging import SQLAStorage
 
 
@@ -13,65 +21,265 @@ api = Flask(__name__, static_url_path='/app/static')
 api.config.from_object('config')
 engine = create_engine(api.config['SQLALCHEMY_DATABASE_URI'])
 db = SQLAlchemy(api, session_options={'autoflush': False})
+instrument(api)
 api_blueprint = Blueprint('api_v1_0', __name__, url_prefix='/api/v1.0')
 meta = MetaData()
 sql_storage = SQLAStorage(engine, metadata=meta)
 
+# query string arguments used by the list handlers, never treated as filters
+reserved_args = ('limit', 'after', 'stream', 'fields', 'expand', 'sort')
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+# rows per multi-row INSERT statement
+BULK_CHUNK_SIZE = 1000
+# serialized responses kept in memory by each process, 0 disables the cache
+response_cache = LRUCache(api.config.get('API_RESPONSE_CACHE_SIZE', 0))
+
 
 def return_json(items_name, items_list):
     return jsonify({items_name: items_list})
 
 
-def new_instance(model, **param_dict):
+def new_instance(model, commit=True, **param_dict):
     item = model(**param_dict)
     db.session.add(item)
-    db.session.commit()
+    if commit:
+        db.session.commit()
+    else:
+        # the caller commits, flush to get the id
+        db.session.flush()
     return item
 
+
+def column_values(mapper, row):
+    """Translate a dict of attribute values to a dict of column values"""
+    return {mapper.get_property(key).columns[0].key: value for key, value in row.items()}
+
+
+def insert_rows(model, rows):
+    """Insert dicts of attribute values without committing, return the new ids in the same order.
+
+    Where the database supports it rows go through multi-row INSERT ... RETURNING statements,
+    one per set of keys and BULK_CHUNK_SIZE rows, otherwise through one INSERT per row.
+    """
+    mapper = class_mapper(model)
+    table = mapper.local_table
+    # core inserts don't go through the flush events
+    bump_versions(db.session.connection(), [table.name])
+    dialect = db.session.get_bind(mapper).dialect
+    if not (dialect.supports_multivalues_insert and dialect.implicit_returning):
+        ids = [db.session.execute(table.insert().values(column_values(mapper, row))).inserted_primary_key[0]
+               for row in rows]
+        after_insert_rows(model, rows)
+        return ids
+
+    ids = [None] * len(rows)
+    groups = defaultdict(list)
+    for index, row in enumerate(rows):
+        groups[tuple(sorted(row))].append(index)
+    for indexes in groups.values():
+        for start in range(0, len(indexes), BULK_CHUNK_SIZE):
+            chunk = indexes[start:start + BULK_CHUNK_SIZE]
+            values = [column_values(mapper, rows[index]) for index in chunk]
+            result = db.session.execute(table.insert().values(values).returning(mapper.primary_key[0]))
+            for index, (new_id,) in zip(chunk, result):
+                ids[index] = new_id
+    after_insert_rows(model, rows)
+    return ids
+
+
+def after_insert_rows(model, rows):
+    # core inserts don't go through the flush events either
+    if model is DissolvedGasTest:
+        gas_rates.refresh_tests(db.session.connection(), [row.get('test_result_id') for row in rows])
+
+
+def tree_params(equipment_id, equipment_type_id):
+    type_name = eq_type_dict.get(equipment_type_id, '')
+    return {
+        'equipment_id': equipment_id,
+        'parent_id': 32,
+        'icon': '../app/static/img/icons/{0}_b.ico'.format(type_name),
+        'type': '{0}'.format(type_name)
+    }
+
+
+def tree_translation_params(tree_id, name):
+    return {'id': tree_id, 'locale': 'en', 'text': name, 'tooltip': name}
+
+
+def serialize_items(items_model, items):
+    """Serialize rows in one go when the model knows how to batch its child queries"""
+    if hasattr(items_model, 'serialize_many'):
+        return items_model.serialize_many(items)
+    return [item.serialize() for item in items]
+
+
+def query_serializer(items_model, collections=True):
+    """Return the query options and the function serializing a list of rows for this request.
+
+    ?fields= and ?expand= restrict the selected columns and loaded relations,
+    otherwise everything serialize() reads is eager loaded.
+    """
+    if 'fields' not in request.args and 'expand' not in request.args:
+        options = eager_load_options(items_model, collections=collections)
+        return options, lambda items: serialize_items(items_model, items)
+    try:
+        sparse = SparseFields(items_model, request.args.get('fields'), request.args.get('expand'))
+    except ValueError as e:
+        abort(400, str(e))
+    return sparse.options(collections), sparse.serialize_many
+
+
 def get_item(path, item_id=None):
     items_model = model_dict[path]['model']
-    if item_id:
-        item = db.session.query(items_model).get(item_id) or abort(404)
-        return item.serialize()
-    if request.args:
-        kwargs = {key: request.args.get(key) for key in request.args if hasattr(items_model, key)
-                  or abort(400, 'Wrong attribute: {}'.format(key))
-                  }
-        if items_model == Campaign and 'equipment_id' in kwargs:
-            campaing_ids = {item.campaign_id for item in db.session.query(TestResult).filter_by(**kwargs)}
-            return [item.serialize() for item in db.session.query(Campaign).filter(Campaign.id.in_(campaing_ids))]
+    options, serialize = query_serializer(items_model)
+    item = db.session.query(items_model).options(*options).get(item_id) or abort(404)
+    return serialize([item])[0]
+
+
+def get_items_query(path):
+    items_model = model_dict[path]['model']
+    query = db.session.query(items_model)
+    args = [(key, value) for key, value in request.args.items() if key not in reserved_args]
+    if 'sort' in request.args and ('limit' in request.args or 'after' in request.args):
+        abort(400, 'Pages are ordered by id, sort can not be used with limit or after')
+    try:
+        return query.filter(*build_filters(items_model, args)).order_by(*build_order(items_model, request.args.get('sort')))
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def keyset_query(path, query):
+    """Order the query by id and apply the ``after`` cursor"""
+    items_model = model_dict[path]['model']
+    if not hasattr(items_model, 'id'):
+        abort(400, 'Pagination is not supported for: {}'.format(path))
 
-        return [item.serialize() for item in db.session.query(items_model).filter_by(**kwargs)]
-    return [item.serialize() for item in db.session.query(items_model).all()]
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            query = query.filter(items_model.id > int(after))
+        except ValueError:
+            abort(400, 'Wrong cursor: {}'.format(after))
+    return query.order_by(items_model.id)
+
+
+def get_items(path):
+    query = get_items_query(path)
+    if 'stream' in request.args:
+        return stream_items(path, query)
+    options, serialize = query_serializer(model_dict[path]['model'])
+    query = query.options(*options)
+
+    limit = request.args.get('limit')
+    if limit is None and 'after' not in request.args:
+        return return_json('result', serialize(query))
+
+    try:
+        limit = min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE)
+    except ValueError:
+        abort(400, 'Wrong limit: {}'.format(limit))
+    if limit < 1:
+        abort(400, 'Wrong limit: {}'.format(limit))
+
+    # fetch one extra row to know if there is a next page without a count query
+    items = keyset_query(path, query).limit(limit + 1).all()
+    next_cursor = items[limit - 1].id if len(items) > limit else None
+    return jsonify({'result': serialize(items[:limit]), 'next': next_cursor})
+
+
+def stream_items(path, query):
+    """Stream serialized rows read through a server-side cursor.
+
+    ``?stream=ndjson`` yields one JSON document per line,
+    any other value yields the usual {"result": [...]} envelope in chunks.
+    """
+    items_model = model_dict[path]['model']
+    if hasattr(items_model, 'id'):
+        query = keyset_query(path, query)
+    # yield_per can not be combined with collection eager loads
+    options, serialize = query_serializer(items_model, collections=False)
+    query = query.options(*options).yield_per(STREAM_CHUNK_SIZE)
+
+    def serialized():
+        rows = iter(query)
+        chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+        while chunk:
+            for data in serialize(chunk):
+                yield data
+            chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+
+    if request.args.get('stream') == 'ndjson':
+        def generate():
+            for data in serialized():
+                yield json.dumps(data) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    def generate():
+        yield '{"result": ['
+        separator = ''
+        for data in serialized():
+            yield separator + json.dumps(data)
+            separator = ', '
+        yield ']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 def add_item(path):
     items_model = model_dict[path]['model']
-    validation_schema = model_dict[path]['schema']
-    param_dict = {k: v for k, v in request.json.items()}
-    v = Validator()
-    if not v.validate(param_dict, validation_schema):
-        abort(400, v.errors)
+    param_dict, errors = validate(path, {k: v for k, v in request.json.items()})
+    if errors:
+        abort(400, errors)
 
-    item = new_instance(items_model, **param_dict)
+    item = new_instance(items_model, commit=False, **param_dict)
     if items_model == Equipment:
-        param_tree_dict = {
-            'equipment_id': item.id,
-            'parent_id': 32,
-            'icon': '../app/static/img/icons/{0}_b.ico'.format(eq_type_dict.get(item.equipment_type_id, '')),
-            'type': '{0}'.format(eq_type_dict.get(item.equipment_type_id, ''))
-        }
-        item_tree = new_instance(Tree, **param_tree_dict)
-
-        param_tree_trans_dict = {
-            'id': item_tree.id, 'locale': 'en',
-            'text': param_dict['name'],
-            'tooltip': param_dict['name']
-        }
-        new_instance(TreeTranslation, **param_tree_trans_dict)
+        item_tree = new_instance(Tree, commit=False, **tree_params(item.id, item.equipment_type_id))
+        new_instance(TreeTranslation, commit=False, **tree_translation_params(item_tree.id, param_dict['name']))
+    db.session.commit()
     return item.id
 
 
+def add_bulk(path):
+    """Validate a list of items and insert all of them in one transaction.
+
+    Equipment gets its tree nodes in the same transaction unless ?tree=0 is given.
+    """
+    items_model = model_dict[path]['model']
+    rows = request.json
+    if not isinstance(rows, list) or not rows:
+        abort(400, 'JSON list not found')
+
+    columns = {prop.key for prop in class_mapper(items_model).column_attrs}
+    errors = {}
+    for index, row in enumerate(rows):
+        if isinstance(row, dict):
+            # inserted with their coerced values
+            rows[index], row_errors = validate(path, row)
+        else:
+            row_errors = 'JSON object expected'
+        if not row_errors and not columns.issuperset(row):
+            row_errors = 'Wrong attribute: {}'.format(', '.join(sorted(set(row) - columns)))
+        if row_errors:
+            errors[index] = row_errors
+    if errors:
+        abort(400, errors)
+
+    try:
+        ids = insert_rows(items_model, rows)
+        if items_model == Equipment and request.args.get('tree') != '0':
+            tree_ids = insert_rows(Tree, [tree_params(item_id, row.get('equipment_type_id'))
+                                          for item_id, row in zip(ids, rows)])
+            insert_rows(TreeTranslation, [tree_translation_params(tree_id, row.get('name'))
+                                          for tree_id, row in zip(tree_ids, rows)])
+    except:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    return ids
+
+
 def update_item(path, item_id):
     items_model = model_dict[path]['model']
     item = db.session.query(items_model).get(item_id)
@@ -95,23 +303,25 @@ def delete_item(path, item_id):
 def add_items():
     path = 'test_result_equipment'
     items_model = model_dict[path]['model']
-    validation_schema = model_dict[path]['schema']
-    v = Validator()
-    if not v.validate(request.json, validation_schema):
-        abort(400, v.errors)
+    document, errors = validate(path, request.json)
+    if errors:
+        abort(400, errors)
 
-    campaign_id = request.json.get('campaign_id')
+    campaign_id = document.get('campaign_id')
     try:
-        db.session.query(items_model).filter(items_model.campaign_id == campaign_id).delete(synchronize_session=False)
+        # a savepoint keeps the transaction usable when the old results can't be deleted
+        with db.session.begin_nested():
+            db.session.query(items_model).filter(items_model.campaign_id == campaign_id)\
+                .delete(synchronize_session=False)
     except:
-        db.session.rollback()
-    else:
-        db.session.commit()
+        pass
 
-    equipment_ids = request.json.get('equipment_id')
+    equipment_ids = document.get('equipment_id')
     if not isinstance(equipment_ids, Iterable):
         equipment_ids = [equipment_ids]
-    return [new_instance(items_model, campaign_id=campaign_id, equipment_id=id).id for id in equipment_ids]
+    ids = insert_rows(items_model, [{'campaign_id': campaign_id, 'equipment_id': id} for id in equipment_ids])
+    db.session.commit()
+    return ids
 
 
 def get_equipment_type_fields(item_id):
@@ -125,6 +335,19 @@ def handler_equipment_type_fields(item_id):
     return return_json('result', get_equipment_type_fields(item_id))
 
 
+def path_models(path, item_id=None):
+    """Return the models serialized by the read handlers of path"""
+    if path not in model_dict:
+        abort(404)
+    items_model = model_dict[path]['model']
+    models = [items_model]
+    relations = class_mapper(items_model).relationships
+    for name in split_names(request.args.get('expand')):
+        if name in relations:
+            models.append(relations[name].mapper.class_)
+    return models
+
+
 @api.errorhandler(404)
 def not_found(error):
     return make_response(return_json('error', 'Not found'), 404)
@@ -136,15 +359,18 @@ def bad_request(error):
 
 
 @api_blueprint.route('/<path>/', methods=['GET', 'POST'])
+@conditional(db.session, path_models, response_cache)
 def handler(path, item_id=None):
     if path not in model_dict:
         abort(404)
 
+    if request.method == 'GET':
+        return get_items(path)
+
     if request.method == 'POST' and not request.json:
             abort(400, 'JSON not found')
 
     crud_functions = {
-        'GET': get_item,
         'POST': add_item,
         # 'PUT': update_item,
         # 'DELETE': delete_item
@@ -156,7 +382,19 @@ def handler(path, item_id=None):
     return return_json('result', crud_func(*args))
 
 
+@api_blueprint.route('/<path>/_bulk', methods=['POST', ])
+def handler_bulk(path):
+    if path not in model_dict:
+        abort(404)
+
+    if not request.json:
+        abort(400, 'JSON not found')
+
+    return return_json('result', add_bulk(path))
+
+
 @api_blueprint.route('/<path>/<int:item_id>', methods=['GET', 'PUT', 'POST', 'DELETE'])
+@conditional(db.session, path_models, response_cache)
 def handler_with_id(path, item_id=None):
     if path not in model_dict:
         abort(404)
@@ -178,12 +416,128 @@ def handler_with_id(path, item_id=None):
 
 
 @api_blueprint.route('/test_profile/', methods=['GET', ])
+@conditional(db.session, lambda: [FluidProfile, ElectricalProfile], response_cache)
 def get_test_profile():
     rows_fluid = db.session.query(FluidProfile).all()
     rows_electrical = db.session.query(ElectricalProfile).all()
     return return_json('result', [item.serialize() for rows in (rows_fluid, rows_electrical) for item in rows])
 
 
+def id_list(name):
+    try:
+        return [int(value) for value in split_names(request.args.get(name))]
+    except ValueError:
+        abort(400, 'Wrong {}: {}'.format(name, request.args.get(name)))
+
+
+@api_blueprint.route('/dissolved_gas_test/diagnosis', methods=['GET', ])
+@conditional(db.session, lambda: [DissolvedGasTest, TestResult, NormGas], response_cache)
+def get_gas_diagnosis():
+    samples = dga.load_samples(db.session, id_list('equipment_id'), id_list('test_result_id'))
+    try:
+        norm = dga.load_norm(db.session, request.args.get('norm'))
+    except ValueError as e:
+        abort(400, str(e))
+    result = dga.serialize(samples, dga.diagnose(samples, norm))
+    return jsonify({'result': result, 'legend': dga.LEGEND})
+
+
+@api_blueprint.route('/equipment/gas_rates', methods=['GET', ])
+@conditional(db.session, lambda: [GasGenerationRate], response_cache)
+def get_gas_rates_exceeding():
+    gas = request.args.get('gas', 'tdcg')
+    try:
+        threshold = float(request.args.get('threshold', 0))
+        items = gas_rates.exceeding(db.session, gas, threshold)
+    except ValueError as e:
+        abort(400, str(e))
+    return return_json('result', [item.serialize() for item in items])
+
+
+@api_blueprint.route('/equipment/<int:item_id>/gas_rates', methods=['GET', ])
+@conditional(db.session, lambda item_id: [GasGenerationRate], response_cache)
+def get_gas_rates_history(item_id):
+    return return_json('result', [item.serialize() for item in gas_rates.history(db.session, item_id)])
+
+
+@api_blueprint.route('/campaign/<int:item_id>/norm_flags', methods=['GET', 'POST'])
+@conditional(db.session, lambda item_id: [NormFlag], response_cache)
+def handler_norm_flags(item_id):
+    db.session.query(Campaign.id).filter(Campaign.id == item_id).scalar() or abort(404)
+    if request.method == 'POST':
+        flags = norms.flag_campaign(db.session, item_id)
+        db.session.commit()
+        return return_json('result', flags)
+
+    items = db.session.query(NormFlag).filter(NormFlag.campaign_id == item_id) \
+        .order_by(NormFlag.test_table, NormFlag.test_id, NormFlag.field).all()
+    return return_json('result', [item.serialize() for item in items])
+
+
+@api_blueprint.route('/gas_sensor/<int:item_id>/readings', methods=['GET', 'POST'])
+# without start and end the window ends now, the same URL gives other readings as time goes by
+@conditional(db.session, lambda item_id: [GasSensorReading], response_cache,
+             cacheable=lambda item_id: bool(request.args.get('start') and request.args.get('end')))
+def handler_readings(item_id):
+    db.session.query(GasSensor.id).filter(GasSensor.id == item_id).scalar() or abort(404)
+    try:
+        if request.method == 'POST':
+            count = readings.ingest(db.session.connection(), item_id,
+                                    readings.read_readings(request.stream, request.mimetype))
+            db.session.commit()
+            return return_json('result', count)
+        return return_json('result', readings.query_readings(db.session, item_id, request.args))
+    except ValueError as e:
+        db.session.rollback()
+        abort(400, str(e))
+
+
+@api_blueprint.route('/<path>/_import', methods=['POST', ])
+def handler_import(path):
+    try:
+        job = lab_import.start(db.session, path, request.stream, request.mimetype,
+                               request.args.get('filename'))
+    except ValueError as e:
+        abort(400, str(e))
+    return return_json('result', job.serialize())
+
+
+@api_blueprint.route('/import_job/<int:item_id>', methods=['GET', 'POST'])
+def handler_import_job(item_id):
+    job = db.session.query(ImportJob).get(item_id) or abort(404)
+    if request.method == 'POST':
+        if job.status == 'done':
+            abort(400, 'Import {} is done'.format(item_id))
+        try:
+            job = lab_import.run(db.session, job, request.stream, request.mimetype)
+        except ValueError as e:
+            abort(400, str(e))
+    return return_json('result', job.serialize())
+
+
+def export_response(filename, **filters):
+    """Stream the CSV export of the test results matching filters as an attachment"""
+    response = Response(stream_with_context(export.export_csv(db.session, **filters)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+    return response
+
+
+@api_blueprint.route('/campaign/<int:item_id>/export.csv', methods=['GET', ])
+def get_campaign_export(item_id):
+    db.session.query(Campaign.id).filter(Campaign.id == item_id).scalar() or abort(404)
+    return export_response('campaign_{}.csv'.format(item_id), campaign_id=item_id)
+
+
+@api_blueprint.route('/test_result/export.csv', methods=['GET', ])
+def get_test_result_export():
+    try:
+        start = readings.parse_time(request.args['start']) if request.args.get('start') else None
+        end = readings.parse_time(request.args['end']) if request.args.get('end') else None
+    except (ValueError, TypeError, OverflowError):
+        abort(400, 'Wrong start or end')
+    return export_response('test_results.csv', start=start, end=end, equipment_ids=id_list('equipment_id'))
+
+
 @api_blueprint.route('/test_result/equipment', methods=['POST', ])
 def handler_items():
     if not request.json:
@@ -90,6 +90,29 @@ doc = ApiDoc(app=api)
 @apiExample {curl} Example usage:
     curl -i http://localhost:8001/api/v1.0/<path>/
 
+@apiExample {curl} Example with pagination:
+    curl -i http://localhost:8001/api/v1.0/<path>/?limit=100&after=42
+
+@apiExample {curl} Example with streaming:
+    curl -i http://localhost:8001/api/v1.0/<path>/?stream=ndjson
+
+@apiExample {curl} Example with sparse fields:
+    curl -i http://localhost:8001/api/v1.0/equipment/?fields=id,name,serial&expand=location
+
+@apiExample {curl} Example with filters and sorting:
+    curl -i http://localhost:8001/api/v1.0/test_result/?date_analyse__ge=2016-01-01&date_analyse__lt=2016-07-01&sort=-date_analyse
+
+@apiParam {Integer}   limit     optional, page size (max 1000), the response gets a "next" cursor
+@apiParam {Integer}   after     optional, cursor: only items with id greater than this one
+@apiParam {String}    stream    optional, "ndjson" for one item per line, any other value for a chunked JSON list
+@apiParam {String}    fields    optional, comma separated columns to return, other columns are not selected
+@apiParam {String}    expand    optional, comma separated relations to embed, other relations are not loaded
+@apiParam {String}    sort      optional, comma separated columns, "-" before a column sorts descending; not with limit or after
+@apiParam {String}    column    optional filter: column=value or column__op=value with op one of
+                                eq, ne, gt, ge, lt, le, in (comma separated values), like, ilike, isnull (true/false);
+                                values are converted to the column type, dates use any format dateutil understands
+@apiHeader {String}   If-None-Match  optional, ETag of a previous response: 304 Not Modified while no table it reads changed
+@apiSuccess {Integer}  next  Cursor for the next page or null, only present when limit or after is given.
 @apiUse GetItemsSuccess
 @apiUse Error404
 """
@@ -101,6 +124,9 @@ doc = ApiDoc(app=api)
 @apiExample {curl} Example usage:
     curl -i http://localhost:8001/api/v1.0/<path>/1
 
+@apiExample {curl} Example with sparse fields:
+    curl -i http://localhost:8001/api/v1.0/<path>/1?fields=id,name&expand=location
+
 @apiSuccessExample Success-Response:
     HTTP/1.0 200 OK
     Content-Type: application/json
@@ -128,6 +154,68 @@ doc = ApiDoc(app=api)
 @apiUse Error400
 """
 """
+@api {post} /<path>/_bulk Add a list of new items
+@apiVersion 1.0.0
+@apiName add_bulk
+@apiGroup General
+@apiDescription All items are validated first, then inserted in one transaction.
+                Validation errors are returned by item index, nothing is inserted then.
+@apiExample {curl} Example usage:
+    curl -i -H "Content-Type: application/json" -X POST -d '[{"name": "first"}, {"name": "second"}]' \
+         http://localhost:8001/api/v1.0/<path>/_bulk
+
+@apiParam {Integer}   tree      optional, equipment only: 0 to skip the creation of tree nodes
+@apiSuccess {List}  result  The new item ids, in the order of the posted items.
+@apiSuccessExample Success-Response:
+    HTTP/1.0 200 OK
+    Content-Type: application/json
+    {
+      "result": [5, 6]
+    }
+@apiUse Error400
+"""
+"""
+@api {post} /<path>/_import Import a file of lab results
+@apiVersion 1.0.0
+@apiName import_results
+@apiGroup General
+@apiDescription Test tables only (dissolved_gas_test, fluid_test, metals_in_oil_test ...).
+                The file is read, validated and inserted 1000 lines at a time, every chunk is committed
+                with the progress of the import job. Invalid lines are rejected and reported, the others imported.
+                A line names its test result by test_result_id, or by equipment_serial and date_analyse.
+                After a failure send the same file to /import_job/:id to resume after the last committed line.
+@apiExample {curl} Example usage:
+    curl -i -H "Content-Type: text/csv" -X POST --data-binary @dga.csv \
+         http://localhost:8001/api/v1.0/dissolved_gas_test/_import?filename=dga.csv
+
+@apiParam {String}    body      text/csv with a header line of column names or application/x-ndjson
+@apiParam {String}    filename  optional, kept with the job
+@apiSuccess {Object}  result    The import job, see /import_job/:id
+@apiUse Error400
+"""
+"""
+@api {get} /import_job/:id Get an import job
+@apiVersion 1.0.0
+@apiName get_import_job
+@apiGroup General
+@apiDescription POST the same file again to resume an import which failed.
+@apiExample {curl} Example usage:
+    curl -i http://localhost:8001/api/v1.0/import_job/1
+
+@apiSuccess {Integer}   id
+@apiSuccess {String}    table_name
+@apiSuccess {String}    filename
+@apiSuccess {String}    status      running, failed or done
+@apiSuccess {Integer}   line        last line of the file committed
+@apiSuccess {Integer}   imported    rows imported
+@apiSuccess {Integer}   rejected    invalid lines
+@apiSuccess {List}      errors      the first 1000 rejected lines: {"line": 4, "errors": {"h2": "wrong value: x"}}
+@apiSuccess {String}    message     why the import failed
+@apiSuccess {List}      created
+@apiSuccess {List}      updated
+@apiUse Error404
+"""
+"""
 @api {put} /<path>/:id Update an item
 @apiVersion 1.0.0
 @apiName update_item
@@ -409,6 +497,55 @@ doc = ApiDoc(app=api)
 @apiUse DelItemSuccess
 @apiUse Error404
 """
+"""
+@api {get} /equipment/gas_rates Get the equipment with high gas generation rates
+@apiVersion 1.0.0
+@apiName get_gas_rates_exceeding
+@apiGroup equipment
+@apiDescription The latest rate (ppm/day, since the previous dissolved gas test) of every equipment
+                whose latest rate of gas is above threshold, highest first.
+                Rates are updated each time dissolved gas tests or their test results are written.
+@apiExample {curl} Example usage:
+      curl -i http://localhost:8001/api/v1.0/equipment/gas_rates?gas=c2h2&threshold=0.5
+
+@apiParam {String}  gas         optional, h2, ch4, c2h2, c2h4, c2h6, co, co2 or tdcg (default)
+@apiParam {Float}   threshold   optional, ppm/day, 0 by default
+@apiSuccess {Integer}   dissolved_gas_test_id
+@apiSuccess {Integer}   previous_test_id
+@apiSuccess {Integer}   equipment_id
+@apiSuccess {List}      date_analyse
+@apiSuccess {Float}     days            days since the previous test
+@apiSuccess {Float}     h2              and ch4, c2h2, c2h4, c2h6, co, co2, tdcg: ppm/day,
+                                        null for tests of the same day or a missing value
+@apiSuccessExample Success-Response:
+    HTTP/1.0 200 OK
+    Content-Type: application/json
+    {
+      "result": [
+        {
+          "dissolved_gas_test_id": 12,
+          "previous_test_id": 9,
+          "equipment_id": 3,
+          "date_analyse": ["2016-04-01", "00:00:00"],
+          "days": 59.0,
+          "tdcg": 6.4,
+          ...
+        }
+      ]
+    }
+@apiUse Error400
+"""
+"""
+@api {get} /equipment/:id/gas_rates Get the gas generation rates of an equipment
+@apiVersion 1.0.0
+@apiName get_gas_rates_history
+@apiGroup equipment
+@apiDescription Rates between successive dissolved gas tests of the equipment, by date.
+@apiExample {curl} Example usage:
+      curl -i http://localhost:8001/api/v1.0/equipment/3/gas_rates
+
+@apiSuccess {List}  result  Rates, with the fields of /equipment/gas_rates
+"""
 
 
 # Equipment_type
@@ -1205,6 +1342,20 @@ doc = ApiDoc(app=api)
 @apiUse Error404
 """
 """
+@api {get} /test_result/export.csv Export the test results of the fleet
+@apiVersion 1.0.0
+@apiName get_test_result_export
+@apiGroup test_result
+@apiDescription Same CSV as /campaign/:id/export.csv, for the test results of every campaign.
+@apiExample {curl} Example usage:
+    curl -o results.csv "http://localhost:8001/api/v1.0/test_result/export.csv?start=2016-01-01&end=2017-01-01"
+
+@apiParam {String}  start           optional, test results analysed since start
+@apiParam {String}  end             optional, test results analysed before end
+@apiParam {String}  equipment_id    optional, comma separated ids
+@apiUse Error400
+"""
+"""
 @api {post} /test_result Add a new item
 @apiVersion 1.0.0
 @apiName add_item
@@ -1433,6 +1584,75 @@ doc = ApiDoc(app=api)
 @apiUse DelItemSuccess
 @apiUse Error404
 """
+"""
+@api {post} /campaign/:id/norm_flags Check the tests of a campaign against their norms
+@apiVersion 1.0.0
+@apiName flag_norms
+@apiGroup campaign
+@apiDescription All the tests of the campaign are checked at once and the norm_flag rows of the campaign
+                are replaced by the measurements out of range:
+                fluid_test and water_test against the norm_physic row of the equipment,
+                furan_test fal above c1 of the first norm_furan (condition 1 up to c1 ... 5 above c4),
+                insulation_resistance_test resistances below the norm_isolation notseal minimum
+                at the temperature of the test result.
+                The evaluation is reused until a norm or a test changes.
+@apiExample {curl} Example usage:
+    curl -i -X POST http://localhost:8001/api/v1.0/campaign/1/norm_flags
+
+@apiSuccess {String}    test_table
+@apiSuccess {Integer}   test_id
+@apiSuccess {String}    field
+@apiSuccess {Integer}   campaign_id
+@apiSuccess {Integer}   test_result_id
+@apiSuccess {Float}     value
+@apiSuccess {Float}     low         lowest allowed value, null if none
+@apiSuccess {Float}     high        highest allowed value, null if none
+@apiSuccess {Integer}   condition   furan condition, null for the other tests
+@apiSuccessExample Success-Response:
+    HTTP/1.0 200 OK
+    Content-Type: application/json
+    {
+      "result": [
+        {
+          "test_table": "fluid_test",
+          "test_id": 2,
+          "field": "ift",
+          "campaign_id": 1,
+          "test_result_id": 2,
+          "value": 30.0,
+          "low": 35.0,
+          "high": null,
+          "condition": null
+        }
+      ]
+    }
+@apiUse Error404
+"""
+"""
+@api {get} /campaign/:id/norm_flags Get the norm flags of a campaign
+@apiVersion 1.0.0
+@apiName get_norm_flags
+@apiGroup campaign
+@apiDescription The flags written by the last POST, same fields.
+@apiExample {curl} Example usage:
+    curl -i http://localhost:8001/api/v1.0/campaign/1/norm_flags
+
+@apiUse Error404
+"""
+"""
+@api {get} /campaign/:id/export.csv Export the test results of a campaign
+@apiVersion 1.0.0
+@apiName get_campaign_export
+@apiGroup campaign
+@apiDescription CSV streamed while it is read from the database: a row per row of the test table of each
+                test result (resolved through test_type_result_table), or per test result without any.
+                The test_result columns and equipment_serial, equipment_name, test_type_name come first,
+                then the columns of every exported test table named table.column.
+@apiExample {curl} Example usage:
+    curl -o campaign_1.csv http://localhost:8001/api/v1.0/campaign/1/export.csv
+
+@apiUse Error404
+"""
 
 
 # role
@@ -1764,6 +1984,58 @@ doc = ApiDoc(app=api)
 @apiUse DelItemSuccess
 @apiUse Error404
 """
+"""
+@api {post} /gas_sensor/:id/readings Add readings of a sensor
+@apiVersion 1.0.0
+@apiName post_readings
+@apiGroup gas_sensor
+@apiDescription Readings stored over the time span of the body are replaced by the readings of the body.
+                taken_at is a UTC ISO 8601 time or epoch seconds, the other fields are optional numbers.
+@apiExample {curl} Example usage:
+    curl -i -H "Content-Type: text/csv" -X POST --data-binary @readings.csv\
+    http://localhost:8001/api/v1.0/gas_sensor/1/readings
+
+@apiParam {String}  body    text/csv with a header line or application/x-ndjson, one reading per line, fields:
+                            taken_at, cap_gaz, h2, ch4, c2h2, c2h4, c2h6, co, co2, o2, n2, water, oil_temperature
+@apiSuccess {Integer}   result  readings stored
+@apiUse Error400
+@apiUse Error404
+"""
+"""
+@api {get} /gas_sensor/:id/readings Get the readings of a sensor over a time range
+@apiVersion 1.0.0
+@apiName get_readings
+@apiGroup gas_sensor
+@apiDescription Columnar readings of [start, end), aggregated by the database into buckets
+                unless bucket is 0. Raw readings are limited to 10000.
+                Only requests giving both start and end get an ETag and 304 answers.
+@apiExample {curl} Example usage:
+      curl -i "http://localhost:8001/api/v1.0/gas_sensor/1/readings?start=2016-01-01&end=2016-03-01&fields=h2,co"
+
+@apiParam {String}  start   optional, UTC, one day before end by default
+@apiParam {String}  end     optional, UTC, now by default
+@apiParam {String}  fields  optional, comma separated, all fields by default
+@apiParam {Integer} bucket  optional, seconds per bucket, 0 for raw readings
+@apiParam {Integer} points  optional, buckets over the range when bucket is not given, 1000 by default
+@apiSuccess {List}      t       epoch seconds of each reading or starting each non empty bucket
+@apiSuccess {Integer}   bucket  seconds per bucket, 0 for raw readings
+@apiSuccess {List}      count   readings per bucket
+@apiSuccess {Object}    h2      and every other field: a list of raw values,
+                                or min, max and avg lists by bucket
+@apiSuccessExample Success-Response:
+    HTTP/1.0 200 OK
+    Content-Type: application/json
+    {
+      "result": {
+        "t": [1451606400, 1451616941],
+        "bucket": 10541,
+        "count": [176, 176],
+        "h2": {"min": [0.0, 0.0], "max": [99.0, 99.0], "avg": [44.3, 47.6]}
+      }
+    }
+@apiUse Error400
+@apiUse Error404
+"""
 
 
 # transformer
@@ -5001,6 +5273,56 @@ doc = ApiDoc(app=api)
 @apiUse DelItemSuccess
 @apiUse Error404
 """
+"""
+@api {get} /dissolved_gas_test/diagnosis Diagnose the dissolved gas tests
+@apiVersion 1.0.0
+@apiName get_diagnosis
+@apiGroup dissolved_gas_test
+@apiDescription All the tests are diagnosed at once. The result is columnar: one list per field,
+                the n-th value of every list belongs to the n-th test.
+                Gases flagged not detectable count as 0 ppm, a ratio over 0 ppm is null.
+                Answers 304 to a matching If-None-Match until a test, result or norm changes.
+@apiExample {curl} Example usage:
+      curl -i http://localhost:8001/api/v1.0/dissolved_gas_test/diagnosis?equipment_id=1,2&norm=IEEE
+
+@apiParam {String}  equipment_id    optional, comma separated ids of the equipment to diagnose
+@apiParam {String}  test_result_id  optional, comma separated ids of the test results to diagnose
+@apiParam {String}  norm            optional, name of the norm_gas rows giving the condition limits,
+                                    the first name by default, 400 with the known names for another name
+@apiSuccess {List}    id              dissolved_gas_test ids
+@apiSuccess {List}    test_result_id
+@apiSuccess {List}    equipment_id
+@apiSuccess {List}    date_analyse
+@apiSuccess {List}    tdcg            Total dissolved combustible gas (ppm)
+@apiSuccess {List}    rogers          Rogers ratios fault, null when no case matches
+@apiSuccess {List}    doernenburg     Doernenburg ratios fault, null when no case matches
+@apiSuccess {List}    iec             IEC 60599 fault, null when no case matches
+@apiSuccess {List}    duval           Duval triangle 1 zone, null without CH4, C2H4 and C2H2
+@apiSuccess {List}    condition       Worst norm_gas condition of the gases and tdcg,
+                                      highest condition + 1 above all limits, 0 without limits
+@apiSuccess {Object}  ratios          ch4_h2, c2h2_c2h4, c2h4_c2h6, c2h2_ch4 and c2h6_c2h2 lists
+@apiSuccess {Object}  legend          Possible values of rogers, doernenburg, iec and duval
+@apiSuccessExample Success-Response:
+    HTTP/1.0 200 OK
+    Content-Type: application/json
+    {
+      "result": {
+        "id": [1, 2],
+        "test_result_id": [1, 2],
+        "equipment_id": [1, 1],
+        "date_analyse": [["2016-01-01", "00:00:00"], ["2016-02-01", "00:00:00"]],
+        "tdcg": [121.0, 1802.0],
+        "rogers": ["Normal", "Thermal > 700C"],
+        "doernenburg": ["Not significant", "Thermal decomposition"],
+        "iec": [null, "T3"],
+        "duval": ["T1", "T3"],
+        "condition": [1, 3],
+        "ratios": {"ch4_h2": [0.5, 1.8], ...}
+      },
+      "legend": {"rogers": ["Normal", ...], ...}
+    }
+@apiUse Error400
+"""
 
 
 # water_test
@@ -0,0 +1,53 @@
+from datetime import datetime
+from sqlalchemy.orm import class_mapper, load_only
+from app.diagnostic.models import dump_datetime, eager_load_options
+
+
+def split_names(value):
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+class SparseFields(object):
+    """Columns and relations requested with ?fields=id,name&expand=location
+
+    Only the requested columns (plus the primary key) are selected,
+    only the expanded relations are loaded, each one with its full serialize().
+    """
+
+    def __init__(self, model, fields=None, expand=None):
+        mapper = class_mapper(model)
+        columns = [prop.key for prop in mapper.column_attrs]
+        relations = {prop.key: prop for prop in mapper.relationships}
+        self.model = model
+        self.fields = split_names(fields) or columns
+        self.expand = split_names(expand)
+        for name in self.fields:
+            if name not in columns:
+                raise ValueError('Wrong field: {}'.format(name))
+        for name in self.expand:
+            if name not in relations:
+                raise ValueError('Wrong relation: {}'.format(name))
+        self.collections = [name for name in self.expand if relations[name].uselist]
+
+        primary_key = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+        self.load = primary_key + [name for name in self.fields if name not in primary_key]
+
+    def options(self, collections=True):
+        """Return query options, collections=False leaves expanded collections to lazy loading"""
+        return [load_only(*self.load)] + eager_load_options(self.model, self.expand, collections)
+
+    def serialize(self, item):
+        data = {}
+        for name in self.fields:
+            value = getattr(item, name)
+            data[name] = dump_datetime(value) if isinstance(value, datetime) else value
+        for name in self.expand:
+            value = getattr(item, name)
+            if name in self.collections:
+                data[name] = [related.serialize() for related in value]
+            else:
+                data[name] = value and value.serialize()
+        return data
+
+    def serialize_many(self, items):
+        return [self.serialize(item) for item in items]
@@ -0,0 +1,161 @@
+import logging
+import operator
+from decimal import Decimal
+from dateutil import parser as date_parser
+from sqlalchemy import types, PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.ext.hybrid import Comparator
+
+# ?name__op=value, ?name=value is the same as ?name__eq=value
+SEPARATOR = '__'
+OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'lt': operator.lt,
+    'le': operator.le,
+    'in': lambda column, values: column.in_(values),
+    'like': lambda column, value: column.like(value),
+    'ilike': lambda column, value: column.ilike(value),
+    'isnull': lambda column, value: column.is_(None) if value else column.isnot(None),
+}
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+# (table, column, reason) already logged by the index advisor
+_reported = set()
+
+
+def get_column(model, name):
+    column_attrs = class_mapper(model).column_attrs
+    if name in column_attrs.keys():
+        return column_attrs[name].columns[0]
+    # hybrid properties comparing a column of related rows, such as Campaign.equipment_id
+    comparator = getattr(getattr(model, name, None), 'comparator', None)
+    if isinstance(comparator, Comparator):
+        return comparator.expression.property.columns[0]
+    raise ValueError('Wrong attribute: {}'.format(name))
+
+
+def to_bool(value):
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise ValueError(value)
+
+
+def coerce(column, value):
+    """Convert a query string value to the python type of column"""
+    column_type = column.type
+    try:
+        if isinstance(column_type, types.Boolean):
+            return to_bool(value)
+        if isinstance(column_type, types.Integer):
+            return int(value)
+        if isinstance(column_type, types.Float):
+            return float(value)
+        if isinstance(column_type, types.Numeric):
+            return Decimal(value)
+        if isinstance(column_type, types.DateTime):
+            return date_parser.parse(value)
+        if isinstance(column_type, types.Date):
+            return date_parser.parse(value).date()
+        if isinstance(column_type, types.Time):
+            return date_parser.parse(value).time()
+    # dateutil raises TypeError for some strings without a date
+    except (ValueError, TypeError, ArithmeticError, OverflowError):
+        raise ValueError('Wrong value for {}: {}'.format(column.key, value))
+    return value
+
+
+def build_filter(model, key, value):
+    """Return the SQL expression for one ?name__op=value argument"""
+    name, op = key, 'eq'
+    if SEPARATOR in key:
+        name, op = key.rsplit(SEPARATOR, 1)
+    if op not in OPERATORS:
+        raise ValueError('Wrong operator: {}'.format(op))
+
+    column = get_column(model, name)
+    if op == 'in':
+        value = [coerce(column, item) for item in value.split(',')]
+    elif op == 'isnull':
+        try:
+            value = to_bool(value)
+        except ValueError:
+            raise ValueError('Wrong value for {}: {}'.format(key, value))
+    elif op not in ('like', 'ilike'):
+        value = coerce(column, value)
+
+    advise(column, op, value)
+    return OPERATORS[op](getattr(model, name), value)
+
+
+def build_filters(model, args):
+    """Return SQL expressions for the (key, value) pairs of the query string"""
+    return [build_filter(model, key, value) for key, value in args]
+
+
+def build_order(model, sort):
+    """Return order_by clauses for ?sort=-date_analyse,id, a leading minus sorts descending"""
+    clauses = []
+    for name in (sort or '').split(','):
+        name = name.strip()
+        if not name:
+            continue
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name not in class_mapper(model).column_attrs.keys():
+            raise ValueError('Wrong sort attribute: {}'.format(name))
+        attribute = getattr(model, name)
+        clauses.append(attribute.desc() if descending else attribute.asc())
+    return clauses
+
+
+def leading_index_columns(table):
+    """Return the columns which lead an index declared on table"""
+    columns = set()
+    for constraint in table.constraints:
+        if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint)) and len(constraint.columns):
+            columns.add(list(constraint.columns)[0])
+    for index in table.indexes:
+        if len(index.columns):
+            columns.add(list(index.columns)[0])
+    return columns
+
+
+def unindexed_reason(column, op, value):
+    """Return why a filter can't use an index or None"""
+    if column not in leading_index_columns(column.table):
+        return 'no index starts with {}'.format(column.key)
+    if op == 'ne':
+        return 'a negation scans the whole index'
+    if op == 'ilike':
+        return 'ilike needs an expression index on lower({})'.format(column.key)
+    if op == 'like' and value[:1] in ('%', '_'):
+        return 'a leading wildcard can not use the index'
+
+
+def advise(column, op, value):
+    """Log once for every filter which can not use an index"""
+    reason = unindexed_reason(column, op, value)
+    key = (column.table.name, column.key, reason)
+    if reason and key not in _reported:
+        _reported.add(key)
+        logging.warning('Filter on {}.{} can not use an index: {}'.format(column.table.name, column.key, reason))
+
+
+def index_report(model_dict):
+    """Return (path, column, type) for the filterable date and key columns of the API models without an index"""
+    report = []
+    for path, entry in sorted(model_dict.items()):
+        table = class_mapper(entry['model']).local_table
+        indexed = leading_index_columns(table)
+        for column in table.columns:
+            if column in indexed:
+                continue
+            if column.foreign_keys or isinstance(column.type, (types.Date, types.DateTime)):
+                report.append((path, '{}.{}'.format(table.name, column.name), str(column.type)))
+    return report
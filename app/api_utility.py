@@ -1,4 +1,5 @@
 import math
+import threading
 
 from app.diagnostic.models import *
 from app.users.models import User, Role
@@ -74,6 +75,95 @@ class MyValidator(Validator):
     #     self.document.get('corr')):
     #     testcheckedtemp = 1
 
+
+class RuleCheck(object):
+    """Stands for the validator when the custom MyValidator rules run outside cerberus"""
+    def __init__(self, document):
+        self.document = document
+        self.failed = False
+
+    def _error(self, field, message):
+        self.failed = True
+
+
+class CompiledValidator(object):
+    """Validator of one schema, built once and shared by the requests.
+
+    Cerberus validators keep the document being validated, so every thread gets its own.
+    Schemas made only of the rules below and the custom MyValidator rules are first checked
+    in plain python, cerberus then only runs for documents which may be invalid, to report the errors.
+    """
+    simple_rules = ('type', 'coerce', 'min', 'max', 'maxlength', 'allowed', 'readonly', 'required')
+    simple_types = {
+        'integer': (int, long),
+        'float': (int, long, float),
+        'boolean': (bool, ),
+        'string': (basestring, ),
+    }
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.local = threading.local()
+        self.required = [field for field, rules in schema.items() if isinstance(rules, dict) and rules.get('required')]
+        self.fast = all(isinstance(rules, dict) and isinstance(rules.get('type', 'string'), basestring) and
+                        rules.get('type', 'string') in self.simple_types and
+                        all(rule in self.simple_rules or self.custom_rule(rule) for rule in rules)
+                        for rules in schema.values())
+        # a broken schema raises SchemaError at import rather than on the first request
+        self.validator()
+
+    @staticmethod
+    def custom_rule(rule):
+        return MyValidator.__dict__.get('_validate_' + rule)
+
+    def validator(self):
+        if not hasattr(self.local, 'validator'):
+            self.local.validator = MyValidator(self.schema)
+        return self.local.validator
+
+    def fast_valid(self, document):
+        """Return document with its values coerced if it is valid, None if cerberus has to decide"""
+        if not isinstance(document, dict) or not all(field in document for field in self.required):
+            return None
+        coerced = {}
+        for field, value in document.items():
+            rules = self.schema.get(field)
+            if rules is None or value is None or rules.get('readonly'):
+                return None
+            if 'coerce' in rules:
+                try:
+                    value = rules['coerce'](value)
+                except Exception:
+                    return None
+            coerced[field] = value
+
+        check = RuleCheck(coerced)
+        for field, value in coerced.items():
+            rules = self.schema[field]
+            if 'type' in rules and not isinstance(value, self.simple_types[rules['type']]):
+                return None
+            if 'min' in rules and value < rules['min'] or 'max' in rules and value > rules['max']:
+                return None
+            if 'maxlength' in rules and len(value) > rules['maxlength']:
+                return None
+            if 'allowed' in rules and value not in rules['allowed']:
+                return None
+            for rule, rule_value in rules.items():
+                if rule not in self.simple_rules:
+                    self.custom_rule(rule)(check, rule_value, field, value)
+        return None if check.failed else coerced
+
+    def normalize(self, document):
+        """Return (document with its values coerced, None) if document is valid, (None, the cerberus errors) otherwise"""
+        if self.fast:
+            coerced = self.fast_valid(document)
+            if coerced is not None:
+                return coerced, None
+        v = self.validator()
+        if v.validate(document):
+            return v.document, None
+        return None, v.errors
+
 def dict_copy_union(dict1, *kargs):
     dict3 = dict1.copy()
     for dict_item in kargs:
@@ -89,9 +179,9 @@ type_float_coerce_dict = {'type': 'float', 'coerce': float}
 type_integer_dict = {'type': 'integer'}
 type_datetime_required_dict = dict_copy_union(type_datetime_dict, required_dict)
 type_integer_coerce_dict = dict_copy_union(type_integer_dict, {'coerce': int})
-type_integer_coerce_4_digits_dict = dict_copy_union(type_integer_coerce_dict, {'max': 9999}),
-type_integer_coerce_6_digits_dict = dict_copy_union(type_integer_coerce_dict, {'max': 999999}),
-type_integer_coerce_8_digits_dict = dict_copy_union(type_integer_coerce_dict, {'max': 99999999}),
+type_integer_coerce_4_digits_dict = dict_copy_union(type_integer_coerce_dict, {'max': 9999})
+type_integer_coerce_6_digits_dict = dict_copy_union(type_integer_coerce_dict, {'max': 999999})
+type_integer_coerce_8_digits_dict = dict_copy_union(type_integer_coerce_dict, {'max': 99999999})
 type_integer_coerce_required_dict = dict_copy_union(type_integer_coerce_dict, required_dict)
 type_string_maxlength_5_dict = dict_copy_union(type_string_dict, {'maxlength': 5})
 type_string_maxlength_20_dict = dict_copy_union(type_string_dict, {'maxlength': 20})
@@ -1470,6 +1560,15 @@ model_dict = {
     },
 }
 
+# schemas checked once at import, reused by every request
+validators = {path: CompiledValidator(item['schema']) for path, item in model_dict.items()}
+
+
+def validate(path, document):
+    """Return (the document with its values coerced, None) if document is valid for model_dict[path],
+    (None, the validation errors) otherwise"""
+    return validators[path].normalize(document)
+
 eq_type_dict = {1: 'air_bkr',
                 2: 'bushing',
                 3: 'capacitor',
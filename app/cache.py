@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Table version counters, ETags and the response cache of the API  """
+
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from functools import wraps
+from itertools import chain
+from flask import request, make_response, Response
+from sqlalchemy.event import listens_for
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, class_mapper, object_mapper
+from app import db
+
+
+class TableVersion(db.Model):
+    """Counter bumped in the transaction of every write to a table.
+
+    Kept in the database so all the worker processes see the same versions.
+    """
+    __tablename__ = 'table_version'
+
+    table_name = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+# connection of a session transaction -> names of the tables written through it, bumped at commit
+_changed_tables = weakref.WeakKeyDictionary()
+
+
+def bump_versions(connection, table_names):
+    """Increment the version of tables, within the current transaction of connection.
+
+    When connection belongs to a session transaction the tables are only recorded and
+    bumped once at commit, so the rows of table_version stay locked for the least time.
+    """
+    changed = _changed_tables.get(connection)
+    if changed is not None:
+        changed.update(table_names)
+    else:
+        _bump(connection, table_names)
+
+
+def _bump(connection, table_names):
+    table = TableVersion.__table__
+    # always updated in the same order, two writers can't wait for each other
+    table_names = sorted(set(table_names) - {table.name})
+    if not table_names:
+        return
+    updated = connection.execute(
+        table.update().where(table.c.table_name.in_(table_names)).values(version=table.c.version + 1)
+    ).rowcount
+    if updated == len(table_names):
+        return
+    existing = {row.table_name for row in connection.execute(
+        table.select().where(table.c.table_name.in_(table_names)))}
+    missing = [name for name in table_names if name not in existing]
+    if not missing:
+        return
+    if connection.dialect.name == 'sqlite':
+        # the update locked the whole database, nobody else can insert them meanwhile
+        connection.execute(table.insert(), [{'table_name': name, 'version': 1} for name in missing])
+        return
+    for name in missing:
+        # table missing from the migrations, another transaction may be inserting it too
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(table.insert().values(table_name=name, version=1))
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+            connection.execute(
+                table.update().where(table.c.table_name == name).values(version=table.c.version + 1))
+
+
+def get_versions(session, table_names):
+    """Return ((table name, version), ...) sorted by name, missing tables have version 0"""
+    table = TableVersion.__table__
+    versions = dict.fromkeys(table_names, 0)
+    versions.update(session.execute(
+        table.select().where(table.c.table_name.in_(list(versions)))
+    ).fetchall())
+    return tuple(sorted(versions.items()))
+
+
+@listens_for(Session, 'after_begin')
+def record_changed_tables(session, transaction, connection):
+    _changed_tables[connection] = session.info.setdefault('changed_tables', set())
+    session.info.setdefault('changed_tables_connections', set()).add(connection)
+
+
+@listens_for(Session, 'after_flush')
+def bump_flushed_tables(session, flush_context):
+    tables = {
+        table.name for obj in chain(session.new, session.dirty, session.deleted)
+        for table in object_mapper(obj).tables
+    }
+    bump_versions(session.connection(), tables)
+
+
+@listens_for(Session, 'after_bulk_update')
+@listens_for(Session, 'after_bulk_delete')
+def bump_bulk_tables(session, query, query_context, result):
+    mapper = class_mapper(query.column_descriptions[0]['type'])
+    bump_versions(session.connection(), [table.name for table in mapper.tables])
+
+
+@listens_for(Session, 'before_commit')
+def bump_changed_tables(session):
+    # a savepoint leaves them to the commit of its transaction
+    if session.transaction.nested:
+        return
+    # the flush of commit() comes after this event, its tables must be recorded first
+    session.flush()
+    tables = session.info.get('changed_tables')
+    if tables:
+        _bump(session.connection(), tables)
+        tables.clear()
+
+
+@listens_for(Session, 'after_transaction_end')
+def forget_changed_tables(session, transaction):
+    # only the end of the outermost transaction leaves session.transaction empty
+    if session.transaction is not None:
+        return
+    session.info.pop('changed_tables', None)
+    for connection in session.info.pop('changed_tables_connections', ()):
+        _changed_tables.pop(connection, None)
+
+
+def dependent_tables(*models):
+    """Return the names of the tables read to serialize models.
+
+    Follows serialize_graph and the models returned by the optional dependent_models() classmethod.
+    """
+    tables = set()
+    seen = set()
+    for model in models:
+        _collect_tables(model, tables, seen)
+    return tables
+
+
+def _collect_tables(model, tables, seen):
+    if model in seen:
+        return
+    seen.add(model)
+    tables.update(table.name for table in class_mapper(model).tables)
+    related = []
+    for path in getattr(model, 'serialize_graph', ()):
+        target = model
+        for name in path.split('.'):
+            prop = class_mapper(target).get_property(name)
+            if prop.secondary is not None:
+                tables.add(prop.secondary.name)
+            target = prop.mapper.class_
+            tables.update(table.name for table in class_mapper(target).tables)
+        related.append(target)
+    if hasattr(model, 'dependent_models'):
+        related.extend(model.dependent_models())
+    for target in related:
+        _collect_tables(target, tables, seen)
+
+
+class LRUCache(object):
+    """Size bounded mapping dropping the least recently used entries, safe to share between threads"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.size < 1:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+def conditional(session, get_models, cache=None, cacheable=None):
+    """Decorate a GET view with ETags built from the versions of the tables it reads.
+
+    get_models receives the view arguments and returns the serialized models.
+    A matching If-None-Match is answered with 304 before the view runs,
+    other responses are kept in cache (an LRUCache) under their ETag unless they are streamed.
+    cacheable, given the view arguments, tells if the response only depends on the URL and
+    the tables, requests it returns False for skip the ETag and the cache.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or (cacheable is not None and not cacheable(*args, **kwargs)):
+                return view(*args, **kwargs)
+
+            versions = get_versions(session, dependent_tables(*get_models(*args, **kwargs)))
+            etag = hashlib.sha1(repr((request.path, request.query_string, versions))).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            cached = cache and cache.get(etag)
+            if cached:
+                response = Response(cached[0], mimetype=cached[1])
+            else:
+                response = make_response(view(*args, **kwargs))
+                if cache and response.status_code == 200 and not response.is_streamed:
+                    cache.set(etag, (response.get_data(), response.mimetype))
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
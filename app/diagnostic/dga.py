@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Dissolved gas analysis of every DissolvedGasTest at once, on columnar NumPy arrays  """
+
+import numpy as np
+from sqlalchemy import select
+from app.diagnostic.models import DissolvedGasTest, TestResult, NormGas, dump_datetime
+
+# combustible gases summed in the TDCG
+COMBUSTIBLE_GASES = ('h2', 'ch4', 'c2h2', 'c2h4', 'c2h6', 'co')
+GASES = COMBUSTIBLE_GASES + ('co2',)
+
+# IEEE C57.104 condition 1 limits (ppm), used to decide when Doernenburg ratios are significant
+L1 = {'h2': 100., 'ch4': 120., 'c2h2': 1., 'c2h4': 50., 'c2h6': 65., 'co': 350.}
+
+ROGERS = ('Normal', 'Low energy partial discharge', 'High energy arcing',
+          'Low temperature thermal', 'Thermal < 700C', 'Thermal > 700C')
+DOERNENBURG = ('Not significant', 'Thermal decomposition', 'Partial discharge', 'Arcing')
+# T3 and T2 come before T1 which only bounds C2H4/C2H6
+IEC = ('PD', 'D1', 'D2', 'T3', 'T2', 'T1')
+DUVAL = ('PD', 'T1', 'T2', 'T3', 'D1', 'D2', 'DT')
+LEGEND = {
+    'rogers': ROGERS,
+    'doernenburg': DOERNENBURG,
+    'iec': IEC,
+    'duval': DUVAL,
+}
+
+
+def load_samples(session, equipment_ids=None, test_result_ids=None):
+    """Return the dissolved gas tests as a dict of columns, gases not detectable are 0 ppm"""
+    dga = DissolvedGasTest.__table__
+    result = TestResult.__table__
+    gas_columns = [dga.c[gas] for gas in GASES]
+    flag_columns = [dga.c[gas + '_flag'] for gas in GASES]
+    query = select(
+        [dga.c.id, dga.c.test_result_id, result.c.equipment_id, result.c.date_analyse] + gas_columns + flag_columns
+    ).select_from(dga.outerjoin(result, dga.c.test_result_id == result.c.id)).order_by(dga.c.id)
+    if equipment_ids:
+        query = query.where(result.c.equipment_id.in_(equipment_ids))
+    if test_result_ids:
+        query = query.where(dga.c.test_result_id.in_(test_result_ids))
+
+    rows = session.execute(query).fetchall()
+    count = len(GASES)
+    # None becomes nan in a float array
+    values = np.array([row[4:4 + count] for row in rows], dtype=float).reshape(len(rows), count)
+    flags = np.array([[bool(flag) for flag in row[4 + count:]] for row in rows], dtype=bool).reshape(len(rows), count)
+    values[flags] = 0.
+
+    samples = {
+        'id': [row[0] for row in rows],
+        'test_result_id': [row[1] for row in rows],
+        'equipment_id': [row[2] for row in rows],
+        'date_analyse': [dump_datetime(row[3]) for row in rows],
+    }
+    for index, gas in enumerate(GASES):
+        samples[gas] = values[:, index]
+    return samples
+
+
+def load_norm(session, name=None):
+    """Return (conditions, {gas: limits}) of the NormGas rows called name, the first name by default.
+
+    Row of condition c holds the highest ppm of condition c.
+    Raises ValueError for a name without rows.
+    """
+    if name is None:
+        name = session.query(NormGas.name).order_by(NormGas.name).limit(1).scalar()
+    rows = session.query(NormGas).filter(NormGas.name == name).order_by(NormGas.condition).all()
+    if not rows and name is not None:
+        names = [row.name for row in session.query(NormGas.name).distinct().order_by(NormGas.name)]
+        raise ValueError('Wrong norm: {}, one of: {} expected'.format(name, ', '.join(names)))
+    conditions = np.array([row.condition for row in rows], dtype=int)
+    limits = {
+        gas: np.array([getattr(row, gas) for row in rows], dtype=float)
+        for gas in COMBUSTIBLE_GASES + ('co2', 'tdcg')
+    }
+    return conditions, limits
+
+
+def ratio(numerator, denominator):
+    """numerator / denominator, inf over 0 ppm and nan for 0 / 0 or a missing gas"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return numerator / denominator
+
+
+def classify(conditions):
+    """Return the index of the first true condition for every sample, -1 where none is true"""
+    return np.select(conditions, np.arange(len(conditions)), default=-1)
+
+
+def tdcg(samples):
+    """Total dissolved combustible gas"""
+    return sum(np.nan_to_num(samples[gas]) for gas in COMBUSTIBLE_GASES)
+
+
+def rogers(samples):
+    """IEEE C57.104 Rogers ratios method, indexes of ROGERS"""
+    r2 = ratio(samples['c2h2'], samples['c2h4'])
+    r1 = ratio(samples['ch4'], samples['h2'])
+    r5 = ratio(samples['c2h4'], samples['c2h6'])
+    with np.errstate(invalid='ignore'):
+        return classify([
+            (r2 < 0.1) & (r1 > 0.1) & (r1 < 1.) & (r5 < 1.),
+            (r2 < 0.1) & (r1 < 0.1) & (r5 < 1.),
+            (r2 >= 0.1) & (r2 <= 3.) & (r1 >= 0.1) & (r1 <= 1.) & (r5 > 3.),
+            (r2 < 0.1) & (r1 >= 0.1) & (r1 <= 1.) & (r5 >= 1.) & (r5 <= 3.),
+            (r2 < 0.1) & (r1 > 1.) & (r5 >= 1.) & (r5 <= 3.),
+            (r2 < 0.1) & (r1 > 1.) & (r5 > 3.),
+        ])
+
+
+def doernenburg(samples):
+    """IEEE C57.104 Doernenburg ratios method, indexes of DOERNENBURG"""
+    h2, ch4, c2h2, c2h4, c2h6 = (np.nan_to_num(samples[gas]) for gas in ('h2', 'ch4', 'c2h2', 'c2h4', 'c2h6'))
+    r1 = ratio(ch4, h2)
+    r2 = ratio(c2h2, c2h4)
+    r3 = ratio(c2h2, ch4)
+    r4 = ratio(c2h6, c2h2)
+    # a key gas above twice L1 and another one above L1
+    key_gases = np.array([h2, ch4, c2h2, c2h4])
+    key_limits = np.array([[L1['h2']], [L1['ch4']], [L1['c2h2']], [L1['c2h4']]])
+    significant = ((key_gases > 2 * key_limits).any(axis=0) & ((key_gases > key_limits).sum(axis=0) >= 2))
+    with np.errstate(invalid='ignore'):
+        return classify([
+            ~significant,
+            (r1 > 1.) & (r2 < 0.75) & (r3 < 0.3) & (r4 > 0.4),
+            (r1 < 0.1) & (r3 < 0.3) & (r4 > 0.4),
+            (r1 > 0.1) & (r1 < 1.) & (r2 > 0.75) & (r3 > 0.3) & (r4 < 0.4),
+        ])
+
+
+def iec(samples):
+    """IEC 60599 basic gas ratios, indexes of IEC"""
+    r1 = ratio(samples['c2h2'], samples['c2h4'])
+    r2 = ratio(samples['ch4'], samples['h2'])
+    r3 = ratio(samples['c2h4'], samples['c2h6'])
+    with np.errstate(invalid='ignore'):
+        return classify([
+            (r2 < 0.1) & (r3 < 0.2),
+            (r1 > 1.) & (r2 >= 0.1) & (r2 <= 0.5) & (r3 > 1.),
+            (r1 >= 0.6) & (r1 <= 2.5) & (r2 >= 0.1) & (r2 <= 1.) & (r3 > 2.),
+            (r1 < 0.2) & (r2 > 1.) & (r3 > 4.),
+            (r1 < 0.1) & (r2 > 1.) & (r3 >= 1.) & (r3 <= 4.),
+            (r2 > 1.) & (r3 < 1.),
+        ])
+
+
+def duval(samples):
+    """Duval triangle 1 zones of the CH4, C2H4 and C2H2 percentages, indexes of DUVAL"""
+    ch4, c2h4, c2h2 = (np.nan_to_num(samples[gas]) for gas in ('ch4', 'c2h4', 'c2h2'))
+    total = ch4 + c2h4 + c2h2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ch4, c2h4, c2h2 = (100. * gas / total for gas in (ch4, c2h4, c2h2))
+        zones = classify([
+            ch4 >= 98.,
+            (c2h2 < 4.) & (c2h4 < 20.),
+            (c2h2 < 4.) & (c2h4 >= 20.) & (c2h4 < 50.),
+            (c2h2 < 15.) & (c2h4 >= 50.),
+            (c2h2 >= 13.) & (c2h4 < 23.),
+            (c2h2 >= 13.) & (c2h4 >= 23.) & ((c2h2 >= 29.) | (c2h4 < 40.)),
+            total > 0,
+        ])
+    return np.where(total > 0, zones, -1)
+
+
+def condition_levels(samples, norm):
+    """Return the NormGas condition of every sample: the worst condition among its gases and TDCG.
+
+    norm is returned by load_norm, a value above the highest limit gets the highest condition + 1,
+    limits of 0 or null are not checked, 0 when no limit is.
+    """
+    conditions, limits = norm
+    levels = np.zeros(len(samples['id']), dtype=int)
+    if not len(conditions):
+        return levels
+    values = dict(samples, tdcg=tdcg(samples))
+    above = np.append(conditions, conditions[-1] + 1)
+    for gas, gas_limits in limits.items():
+        used = np.nan_to_num(gas_limits) > 0
+        if not used.any():
+            continue
+        # limits of increasing conditions never decrease
+        thresholds = np.maximum.accumulate(gas_limits[used])
+        gas_conditions = np.append(conditions[used], above[-1])
+        detected = np.isfinite(values[gas])
+        gas_levels = gas_conditions[np.searchsorted(thresholds, np.where(detected, values[gas], 0.), side='left')]
+        levels = np.maximum(levels, np.where(detected, gas_levels, 0))
+    return levels
+
+
+def diagnose(samples, norm=None):
+    """Return the diagnosis columns of samples (see load_samples)"""
+    columns = {'tdcg': tdcg(samples)}
+    for name, method in (('rogers', rogers), ('doernenburg', doernenburg), ('iec', iec), ('duval', duval)):
+        columns[name] = method(samples)
+    columns['condition'] = condition_levels(samples, norm) if norm is not None else None
+    columns['ratios'] = {
+        'ch4_h2': ratio(samples['ch4'], samples['h2']),
+        'c2h2_c2h4': ratio(samples['c2h2'], samples['c2h4']),
+        'c2h4_c2h6': ratio(samples['c2h4'], samples['c2h6']),
+        'c2h2_ch4': ratio(samples['c2h2'], samples['ch4']),
+        'c2h6_c2h2': ratio(samples['c2h6'], samples['c2h2']),
+    }
+    return columns
+
+
+def float_list(values):
+    """List of the values, None for nan and inf which JSON can't represent"""
+    return np.where(np.isfinite(values), values, None).tolist()
+
+
+def label_list(codes, labels):
+    """List of the labels of codes, None for -1"""
+    return np.array((None,) + tuple(labels), dtype=object)[codes + 1].tolist()
+
+
+def serialize(samples, columns):
+    """Columnar JSON data: one list per field, all in the order of samples['id']"""
+    data = {name: samples[name] for name in ('id', 'test_result_id', 'equipment_id', 'date_analyse')}
+    data['tdcg'] = float_list(columns['tdcg'])
+    for name, labels in LEGEND.items():
+        data[name] = label_list(columns[name], labels)
+    data['condition'] = columns['condition'] if columns['condition'] is None else columns['condition'].tolist()
+    data['ratios'] = {name: float_list(values) for name, values in columns['ratios'].items()}
+    return data
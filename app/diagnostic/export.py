@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  CSV export of test results joined with the rows of their test tables, streamed from a server-side cursor  """
+
+import csv
+from cStringIO import StringIO
+from datetime import datetime
+from collections import defaultdict
+from sqlalchemy import select, and_, or_, distinct
+from app.diagnostic.models import TestResult, Equipment, TestType, get_test_models
+
+# rows fetched from the cursor and written to the response at a time
+EXPORT_CHUNK_SIZE = 1000
+# columns of the equipment and test type of a test result, after the test_result columns
+LABEL_COLUMNS = ('equipment_serial', 'equipment_name', 'test_type_name')
+
+
+def cell(value):
+    """CSV text of a value, empty for null"""
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def conditions(campaign_id=None, start=None, end=None, equipment_ids=None):
+    """Where clause of the exported test results, analysed in [start, end) when given"""
+    result = TestResult.__table__
+    clauses = []
+    if campaign_id is not None:
+        clauses.append(result.c.campaign_id == campaign_id)
+    if start is not None:
+        clauses.append(result.c.date_analyse >= start)
+    if end is not None:
+        clauses.append(result.c.date_analyse < end)
+    if equipment_ids:
+        clauses.append(result.c.equipment_id.in_(equipment_ids))
+    return and_(*clauses)
+
+
+def test_tables(session, where):
+    """Return [(test table, test type ids)] of the exported test results, by table name.
+
+    Test types without a table come last with a None table.
+    """
+    result = TestResult.__table__
+    test_models = get_test_models()
+    type_ids = defaultdict(list)
+    for row in session.execute(select([distinct(result.c.test_type_id)]).where(where)):
+        model = test_models.get(row[0])
+        type_ids[model.__table__ if model is not None else None].append(row[0])
+    tables = sorted((table for table in type_ids if table is not None), key=lambda table: table.name)
+    if None in type_ids:
+        tables.append(None)
+    return [(table, type_ids[table]) for table in tables]
+
+
+def test_columns(table):
+    """Exported columns of a test table, its link to the test result is implied"""
+    return [column for column in table.columns if column.key != 'test_result_id']
+
+
+def export_query(where, table, type_ids):
+    """Select of the exported test results of type_ids, with the rows of their test table when there is one"""
+    result = TestResult.__table__
+    equipment = Equipment.__table__
+    test_type = TestType.__table__
+    columns = list(result.columns) + [equipment.c.serial, equipment.c.name, test_type.c.name]
+    source = result.outerjoin(equipment, result.c.equipment_id == equipment.c.id) \
+        .outerjoin(test_type, result.c.test_type_id == test_type.c.id)
+    order = [result.c.id]
+    if table is not None:
+        columns += test_columns(table)
+        source = source.outerjoin(table, table.c.test_result_id == result.c.id)
+        order += list(table.primary_key)
+    known_ids = [type_id for type_id in type_ids if type_id is not None]
+    type_clauses = [result.c.test_type_id.in_(known_ids)] if known_ids else []
+    if None in type_ids:
+        type_clauses.append(result.c.test_type_id == None)
+    return select(columns).select_from(source).where(and_(where, or_(*type_clauses))).order_by(*order) \
+        .execution_options(stream_results=True)
+
+
+def export_csv(session, **filters):
+    """Yield the CSV text of the test results matching filters (see conditions), EXPORT_CHUNK_SIZE rows at a time.
+
+    A row per test row, or per test result without any, grouped by test table. The header
+    has the test_result columns, then the columns of every exported test table prefixed by its name,
+    a row fills the columns of its own table only.
+    """
+    where = conditions(**filters)
+    tables = test_tables(session, where)
+    header = [column.key for column in TestResult.__table__.columns] + list(LABEL_COLUMNS)
+    width = len(header)
+    offsets = {}
+    for table, type_ids in tables:
+        if table is not None:
+            offsets[table.name] = len(header)
+            header += ['{}.{}'.format(table.name, column.key) for column in test_columns(table)]
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield buffer.getvalue()
+
+    for table, type_ids in tables:
+        rows = session.execute(export_query(where, table, type_ids))
+        # the test columns of a row go after the blank columns of the tables before its own
+        blank_before = [''] * ((offsets[table.name] if table is not None else len(header)) - width)
+        chunk = rows.fetchmany(EXPORT_CHUNK_SIZE)
+        while chunk:
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            for row in chunk:
+                values = [cell(value) for value in row]
+                line = values[:width] + blank_before + values[width:]
+                writer.writerow(line + [''] * (len(header) - len(line)))
+            yield buffer.getvalue()
+            chunk = rows.fetchmany(EXPORT_CHUNK_SIZE)
+        rows.close()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Gas generation rates between successive dissolved gas tests of an equipment, kept in gas_generation_rate  """
+
+from itertools import chain
+from sqlalchemy import select, func, case, and_, type_coerce, DateTime, Float
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from app.cache import bump_versions
+from app.diagnostic.models import DissolvedGasTest, TestResult, Equipment, GasGenerationRate, IN_CHUNK_SIZE
+from app.diagnostic.dga import GASES, COMBUSTIBLE_GASES
+
+RATES = GASES + ('tdcg',)
+# first key of the advisory locks taken on equipment ids while their rates are recomputed
+RATES_LOCK = 0x67617372
+
+
+def samples_query(equipment_ids=None):
+    """Dated dissolved gas tests, each one with the values of the previous test of its equipment.
+
+    Gases flagged not detectable are 0 ppm.
+    """
+    dga = DissolvedGasTest.__table__
+    result = TestResult.__table__
+    window = {'partition_by': result.c.equipment_id, 'order_by': [result.c.date_analyse, dga.c.id]}
+    values = [type_coerce(case([(dga.c[gas + '_flag'] == True, 0.)], else_=dga.c[gas]), Float) for gas in GASES]
+    query = select(
+        [dga.c.id, result.c.equipment_id, result.c.date_analyse] +
+        [value.label(gas) for gas, value in zip(GASES, values)] +
+        [func.lag(dga.c.id).over(**window).label('previous_id'),
+         func.lag(result.c.date_analyse, type_=DateTime).over(**window).label('previous_date')] +
+        [func.lag(value, type_=Float).over(**window).label('previous_' + gas) for gas, value in zip(GASES, values)]
+    ).select_from(dga.join(result, dga.c.test_result_id == result.c.id)).where(and_(
+        result.c.equipment_id != None, result.c.date_analyse != None
+    ))
+    if equipment_ids is not None:
+        query = query.where(result.c.equipment_id.in_(equipment_ids))
+    return query
+
+
+def tdcg(values):
+    return sum(values[gas] or 0. for gas in COMBUSTIBLE_GASES)
+
+
+def rate_rows(samples, since=None):
+    """Return the gas_generation_rate rows of samples (see samples_query) analysed since the date since"""
+    rows = []
+    for sample in samples:
+        if sample.previous_id is None or (since is not None and sample.date_analyse < since):
+            continue
+        days = (sample.date_analyse - sample.previous_date).total_seconds() / 86400.
+        current = {gas: sample[gas] for gas in GASES}
+        previous = {gas: sample['previous_' + gas] for gas in GASES}
+        current['tdcg'], previous['tdcg'] = tdcg(current), tdcg(previous)
+        row = {
+            'dissolved_gas_test_id': sample.id,
+            'previous_test_id': sample.previous_id,
+            'equipment_id': sample.equipment_id,
+            'date_analyse': sample.date_analyse,
+            'days': days,
+        }
+        for name in RATES:
+            # samples of the same day have no rate
+            if days > 0 and current[name] is not None and previous[name] is not None:
+                row[name] = (current[name] - previous[name]) / days
+            else:
+                row[name] = None
+        rows.append(row)
+    return rows
+
+
+def chunks(ids):
+    ids = sorted(set(ids) - {None})
+    return [ids[start:start + IN_CHUNK_SIZE] for start in range(0, len(ids), IN_CHUNK_SIZE)]
+
+
+def lock_equipment(connection, equipment_ids=None):
+    """Wait for the other transactions recomputing rates of equipment (all of them by default) to end.
+
+    Advisory locks rather than row locks, the equipment rows are key share locked by the inserts of tests.
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    equipment = Equipment.__table__
+    for chunk in (chunks(equipment_ids) if equipment_ids is not None else [None]):
+        ids = select([equipment.c.id]).order_by(equipment.c.id)
+        if chunk is not None:
+            ids = ids.where(equipment.c.id.in_(chunk))
+        # locked in id order, two refreshes can't wait for each other
+        ids = ids.alias('ids')
+        connection.execute(select([func.pg_advisory_xact_lock(RATES_LOCK, ids.c.id)]).select_from(ids)).fetchall()
+
+
+def refresh_rates(connection, equipment_ids=None, since=None):
+    """Recompute the rates of equipment (all of them by default) for the tests analysed since the date since"""
+    table = GasGenerationRate.__table__
+    lock_equipment(connection, equipment_ids)
+    for chunk in (chunks(equipment_ids) if equipment_ids is not None else [None]):
+        delete = table.delete()
+        if chunk is not None:
+            delete = delete.where(table.c.equipment_id.in_(chunk))
+        if since is not None:
+            delete = delete.where(table.c.date_analyse >= since)
+        connection.execute(delete)
+        rows = rate_rows(connection.execute(samples_query(chunk)), since)
+        if rows:
+            connection.execute(table.insert(), rows)
+    bump_versions(connection, [table.name])
+
+
+def refresh_tests(connection, test_result_ids=(), dissolved_gas_test_ids=(), previous=()):
+    """Update the rates after changes to dissolved gas tests or to the equipment and date of test results.
+
+    Rates are recomputed from the earliest date of the test results, of the current rates of their tests
+    and of previous, the (equipment id, date) test results had before they moved, for the equipment of all
+    of them, so a test moved to another equipment or date leaves the old one too.
+    """
+    dga = DissolvedGasTest.__table__
+    result = TestResult.__table__
+    rate = GasGenerationRate.__table__
+    test_result_ids = chunks(test_result_ids)
+    dissolved_gas_test_ids = set(dissolved_gas_test_ids)
+    for chunk in test_result_ids:
+        dissolved_gas_test_ids.update(
+            row.id for row in connection.execute(select([dga.c.id]).where(dga.c.test_result_id.in_(chunk)))
+        )
+    queries = [
+        select([result.c.equipment_id, func.min(result.c.date_analyse)]).where(
+            result.c.id.in_(chunk)).group_by(result.c.equipment_id)
+        for chunk in test_result_ids
+    ] + [
+        select([rate.c.equipment_id, func.min(rate.c.date_analyse)]).where(
+            rate.c.dissolved_gas_test_id.in_(chunk)).group_by(rate.c.equipment_id)
+        for chunk in chunks(dissolved_gas_test_ids)
+    ]
+
+    equipment_ids = set()
+    dates = []
+    # the first test of an equipment has no rate, its old place is only known from previous
+    for equipment_id, date_analyse in chain(chain.from_iterable(connection.execute(query) for query in queries),
+                                            previous):
+        if equipment_id is not None and date_analyse is not None:
+            equipment_ids.add(equipment_id)
+            dates.append(date_analyse)
+    if equipment_ids:
+        refresh_rates(connection, equipment_ids, min(dates))
+
+
+@listens_for(Session, 'after_flush')
+def refresh_flushed_rates(session, flush_context):
+    test_result_ids = set()
+    dissolved_gas_test_ids = set()
+    # (equipment id, date) of the test results before they moved
+    previous = []
+    # equipment of deleted test results, recomputed over their whole history
+    equipment_ids = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, DissolvedGasTest):
+            test_result_ids.update(get_history(obj, 'test_result_id').sum())
+            dissolved_gas_test_ids.add(obj.id)
+        elif isinstance(obj, TestResult):
+            if obj in session.deleted:
+                equipment_ids.update(get_history(obj, 'equipment_id').sum())
+            else:
+                equipment = get_history(obj, 'equipment_id')
+                date_analyse = get_history(obj, 'date_analyse')
+                if equipment.has_changes() or date_analyse.has_changes():
+                    test_result_ids.add(obj.id)
+                    previous.append((equipment.deleted[0] if equipment.deleted else obj.equipment_id,
+                                     date_analyse.deleted[0] if date_analyse.deleted else obj.date_analyse))
+
+    connection = session.connection()
+    if set(equipment_ids) - {None}:
+        refresh_rates(connection, equipment_ids)
+    if test_result_ids or dissolved_gas_test_ids:
+        refresh_tests(connection, test_result_ids, dissolved_gas_test_ids, previous)
+
+
+def exceeding(session, gas, threshold):
+    """Return the latest rate of every equipment whose latest gas rate is above threshold, highest first"""
+    if gas not in RATES:
+        raise ValueError('Wrong gas: {}'.format(gas))
+    table = GasGenerationRate.__table__
+    # one row per equipment, the test with the highest id among the latest ones of the same date
+    position = func.row_number().over(
+        partition_by=table.c.equipment_id,
+        order_by=[table.c.date_analyse.desc(), table.c.dissolved_gas_test_id.desc()],
+    )
+    latest = select([table.c.dissolved_gas_test_id, position.label('position')]).alias('latest')
+    rate = getattr(GasGenerationRate, gas)
+    return session.query(GasGenerationRate).join(latest, and_(
+        GasGenerationRate.dissolved_gas_test_id == latest.c.dissolved_gas_test_id,
+        latest.c.position == 1,
+    )).filter(rate > threshold).order_by(rate.desc(), GasGenerationRate.equipment_id).all()
+
+
+def history(session, equipment_id):
+    """Return the rates of equipment by date"""
+    return session.query(GasGenerationRate).filter(GasGenerationRate.equipment_id == equipment_id).order_by(
+        GasGenerationRate.date_analyse, GasGenerationRate.dissolved_gas_test_id
+    ).all()
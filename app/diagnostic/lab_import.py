@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Import of lab result files into the test tables, chunk by chunk, resumable through ImportJob  """
+
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+from sqlalchemy import select, and_, Boolean, Integer, Float, Numeric
+from sqlalchemy.exc import SQLAlchemyError
+from app.api_utility import model_dict, validate
+from app.cache import bump_versions
+from app.diagnostic.models import Equipment, TestResult, DissolvedGasTest, ImportJob, IN_CHUNK_SIZE
+from app.diagnostic.readings import parse_time
+from app.diagnostic import gas_rates
+
+# lines validated, inserted and committed at a time
+IMPORT_CHUNK_SIZE = 1000
+# errors kept in ImportJob.errors, the rejected count goes on
+MAX_REPORTED_ERRORS = 1000
+# a row without test_result_id names its test result by equipment serial and analysis date
+LOOKUP_FIELDS = ('equipment_serial', 'date_analyse')
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y')
+FALSE_VALUES = ('0', 'false', 'f', 'no', 'n')
+MIMETYPES = ('text/csv', 'application/x-ndjson', 'application/ndjson')
+# model_dict paths of the tables holding the measurements of a test result
+IMPORT_PATHS = tuple(sorted(
+    path for path, item in model_dict.items()
+    if 'test_result_id' in item['model'].__table__.columns and path == item['model'].__tablename__ and
+    path not in ('test_recommendation', 'test_sampling_card')
+))
+
+
+def read_records(lines, mimetype):
+    """Yield (line, dict of values) of text/csv lines, with a header line, or of application/x-ndjson lines"""
+    if mimetype == 'text/csv':
+        rows = csv.reader(lines)
+        header = [name.strip() for name in next(rows, [])]
+        for line, row in enumerate(rows, 2):
+            if row:
+                yield line, dict(zip(header, row))
+    elif mimetype in ('application/x-ndjson', 'application/ndjson'):
+        for line, text in enumerate(lines, 1):
+            if not text.strip():
+                continue
+            try:
+                values = json.loads(text)
+            except ValueError:
+                values = None
+            # reported by prepare() with the other row errors
+            yield line, values if isinstance(values, dict) else None
+    else:
+        raise ValueError(wrong_mimetype(mimetype))
+
+
+def wrong_mimetype(mimetype):
+    """Return the error message of an unsupported content type, None for text/csv and application/x-ndjson"""
+    if mimetype not in MIMETYPES:
+        return 'Wrong content type: {}, text/csv or application/x-ndjson expected'.format(mimetype)
+
+
+def convert(column, value):
+    """Value of a column from its text in a CSV file, JSON values are kept"""
+    if not isinstance(value, basestring):
+        return value
+    value = value.strip()
+    if value == '':
+        return None
+    if isinstance(column.type, Boolean):
+        if value.lower() in TRUE_VALUES:
+            return True
+        if value.lower() in FALSE_VALUES:
+            return False
+        raise ValueError
+    if isinstance(column.type, Integer):
+        return int(value)
+    if isinstance(column.type, (Float, Numeric)):
+        return float(value)
+    return value
+
+
+def equipment_lookup(session):
+    """{serial: equipment id} of the whole fleet, built once per import"""
+    equipment = Equipment.__table__
+    return dict(session.execute(select([equipment.c.serial, equipment.c.id])).fetchall())
+
+
+def test_result_lookup(session, ids, keys):
+    """Return (existing ids among ids, {(equipment id, date_analyse): [test result ids]} of keys)"""
+    result = TestResult.__table__
+    ids = sorted(set(ids))
+    existing = set()
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        existing.update(row[0] for row in session.execute(
+            select([result.c.id]).where(result.c.id.in_(ids[start:start + IN_CHUNK_SIZE]))))
+    by_key = defaultdict(list)
+    equipment_ids = sorted(set(key[0] for key in keys))
+    dates = set(key[1] for key in keys)
+    for start in range(0, len(equipment_ids), IN_CHUNK_SIZE):
+        rows = session.execute(select([result.c.equipment_id, result.c.date_analyse, result.c.id]).where(and_(
+            result.c.equipment_id.in_(equipment_ids[start:start + IN_CHUNK_SIZE]),
+            result.c.date_analyse.in_(dates),
+        )).order_by(result.c.id))
+        for equipment_id, date_analyse, test_result_id in rows:
+            by_key[(equipment_id, date_analyse)].append(test_result_id)
+    return existing, by_key
+
+
+def prepare(session, path, records, serials):
+    """Return (rows to insert, [{'line': line, 'errors': errors}]) of a chunk of records"""
+    table = model_dict[path]['model'].__table__
+    rows = []
+    errors = []
+    for line, values in records:
+        if values is None:
+            errors.append({'line': line, 'errors': 'JSON object expected'})
+            continue
+        row_errors = {}
+        row = {}
+        for name, value in values.items():
+            if name in LOOKUP_FIELDS:
+                continue
+            if name not in table.columns or name == 'id':
+                row_errors[name] = 'unknown field'
+                continue
+            try:
+                value = convert(table.columns[name], value)
+            except (ValueError, TypeError, OverflowError):
+                row_errors[name] = 'wrong value: {}'.format(value)
+                continue
+            if value is not None:
+                row[name] = value
+        if 'test_result_id' not in row:
+            if values.get('equipment_serial') not in serials:
+                row_errors['equipment_serial'] = 'unknown serial: {}'.format(values.get('equipment_serial'))
+            try:
+                date_analyse = parse_time(values['date_analyse'])
+            except (KeyError, ValueError, TypeError, OverflowError, AttributeError):
+                row_errors['date_analyse'] = 'test_result_id or date_analyse expected'
+        if not row_errors:
+            if 'test_result_id' not in row:
+                row['test_result_id'] = (serials[values['equipment_serial']], date_analyse)
+            document, row_errors = validate(path, dict(row, test_result_id=0))
+            if document is not None:
+                # inserted with the values coerced by the schema
+                row = dict(document, test_result_id=row['test_result_id'])
+        if row_errors:
+            errors.append({'line': line, 'errors': row_errors})
+        else:
+            rows.append((line, row))
+
+    existing, by_key = test_result_lookup(
+        session,
+        [row['test_result_id'] for line, row in rows if not isinstance(row['test_result_id'], tuple)],
+        [row['test_result_id'] for line, row in rows if isinstance(row['test_result_id'], tuple)],
+    )
+    resolved = []
+    for line, row in rows:
+        key = row['test_result_id']
+        if isinstance(key, tuple):
+            if len(by_key.get(key, ())) != 1:
+                message = 'no test result' if key not in by_key else 'several test results'
+                errors.append({'line': line, 'errors': {'date_analyse': message}})
+                continue
+            row['test_result_id'] = by_key[key][0]
+        elif key not in existing:
+            errors.append({'line': line, 'errors': {'test_result_id': 'unknown test result: {}'.format(key)}})
+            continue
+        resolved.append(row)
+    errors.sort(key=lambda error: error['line'])
+    return resolved, errors
+
+
+def insert(connection, model, rows):
+    """executemany INSERT of rows, one statement per set of keys so missing values keep their defaults"""
+    table = model.__table__
+    groups = defaultdict(list)
+    for row in rows:
+        groups[tuple(sorted(row))].append(row)
+    for group in groups.values():
+        connection.execute(table.insert(), group)
+    bump_versions(connection, [table.name])
+    # core inserts don't go through the flush events
+    if model is DissolvedGasTest:
+        gas_rates.refresh_tests(connection, [row['test_result_id'] for row in rows])
+
+
+def run(session, job, lines, mimetype):
+    """Import the lines of a file into the table of job, return job.
+
+    Every IMPORT_CHUNK_SIZE lines are committed with the progress of job, lines up to job.line
+    are skipped so the same file can be sent again after a failure. Invalid rows are rejected
+    and reported in job.errors, a database error stops the import with status failed.
+    """
+    model = model_dict[job.table_name]['model']
+    serials = equipment_lookup(session)
+    errors = json.loads(job.errors) if job.errors else []
+    message = wrong_mimetype(mimetype)
+    if message:
+        # a job resumed with a wrong file isn't left running
+        job.status = 'failed'
+        job.message = message
+        session.commit()
+        raise ValueError(message)
+    job.status = 'running'
+    job.message = None
+    session.commit()
+
+    records = read_records(lines, mimetype)
+    try:
+        chunk = list(islice(records, IMPORT_CHUNK_SIZE))
+        while chunk:
+            chunk = [(line, values) for line, values in chunk if line > job.line]
+            if chunk:
+                rows, chunk_errors = prepare(session, job.table_name, chunk, serials)
+                if rows:
+                    insert(session.connection(), model, rows)
+                errors.extend(chunk_errors[:MAX_REPORTED_ERRORS - len(errors)])
+                job.line = chunk[-1][0]
+                job.imported += len(rows)
+                job.rejected += len(chunk_errors)
+                job.errors = json.dumps(errors)
+                session.commit()
+            chunk = list(islice(records, IMPORT_CHUNK_SIZE))
+    except (SQLAlchemyError, csv.Error) as e:
+        session.rollback()
+        job.status = 'failed'
+        job.message = str(e)
+        session.commit()
+        return job
+    job.status = 'done'
+    session.commit()
+    return job
+
+
+def start(session, path, lines, mimetype, filename=None):
+    """Create the job of a new import and run it"""
+    if path not in IMPORT_PATHS:
+        raise ValueError('Can not import into: {}'.format(path))
+    message = wrong_mimetype(mimetype)
+    if message:
+        raise ValueError(message)
+    job = ImportJob(table_name=path, filename=filename)
+    session.add(job)
+    session.commit()
+    return run(session, job, lines, mimetype)
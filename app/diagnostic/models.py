@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
 import sqlalchemy as sqla
 from app import db
-from sqlalchemy.orm import relationship, relation
+from app.cache import get_versions
+from collections import defaultdict
+from flask import g, has_app_context
+from sqlalchemy.event import listens_for
+from sqlalchemy.ext.hybrid import hybrid_property, Comparator
+from sqlalchemy.orm import relationship, relation, joinedload, subqueryload, class_mapper, Session
 from sqlalchemy.sql.expression import cast
 from sqlalchemy import Enum
 
@@ -15,15 +21,121 @@ def dump_datetime(value):
     return [value.strftime("%Y-%m-%d"), value.strftime("%H:%M:%S")]
 
 
+# ids passed to a single IN (...) clause by load_grouped
+IN_CHUNK_SIZE = 500
+
+_classes_by_tablename = {}
+# (versions of TEST_MODELS_TABLES, {test_type_id: model storing the test rows}), None until first use
+_test_models = None
+TEST_MODELS_TABLES = ('test_type_result_table',)
+
+
 def get_class_by_tablename(tablename):
   """Return class reference mapped to table.
 
   :param tablename: String with name of table.
   :return: Class reference or None.
   """
-  for c in db.Model._decl_class_registry.values():
-    if hasattr(c, '__tablename__') and c.__tablename__ == tablename:
-      return c
+  if tablename not in _classes_by_tablename:
+    for c in db.Model._decl_class_registry.values():
+      if hasattr(c, '__tablename__'):
+        _classes_by_tablename[c.__tablename__] = c
+  return _classes_by_tablename.get(tablename)
+
+
+def get_test_models():
+    """Return {test_type_id: model storing the rows of the test type}.
+
+    The mapping is read from test_type_result_table and kept until that table changes,
+    in this process or another one: its version is checked once per request.
+    """
+    global _test_models
+    checked = has_app_context() and getattr(g, 'test_models_checked', False)
+    if _test_models is None or not checked:
+        versions = get_versions(db.session, TEST_MODELS_TABLES)
+        if _test_models is None or _test_models[0] != versions:
+            _test_models = (versions, {
+                row.test_type_id: get_class_by_tablename(row.test_result_table_name)
+                for row in db.session.query(TestTypeResultTable)
+            })
+        if has_app_context():
+            g.test_models_checked = True
+    return _test_models[1]
+
+
+def get_test_model(test_type_id):
+    return get_test_models().get(test_type_id)
+
+
+def reset_test_models(*args):
+    global _test_models
+    _test_models = None
+
+
+def load_grouped(model, key, ids):
+    """Return {key value: [rows]} for the rows of model whose key column is in ids.
+
+    One query per IN_CHUNK_SIZE ids, rows come with everything their serialize() reads.
+    """
+    column = getattr(model, key)
+    query = db.session.query(model).options(*eager_load_options(model)) \
+        .order_by(*class_mapper(model).primary_key)
+    ids = list(set(ids))
+    rows = defaultdict(list)
+    for start in range(0, len(ids), IN_CHUNK_SIZE):
+        for row in query.filter(column.in_(ids[start:start + IN_CHUNK_SIZE])):
+            rows[getattr(row, key)].append(row)
+    return rows
+
+
+def eager_load_options(model, graph=None, collections=True):
+    """Return query options loading everything model.serialize() touches.
+
+    Every model lists the relations its serialize() follows in ``serialize_graph``,
+    related models are expanded with their own graph. A dotted name such as
+    'campaign.created_by' loads the intermediate relation without expanding it.
+    Many-to-one relations are joined, collections are loaded with one extra query each.
+    Pass collections=False for queries using yield_per.
+    """
+    if graph is None:
+        graph = getattr(model, 'serialize_graph', ())
+    options = []
+    _add_eager_options(options, model, None, graph, collections, (model,))
+    return options
+
+
+def _add_eager_options(options, model, parent_option, graph, collections, seen):
+    for path in graph:
+        option, target = parent_option, model
+        for name in path.split('.'):
+            prop = class_mapper(target).get_property(name)
+            if prop.uselist and not collections:
+                break
+            if prop.uselist:
+                option = subqueryload(name) if option is None else option.subqueryload(name)
+            else:
+                option = joinedload(name) if option is None else option.joinedload(name)
+            target = prop.mapper.class_
+        else:
+            options.append(option)
+            if target not in seen:
+                _add_eager_options(options, target, option, getattr(target, 'serialize_graph', ()),
+                                   collections, seen + (target,))
+
+
+class AnyComparator(Comparator):
+    """Compare a column of the related rows, true when any of them matches.
+
+    Compiles to an EXISTS subquery on the relation, e.g. Campaign.equipment_id == 5
+    is "a test result of the campaign has equipment_id 5".
+    """
+
+    def __init__(self, relation, column):
+        super(AnyComparator, self).__init__(column)
+        self.relation = relation
+
+    def operate(self, op, *other, **kwargs):
+        return self.relation.any(op(self.expression, *other, **kwargs))
 
 
 class Lab(db.Model):
@@ -176,6 +288,8 @@ class Contract(db.Model):
     )
     contract_status = relationship(ContractStatus, backref="contract")
 
+    serialize_graph = ('contract_status',)
+
     def __repr__(self):
         return self.name
 
@@ -252,23 +366,37 @@ class Campaign(db.Model):
     # error_state = db.Column(db.Integer, server_default=db.text("0"), nullable=True)  # ErrorState: Need to look into
     # error_code = db.Column(db.Integer, server_default=db.text("0"), nullable=True)  # ErrorCode: Need to look into
 
-    # TODO equipment_id as a property (SQLAlchemy query filter doesn't use this property in comparison)
-    @property
+    equipments = db.relationship('Equipment', secondary='test_result', collection_class=set, viewonly=True)
+
+    @hybrid_property
     def equipment_id(self):
-        class MyList(object):
-            def __init__(self, *args):
-                self.my_list = args
+        return sorted(equipment.id for equipment in self.equipments)
 
-            def __eq__(self, other):
-                return other in self.my_list
+    @equipment_id.comparator
+    def equipment_id(cls):
+        return AnyComparator(cls.test_result, TestResult.equipment_id)
 
-        return MyList([x.equipment_id for x in db.session.query(TestResult).filter_by(campaign_id=id)])
+    serialize_graph = ('created_by', 'contract', 'status')
 
     def __repr__(self):
         return 'Campaign {0}, created at {1} by {2}'.format(self.id, self.date_created, self.created_by)
 
-    def serialize(self):
+    @classmethod
+    def dependent_models(cls):
+        return [TestResult]
+
+    @classmethod
+    def serialize_many(cls, campaigns):
+        """Serialize campaigns reading the test results of all of them at once"""
+        campaigns = list(campaigns)
+        test_results = load_grouped(TestResult, 'campaign_id', [campaign.id for campaign in campaigns])
+        children = TestResult.load_children([res for rows in test_results.values() for res in rows])
+        return [campaign.serialize(test_results.get(campaign.id, []), children) for campaign in campaigns]
+
+    def serialize(self, test_results=None, children=None):
         """Return object data in easily serializeable format"""
+        if test_results is None:
+            test_results = load_grouped(TestResult, 'campaign_id', [self.id]).get(self.id, [])
         return {
             'id': self.id,
             'date_created': dump_datetime(self.date_created),
@@ -293,7 +421,7 @@ class Campaign(db.Model):
             # 'error_code': self.error_code,
 
 
-            'test_result': [ res.serialize() for res in db.session.query(TestResult).filter_by(campaign_id=self.id)]
+            'test_result': TestResult.serialize_many(test_results, children)
         }
 
 
@@ -565,6 +693,50 @@ class GasSensor(db.Model):
                 }
 
 
+class GasSensorReading(db.Model):
+    """GasSensorReading. Readings of online gas sensors, appended by app.diagnostic.readings.
+
+    On PostgreSQL the rows are stored in one inherited table per month.
+    """
+    __tablename__ = u'gas_sensor_reading'
+
+    gas_sensor_id = db.Column(db.Integer, db.ForeignKey("gas_sensor.id", ondelete='CASCADE'), primary_key=True)
+    taken_at = db.Column(db.DateTime, primary_key=True)
+    cap_gaz = db.Column(db.Float(53))  # Sensor reading, as DissolvedGasTest.cap_gaz
+    h2 = db.Column(db.Float(53))  # ppm, for multi gas sensors
+    ch4 = db.Column(db.Float(53))
+    c2h2 = db.Column(db.Float(53))
+    c2h4 = db.Column(db.Float(53))
+    c2h6 = db.Column(db.Float(53))
+    co = db.Column(db.Float(53))
+    co2 = db.Column(db.Float(53))
+    o2 = db.Column(db.Float(53))
+    n2 = db.Column(db.Float(53))
+    water = db.Column(db.Float(53))  # ppm
+    oil_temperature = db.Column(db.Float(53))  # C
+
+    def __repr__(self):
+        return "{} {}".format(self.gas_sensor_id, self.taken_at)
+
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {'gas_sensor_id': self.gas_sensor_id,
+                'taken_at': dump_datetime(self.taken_at),
+                'cap_gaz': self.cap_gaz,
+                'h2': self.h2,
+                'ch4': self.ch4,
+                'c2h2': self.c2h2,
+                'c2h4': self.c2h4,
+                'c2h6': self.c2h6,
+                'co': self.co,
+                'co2': self.co2,
+                'o2': self.o2,
+                'n2': self.n2,
+                'water': self.water,
+                'oil_temperature': self.oil_temperature,
+                }
+
+
 class Transformer(db.Model):
     __tablename__ = u'transformer'
 
@@ -776,6 +948,12 @@ class Transformer(db.Model):
     ratiot_ag8 = db.Column(db.Float(53))  # RatioTag8. Tag use for TTR
     formula_ratio3 = db.Column(db.Float(53))  # RatioFormula3
 
+    serialize_graph = (
+        'fluid_type', 'fluid_level', 'gas_sensor', 'bushing_serial1', 'bushing_serial2', 'bushing_serial3',
+        'bushing_serial4', 'bushing_serial5', 'bushing_serial6', 'bushing_serial7', 'bushing_serial8',
+        'bushing_serial9', 'bushing_serial10', 'bushing_serial11', 'bushing_serial12'
+    )
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -911,6 +1089,8 @@ class Breaker(db.Model):
     # # welded_cover. Is cover welded. Important to planned work as it is much longer to remove cover
     # welded_cover = db.Column(db.Boolean)
 
+    serialize_graph = ('fluid_type', 'fluid_level', 'interrupting_medium', 'breaker_mechanism')
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -964,6 +1144,8 @@ class LoadTapChanger(db.Model):
     # # tap changer property property
     # ltc4 = db.Column(db.Float(53))  # LTC4
 
+    serialize_graph = ('fluid_type', 'fluid_level', 'interrupting_medium')
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -1038,6 +1220,8 @@ class Bushing(db.Model):
     # bushing_type_q = db.Column(db.String(25))  # Bushing type for Q
     # bushing_type_qn = db.Column(db.String(25))  # Bushing type for QN
 
+    serialize_graph = ('fluid_type',)
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -1071,6 +1255,8 @@ class EquipmentConnection(db.Model):
     parent_id = db.Column('parent_id', db.ForeignKey("equipment.id"))
     parent = db.relationship('Equipment', foreign_keys='EquipmentConnection.parent_id')
 
+    serialize_graph = ('equipment', 'parent')
+
     def serialize(self):
         """Return object data in easily serializeable format"""
         return {'id': self.id,
@@ -1341,6 +1527,8 @@ class Rectifier(db.Model):
     gas_sensor_id = db.Column('gas_sensor_id', db.ForeignKey("gas_sensor.id"), nullable=False)
     gas_sensor = relationship('GasSensor', foreign_keys='Rectifier.gas_sensor_id')
 
+    serialize_graph = ('fluid_type', 'fluid_level', 'gas_sensor')
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -1385,6 +1573,8 @@ class Inductance(db.Model):
     gas_sensor_id = db.Column('gas_sensor_id', db.ForeignKey("gas_sensor.id"), nullable=False)
     gas_sensor = relationship('GasSensor', foreign_keys='Inductance.gas_sensor_id')
 
+    serialize_graph = ('fluid_type', 'fluid_level', 'gas_sensor')
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -1425,6 +1615,8 @@ class Tank(db.Model):
     fluid_level_id = db.Column(db.Integer, db.ForeignKey("fluid_level.id"))
     fluid_level = db.relationship('FluidLevel', foreign_keys='Tank.fluid_level_id')
 
+    serialize_graph = ('fluid_type', 'fluid_level')
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -1459,6 +1651,8 @@ class Switch(db.Model):
     # # welded_cover. Is cover welded. Important to planned work as it is much longer to remove cover
     # welded_cover = db.Column(db.Boolean)
 
+    serialize_graph = ('interrupting_medium',)
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -1491,6 +1685,8 @@ class Cable(db.Model):
     # manufactured = db.Column(db.Integer())
     # description = db.Column(db.UnicodeText())  # description. Describe the equipment function
 
+    serialize_graph = ('insulation',)
+
     def __repr__(self):
         return "{} {} {}".format(self.__tablename__, self.name, self.serial)
 
@@ -1619,6 +1815,8 @@ class Equipment(db.Model):
     # id of a similar equipment
     sibling = db.Column(db.Integer)
 
+    serialize_graph = ('equipment_type', 'manufacturer', 'location', 'visual_inspection_by', 'assigned_to', 'norm')
+
     def __repr__(self):
         return "{} {} {}".format(self.name, self.serial, self.equipment_number)
 
@@ -1716,6 +1914,8 @@ class Recommendation(db.Model):
     test_type_id = db.Column(db.Integer, db.ForeignKey('test_type.id'))
     test_type = relationship('TestType', foreign_keys='Recommendation.test_type_id')
 
+    serialize_graph = ('test_type',)
+
     def __repr__(self):
         return self.name
 
@@ -1744,6 +1944,8 @@ class TestRecommendation(db.Model):
     test_result_id = db.Column(db.Integer, db.ForeignKey("test_result.id"))
     test_result = db.relationship('TestResult', backref='test_recommendation')
 
+    serialize_graph = ('recommendation', 'user')
+
     def __repr__(self):
         return "{} {} by {}".format(self.id, self.recommendation, self.user)
 
@@ -1825,6 +2027,8 @@ class Syringe(db.Model):
     lab_id = db.Column('lab_id', db.ForeignKey('lab.id'), nullable=True)
     lab = db.relationship('Lab', backref='syringe')
 
+    serialize_graph = ('lab',)
+
     def __repr__(self):
         return self.serial
 
@@ -1936,6 +2140,8 @@ class TestSchedule(db.Model):
 
     order = db.Column(db.Integer, primary_key=True, nullable=False)  # WorkOrderNum
 
+    serialize_graph = ('equipment', 'assigned_to', 'tests')
+
     def __repr__(self):
         return "{} {}".format(self.equipment, self.start_date)
 
@@ -1990,6 +2196,8 @@ class TestTypeResultTable(db.Model):
     # test_type = db.relationship('TestType', back_populates="test_type_result_table")
     test_result_table_name = db.Column(db.String(100), nullable=False)
 
+    serialize_graph = ('test_type',)
+
     def __repr__(self):
         return "{} - {}".format(self.test_type, self.test_result_table_name)
 
@@ -2002,11 +2210,28 @@ class TestTypeResultTable(db.Model):
                 }
 
 
+@listens_for(TestTypeResultTable, 'after_insert')
+@listens_for(TestTypeResultTable, 'after_update')
+@listens_for(TestTypeResultTable, 'after_delete')
+def test_type_result_table_changed(mapper, connection, target):
+    reset_test_models()
+
+
+@listens_for(Session, 'after_bulk_update')
+@listens_for(Session, 'after_bulk_delete')
+def test_type_result_table_bulk_changed(session, query, query_context, result):
+    if query.column_descriptions[0]['type'] is TestTypeResultTable:
+        reset_test_models()
+
+
 class TestResult(db.Model):
     """
     TestResults. Contains test results. It is a "tablepart" of campaign
     """
     __tablename__ = 'test_result'
+    __table_args__ = (
+        db.Index('ix_test_result_equipment_id_campaign_id', 'equipment_id', 'campaign_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     campaign_id = db.Column(db.Integer, db.ForeignKey("campaign.id"))
@@ -2118,23 +2343,60 @@ class TestResult(db.Model):
     qty_vial = db.Column(db.Integer)
     sampling_vial = db.Column(db.Integer)
 
+    # campaign.created_by is read by analysis_number
+    serialize_graph = (
+        'test_reason', 'test_type', 'sampling_point', 'test_status', 'equipment', 'fluid_profile',
+        'electrical_profile', 'material', 'fluid_type', 'performed_by', 'lab', 'lab_contract',
+        'campaign.created_by'
+    )
 
     def __repr__(self):
         return "{} - {}".format(self.campaign, self.test_type)
 
     @property
     def test_model(self):
-        result_table = db.session.query(TestTypeResultTable).filter_by(test_type_id=self.test_type_id).first()
-        if result_table:
-            return get_class_by_tablename(result_table.test_result_table_name)
+        return get_test_model(self.test_type_id)
 
     @property
     def analysis_number(self):
         if self.campaign:
             return "{}{}".format(self.id, self.campaign.created_by.initials)
 
-    def serialize(self):
+    @classmethod
+    def dependent_models(cls):
+        """Models read by serialize() besides the serialize_graph relations"""
+        test_models = {model for model in get_test_models().values() if model is not None}
+        return [TestTypeResultTable, TestSamplingCard, TestRecommendation] + list(test_models)
+
+    @classmethod
+    def load_children(cls, results):
+        """Return {id: (tests, sampling cards, recommendations)} with one query per child table"""
+        ids_by_model = defaultdict(list)
+        for res in results:
+            if res.test_model is not None:
+                ids_by_model[res.test_model].append(res.id)
+        tests = {}
+        for model, ids in ids_by_model.items():
+            tests.update(load_grouped(model, 'test_result_id', ids))
+        ids = [res.id for res in results]
+        cards = load_grouped(TestSamplingCard, 'test_result_id', ids)
+        recommendations = load_grouped(TestRecommendation, 'test_result_id', ids)
+        return {
+            res_id: (tests.get(res_id, []), cards.get(res_id, []), recommendations.get(res_id, []))
+            for res_id in ids
+        }
+
+    @classmethod
+    def serialize_many(cls, results, children=None):
+        """Serialize results loading their tests, sampling cards and recommendations in batches"""
+        results = list(results)
+        if children is None:
+            children = cls.load_children(results)
+        return [res.serialize(children[res.id]) for res in results]
+
+    def serialize(self, children=None):
         """Return object data in easily serializeable format"""
+        tests, cards, recommendations = children or self.load_children([self])[self.id]
         return {
             'id': self.id,
             'campaign_id': self.campaign_id,
@@ -2217,18 +2479,9 @@ class TestResult(db.Model):
             'antioxidant': self.antioxidant,
             'qty_vial': self.qty_vial,
             'sampling_vial': self.sampling_vial,
-            'tests': self.test_model and [
-                test.serialize() for test in db.session.query(self.test_model)
-                    .filter_by(test_result_id=self.id)
-            ],
-            'test_sampling_cards': [
-                card.serialize() for card in db.session.query(TestSamplingCard)
-                    .filter_by(test_result_id=self.id)
-            ],
-            'test_recommendations': [
-                item.serialize() for item in db.session.query(TestRecommendation)
-                    .filter_by(test_result_id=self.id)
-            ]
+            'tests': self.test_model and [test.serialize() for test in tests],
+            'test_sampling_cards': [card.serialize() for card in cards],
+            'test_recommendations': [item.serialize() for item in recommendations]
         }
 
 
@@ -2882,6 +3135,18 @@ class VisualInspectionTest(db.Model):
     grounding_connection = db.relationship('ConnectionCondition', foreign_keys='VisualInspectionTest.grounding_connection_id')
     misc_foundation = db.relationship('FoundationCondition', foreign_keys='VisualInspectionTest.misc_foundation_id')
 
+    serialize_graph = (
+        'tank_cover_gasket', 'tank_manhole_gasket', 'tank_gas_relay', 'tank_oil_level', 'tank_pressure_unit',
+        'tank_overpressure_valve', 'tank_ampling_valve', 'tank_oil_pump', 'tank_overall_condition',
+        'exp_tank_pipe_gasket', 'exp_tank_oil_level', 'exp_tank_paint', 'exp_tank_overall_condition',
+        'bushing_gasket', 'bushing_oil_level', 'bushing_overall_condition', 'tap_changer_gasket',
+        'tap_changer_oil_level', 'tap_changer_pressure_unit', 'tap_changer_overpressure_valve',
+        'tap_changer_ampling_valve', 'tap_changer_counter', 'tap_changer_filter',
+        'tap_changer_overall_condition', 'radiator_fan', 'radiator_gasket', 'radiator_overall_condition',
+        'control_cab_connection', 'control_cab_heating', 'control_cab_overall_condition',
+        'grounding_connection', 'misc_foundation'
+    )
+
     def __repr__(self):
         return "{} {}".format(self.id, self.test_result)
 
@@ -3246,6 +3511,53 @@ class DissolvedGasTest(db.Model):
                 }
 
 
+class GasGenerationRate(db.Model):
+    """Gas generation rates (ppm/day) of a DissolvedGasTest since the previous test of the same equipment.
+
+    Maintained by app.diagnostic.gas_rates, never written by the API.
+    """
+    __tablename__ = u'gas_generation_rate'
+    __table_args__ = (
+        db.Index('ix_gas_generation_rate_equipment_id_date_analyse', 'equipment_id', 'date_analyse'),
+    )
+
+    dissolved_gas_test_id = db.Column(db.Integer, db.ForeignKey("dissolved_gas_test.id", ondelete='CASCADE'),
+                                      primary_key=True)
+    previous_test_id = db.Column(db.Integer, db.ForeignKey("dissolved_gas_test.id", ondelete='CASCADE'))
+    equipment_id = db.Column(db.Integer, db.ForeignKey("equipment.id", ondelete='CASCADE'), nullable=False)
+    equipment = db.relationship('Equipment', foreign_keys='GasGenerationRate.equipment_id')
+    date_analyse = db.Column(db.DateTime, nullable=False)
+    days = db.Column(db.Float(53))  # days since the previous test
+    h2 = db.Column(db.Float(53))
+    ch4 = db.Column(db.Float(53))
+    c2h2 = db.Column(db.Float(53))
+    c2h4 = db.Column(db.Float(53))
+    c2h6 = db.Column(db.Float(53))
+    co = db.Column(db.Float(53))
+    co2 = db.Column(db.Float(53))
+    tdcg = db.Column(db.Float(53))
+
+    def __repr__(self):
+        return "{} {}".format(self.dissolved_gas_test_id, self.equipment_id)
+
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {'dissolved_gas_test_id': self.dissolved_gas_test_id,
+                'previous_test_id': self.previous_test_id,
+                'equipment_id': self.equipment_id,
+                'date_analyse': dump_datetime(self.date_analyse),
+                'days': self.days,
+                'h2': self.h2,
+                'ch4': self.ch4,
+                'c2h2': self.c2h2,
+                'c2h4': self.c2h4,
+                'c2h6': self.c2h6,
+                'co': self.co,
+                'co2': self.co2,
+                'tdcg': self.tdcg,
+                }
+
+
 class WaterTest(db.Model):
     """Water. Dissolved and free water content in oil test results"""
     __tablename__ = u'water_test'
@@ -3322,6 +3634,8 @@ class InhibitorTest(db.Model):
     remark = db.Column(db.String(80))
     inhibitor_flag = db.Column(db.Boolean)
 
+    serialize_graph = ('inhibitor_type',)
+
     def __repr__(self):
         return "{} {}".format(self.id, self.test_result)
 
@@ -3682,6 +3996,8 @@ class NormParticles(db.Model):
     iso4406_2 = db.Column(db.Float(53))  # ISO4406_2
     iso4406_3 = db.Column(db.Float(53))  # ISO4406_3
 
+    serialize_graph = ('equipment',)
+
     def __repr__(self):
         return self.id
 
@@ -3752,6 +4068,72 @@ class NormFuran(db.Model):
                 }
 
 
+class NormFlag(db.Model):
+    """A test measurement out of the range of its norm, written by app.diagnostic.norms"""
+    __tablename__ = 'norm_flag'
+
+    test_table = db.Column(db.String(50), primary_key=True)  # fluid_test, furan_test ...
+    test_id = db.Column(db.Integer, primary_key=True)
+    field = db.Column(db.String(50), primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey("campaign.id", ondelete='CASCADE'), index=True)
+    test_result_id = db.Column(db.Integer, db.ForeignKey("test_result.id", ondelete='CASCADE'))
+    value = db.Column(db.Float(53))
+    low = db.Column(db.Float(53))  # lowest allowed value, null if none
+    high = db.Column(db.Float(53))  # highest allowed value, null if none
+    condition = db.Column(db.Integer)  # condition level of the norms defining several
+
+    def __repr__(self):
+        return "{} {} {}".format(self.test_table, self.test_id, self.field)
+
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {'test_table': self.test_table,
+                'test_id': self.test_id,
+                'field': self.field,
+                'campaign_id': self.campaign_id,
+                'test_result_id': self.test_result_id,
+                'value': self.value,
+                'low': self.low,
+                'high': self.high,
+                'condition': self.condition,
+                }
+
+
+class ImportJob(db.Model):
+    """Import of a file of lab results by app.diagnostic.lab_import, resumed from line after a failure"""
+    __tablename__ = 'import_job'
+
+    id = db.Column(db.Integer(), primary_key=True, nullable=False)
+    table_name = db.Column(db.String(100), nullable=False)  # model_dict path of the imported test table
+    filename = db.Column(db.String(255))
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, failed, done
+    line = db.Column(db.Integer, nullable=False, default=0)  # last line of the file committed
+    imported = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text)  # JSON list of the errors of the rejected rows
+    message = db.Column(db.Text)  # why the import failed
+    created = db.Column(db.DateTime, default=sqla.func.now())
+    updated = db.Column(db.DateTime, default=sqla.func.now(), onupdate=sqla.func.now())
+
+    def __repr__(self):
+        return "{} {}".format(self.table_name, self.filename)
+
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {'id': self.id,
+                'table_name': self.table_name,
+                'filename': self.filename,
+                'status': self.status,
+                'line': self.line,
+                'imported': self.imported,
+                'rejected': self.rejected,
+                'errors': json.loads(self.errors) if self.errors else [],
+                'message': self.message,
+                'created': dump_datetime(self.created),
+                'updated': dump_datetime(self.updated),
+                }
+
+
 class TestSamplingCard(db.Model):
 
     __tablename__ = 'test_sampling_card'
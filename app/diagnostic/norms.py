@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Batch evaluation of the fluid, furan and insulation tests of a campaign against their norms  """
+
+import numpy as np
+from itertools import groupby
+from sqlalchemy import select
+from app.cache import LRUCache, get_versions, bump_versions
+from app.diagnostic.models import FluidTest, WaterTest, FuranTest, InsulationResistanceTest, TestResult
+from app.diagnostic.models import NormPhysic, NormFuran, NormIsolation, NormFlag
+
+# (test model, test column, NormPhysic column prefix), a test is checked against the NormPhysic row of its equipment
+PHYSIC_RULES = (
+    (FluidTest, 'acidity', 'acid'),
+    (FluidTest, 'ift', 'ift'),
+    (FluidTest, 'dielectric_1816', 'd1816'),
+    (FluidTest, 'dielectric_1816_2', 'd1816_2'),
+    (FluidTest, 'dielectric_877', 'd877'),
+    (FluidTest, 'dielectric_iec_156', 'cei156'),
+    (FluidTest, 'color', 'color'),
+    (FluidTest, 'density', 'density'),
+    (FluidTest, 'pf20c', 'pf20'),
+    (FluidTest, 'pf100c', 'p100'),
+    (FluidTest, 'flash_point', 'flashpoint'),
+    (FluidTest, 'pour_point', 'pourpoint'),
+    (FluidTest, 'viscosity', 'viscosity'),
+    (WaterTest, 'water', 'water'),
+)
+# furfural content, against the c1 < c2 < c3 < c4 condition limits of NormFuran
+FURAN_FIELDS = ('fal',)
+# megohms, against the NormIsolation minimum at the temperature of the test result
+INSULATION_FIELDS = ('resistance1', 'resistance2', 'resistance3', 'resistance4', 'resistance5')
+
+NORM_TABLES = ('norm_physic', 'norm_furan', 'norm_isolation')
+# evaluations are reused while the versions of these tables don't change
+EVALUATED_TABLES = NORM_TABLES + ('test_result', 'fluid_test', 'water_test', 'furan_test', 'insulation_resistance_test')
+
+# (versions of NORM_TABLES, compiled norms)
+_compiled = None
+# (campaign id, versions of EVALUATED_TABLES) -> flags
+_evaluations = LRUCache(100)
+
+
+def limit_values(rows, column):
+    """Values of column in rows as floats, nan where the column is null or holds its 0 server default"""
+    unset = 0. if column.server_default is not None else None
+    return [np.nan if getattr(row, column.key) in (None, unset) else getattr(row, column.key) for row in rows]
+
+
+class RangeNorm(object):
+    """NormPhysic rows compiled to one min and one max matrix, a row per equipment and a column per field"""
+
+    def __init__(self, rows, prefixes):
+        # the last row of an equipment wins
+        by_equipment = dict((row.equipment_id, row) for row in sorted(rows, key=lambda row: row.id))
+        self.equipment_ids = np.array(sorted(by_equipment), dtype=int)
+        rows = [by_equipment[equipment_id] for equipment_id in self.equipment_ids]
+        table = NormPhysic.__table__
+        self.low = np.array([limit_values(rows, table.c[prefix + '_min']) for prefix in prefixes], dtype=float).T
+        self.high = np.array([limit_values(rows, table.c[prefix + '_max']) for prefix in prefixes], dtype=float).T
+
+    def limits(self, equipment_ids):
+        """Return the (low, high) matrices of equipment_ids, nan for equipment without norm"""
+        count = len(self.equipment_ids)
+        if not count:
+            unset = np.full((len(equipment_ids), self.low.shape[1]), np.nan)
+            return unset, unset
+        index = np.minimum(np.searchsorted(self.equipment_ids, equipment_ids), count - 1)
+        found = (self.equipment_ids[index] == equipment_ids)[:, None]
+        return np.where(found, self.low[index], np.nan), np.where(found, self.high[index], np.nan)
+
+
+class ConditionNorm(object):
+    """NormFuran row compiled to increasing condition limits, condition 1 up to c1, 5 above c4"""
+
+    def __init__(self, row):
+        table = NormFuran.__table__
+        limits = [limit_values([row], table.c[name])[0] for name in ('c1', 'c2', 'c3', 'c4')] if row else []
+        self.limits = np.maximum.accumulate(np.array([limit for limit in limits if not np.isnan(limit)], dtype=float))
+
+    def conditions(self, values):
+        """Condition of every value, 0 for missing values or without limits"""
+        if not len(self.limits):
+            return np.zeros(values.shape, dtype=int)
+        conditions = np.searchsorted(self.limits, np.nan_to_num(values), side='left') + 1
+        return np.where(np.isnan(values), 0, conditions)
+
+
+class CurveNorm(object):
+    """NormIsolation rows compiled to the minimum resistance curve by temperature (C)"""
+
+    def __init__(self, rows, column='notseal'):
+        points = sorted((row.c, getattr(row, column)) for row in rows
+                        if row.c is not None and getattr(row, column))
+        self.temperatures = np.array([point[0] for point in points], dtype=float)
+        self.minimums = np.array([point[1] for point in points], dtype=float)
+
+    def minimum(self, temperatures):
+        """Minimum at every temperature, interpolated and held flat outside the curve, nan without curve"""
+        if not len(self.temperatures):
+            return np.full(len(temperatures), np.nan)
+        return np.interp(temperatures, self.temperatures, self.minimums)
+
+
+def compile_norms(session):
+    """Return the norms compiled once per change of the norm tables"""
+    global _compiled
+    versions = get_versions(session, NORM_TABLES)
+    if _compiled is None or _compiled[0] != versions:
+        _compiled = (versions, {
+            'physic': RangeNorm(session.query(NormPhysic).all(), [prefix for model, field, prefix in PHYSIC_RULES]),
+            'furan': ConditionNorm(session.query(NormFuran).order_by(NormFuran.id).first()),
+            'isolation': CurveNorm(session.query(NormIsolation).all()),
+        })
+    return _compiled[1]
+
+
+def load_tests(session, model, fields, campaign_id):
+    """Return the tests of a campaign as columns, values holds a column of floats per field"""
+    test = model.__table__
+    result = TestResult.__table__
+    rows = session.execute(
+        select([test.c.id, test.c.test_result_id, result.c.equipment_id, result.c.temperature] +
+               [test.c[field] for field in fields])
+        .select_from(test.join(result, test.c.test_result_id == result.c.id))
+        .where(result.c.campaign_id == campaign_id)
+        .order_by(test.c.id)
+    ).fetchall()
+    return {
+        'id': [row[0] for row in rows],
+        'test_result_id': [row[1] for row in rows],
+        'equipment_id': np.array([-1 if row[2] is None else row[2] for row in rows], dtype=int),
+        'temperature': np.array([row[3] for row in rows], dtype=float),
+        'values': np.array([row[4:] for row in rows], dtype=float).reshape(len(rows), len(fields)),
+    }
+
+
+def flag_rows(model, fields, tests, out, low=None, high=None, conditions=None):
+    """Return a norm_flag row for every true cell of the out matrix"""
+    flags = []
+    for row, column in zip(*np.nonzero(out)):
+        flags.append({
+            'test_table': model.__tablename__,
+            'test_id': tests['id'][row],
+            'field': fields[column],
+            'test_result_id': tests['test_result_id'][row],
+            'value': float(tests['values'][row, column]),
+            'low': None if low is None or np.isnan(low[row, column]) else float(low[row, column]),
+            'high': None if high is None or np.isnan(high[row, column]) else float(high[row, column]),
+            'condition': None if conditions is None else int(conditions[row, column]),
+        })
+    return flags
+
+
+def evaluate(session, campaign_id):
+    """Return the norm_flag rows of the tests of a campaign which are out of the range of their norm"""
+    norms = compile_norms(session)
+    flags = []
+
+    for model, rules in groupby(enumerate(PHYSIC_RULES), key=lambda item: item[1][0]):
+        columns, fields = zip(*[(index, rule[1]) for index, rule in rules])
+        tests = load_tests(session, model, fields, campaign_id)
+        low, high = norms['physic'].limits(tests['equipment_id'])
+        low, high = low[:, list(columns)], high[:, list(columns)]
+        with np.errstate(invalid='ignore'):
+            out = (tests['values'] < low) | (tests['values'] > high)
+        flags.extend(flag_rows(model, fields, tests, out, low, high))
+
+    tests = load_tests(session, FuranTest, FURAN_FIELDS, campaign_id)
+    conditions = norms['furan'].conditions(tests['values'])
+    high = np.full(tests['values'].shape, norms['furan'].limits[0] if len(norms['furan'].limits) else np.nan)
+    flags.extend(flag_rows(FuranTest, FURAN_FIELDS, tests, conditions > 1, high=high, conditions=conditions))
+
+    tests = load_tests(session, InsulationResistanceTest, INSULATION_FIELDS, campaign_id)
+    low = np.repeat(norms['isolation'].minimum(tests['temperature'])[:, None], len(INSULATION_FIELDS), axis=1)
+    with np.errstate(invalid='ignore'):
+        out = tests['values'] < low
+    flags.extend(flag_rows(InsulationResistanceTest, INSULATION_FIELDS, tests, out, low=low))
+
+    for flag in flags:
+        flag['campaign_id'] = campaign_id
+    return flags
+
+
+def cached_evaluate(session, campaign_id):
+    """evaluate() reused until a norm or a test of the campaign changes"""
+    key = (campaign_id, get_versions(session, EVALUATED_TABLES))
+    flags = _evaluations.get(key)
+    if flags is None:
+        flags = evaluate(session, campaign_id)
+        _evaluations.set(key, flags)
+    return flags
+
+
+def flag_campaign(session, campaign_id):
+    """Replace the norm_flag rows of a campaign in one delete and one executemany insert, without committing"""
+    flags = cached_evaluate(session, campaign_id)
+    table = NormFlag.__table__
+    connection = session.connection()
+    connection.execute(table.delete().where(table.c.campaign_id == campaign_id))
+    if flags:
+        connection.execute(table.insert(), flags)
+    bump_versions(connection, [table.name])
+    return flags
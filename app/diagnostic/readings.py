@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Ingest, storage and downsampling of the readings of online gas sensors  """
+
+import csv
+import json
+import math
+from calendar import timegm
+from datetime import datetime, timedelta
+from itertools import groupby
+from dateutil import parser as date_parser, tz
+from sqlalchemy import select, func, and_, extract, cast, literal_column, Integer
+from sqlalchemy.sql import table as table_clause, column
+from app.cache import bump_versions
+from app.diagnostic.models import GasSensorReading
+
+READING_FIELDS = ('cap_gaz', 'h2', 'ch4', 'c2h2', 'c2h4', 'c2h6', 'co', 'co2', 'o2', 'n2', 'water', 'oil_temperature')
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M')
+# rows per executemany INSERT
+INSERT_CHUNK_SIZE = 1000
+# buckets returned by a range query without an explicit bucket width
+DEFAULT_POINTS = 1000
+# raw readings a range query may return, wider ranges need buckets
+MAX_RAW_POINTS = 10000
+DEFAULT_RANGE = timedelta(days=1)
+
+
+def parse_time(value):
+    """Naive UTC datetime of epoch seconds or of an ISO 8601 string, UTC unless it has an offset"""
+    if isinstance(value, (int, long, float)):
+        return datetime.utcfromtimestamp(value)
+    value = value.strip()
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except ValueError:
+        pass
+    parsed = date_parser.parse(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return parsed
+
+
+def to_epoch(value):
+    return timegm(value.timetuple())
+
+
+def parse_reading(values, line):
+    """Return the reading of a dict of field values read at line"""
+    try:
+        reading = {'taken_at': parse_time(values['taken_at'])}
+    except KeyError:
+        raise ValueError('Line {}: taken_at is missing'.format(line))
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError('Line {}: wrong taken_at: {}'.format(line, values['taken_at']))
+    for field in READING_FIELDS:
+        value = values.get(field)
+        try:
+            reading[field] = None if value in (None, '') else float(value)
+        except (ValueError, TypeError):
+            raise ValueError('Line {}: wrong {}: {}'.format(line, field, value))
+    unknown = set(values) - set(READING_FIELDS) - {'taken_at'}
+    if unknown:
+        raise ValueError('Line {}: unknown fields: {}'.format(line, ', '.join(sorted(unknown))))
+    return reading
+
+
+def read_csv(lines):
+    """Readings of CSV lines, the first one names the fields"""
+    rows = csv.reader(lines)
+    header = [name.strip() for name in next(rows, [])]
+    for line, row in enumerate(rows, 2):
+        if row:
+            yield parse_reading(dict(zip(header, row)), line)
+
+
+def read_ndjson(lines):
+    """Readings of newline delimited JSON objects"""
+    for line, text in enumerate(lines, 1):
+        if not text.strip():
+            continue
+        try:
+            values = json.loads(text)
+        except ValueError:
+            raise ValueError('Line {}: wrong JSON'.format(line))
+        if not isinstance(values, dict):
+            raise ValueError('Line {}: an object is expected'.format(line))
+        yield parse_reading(values, line)
+
+
+def read_readings(lines, mimetype):
+    """Return the readings of a text/csv or application/x-ndjson body"""
+    if mimetype == 'text/csv':
+        return list(read_csv(lines))
+    if mimetype in ('application/x-ndjson', 'application/ndjson'):
+        return list(read_ndjson(lines))
+    raise ValueError('Wrong content type: {}, text/csv or application/x-ndjson expected'.format(mimetype))
+
+
+def partition(connection, year, month):
+    """Return the table of the readings of a month, created with its constraints when missing"""
+    name = '{}_y{:04d}m{:02d}'.format(GasSensorReading.__tablename__, year, month)
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    # the CHECK constraint lets the planner skip the other months of a range query
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS {name} (
+          PRIMARY KEY (gas_sensor_id, taken_at),
+          FOREIGN KEY (gas_sensor_id) REFERENCES gas_sensor (id) ON DELETE CASCADE,
+          CHECK (taken_at >= '{start}' AND taken_at < '{end}')
+        ) INHERITS ({parent})
+    """.format(name=name, start=start, end=end, parent=GasSensorReading.__tablename__))
+    return table_clause(name, *[column(key) for key in GasSensorReading.__table__.columns.keys()])
+
+
+def ingest(connection, gas_sensor_id, readings):
+    """Store readings of a sensor without committing, return how many were stored.
+
+    Stored readings of the sensor over the time span of readings are replaced,
+    on PostgreSQL every month goes straight to its own partition.
+    """
+    table = GasSensorReading.__table__
+    # the last reading of a time wins
+    readings = sorted(dict((reading['taken_at'], reading) for reading in readings).values(),
+                      key=lambda reading: reading['taken_at'])
+    if not readings:
+        return 0
+
+    connection.execute(table.delete().where(and_(
+        table.c.gas_sensor_id == gas_sensor_id,
+        table.c.taken_at >= readings[0]['taken_at'],
+        table.c.taken_at <= readings[-1]['taken_at'],
+    )))
+    partitioned = connection.dialect.name == 'postgresql'
+    for (year, month), rows in groupby(readings, key=lambda reading: (reading['taken_at'].year,
+                                                                       reading['taken_at'].month)):
+        target = partition(connection, year, month) if partitioned else table
+        rows = [dict(row, gas_sensor_id=gas_sensor_id) for row in rows]
+        # one compiled statement run as executemany, a multi-row VALUES is compiled again for every chunk
+        insert = target.insert()
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+            connection.execute(insert, rows[start:start + INSERT_CHUNK_SIZE])
+    bump_versions(connection, [table.name])
+    return len(readings)
+
+
+def epoch(expression, dialect_name):
+    """Seconds since 1970-01-01 of a naive UTC timestamp expression"""
+    if dialect_name == 'sqlite':
+        return cast(func.strftime('%s', expression), Integer)
+    return extract('epoch', expression)
+
+
+def range_args(args):
+    """Return (start, end, fields, bucket width in seconds or 0 for raw readings) of the query string"""
+    try:
+        end = parse_time(args['end']) if args.get('end') else datetime.utcnow()
+        start = parse_time(args['start']) if args.get('start') else end - DEFAULT_RANGE
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError('Wrong start or end')
+    if start >= end:
+        raise ValueError('start must be before end')
+
+    fields = [name.strip() for name in args.get('fields', '').split(',') if name.strip()] or list(READING_FIELDS)
+    for name in fields:
+        if name not in READING_FIELDS:
+            raise ValueError('Wrong field: {}'.format(name))
+
+    try:
+        if 'bucket' in args:
+            bucket = int(args['bucket'])
+        else:
+            points = int(args.get('points', DEFAULT_POINTS))
+            if points < 1:
+                raise ValueError
+            bucket = max(1, int(math.ceil((to_epoch(end) - to_epoch(start)) / float(points))))
+    except ValueError:
+        raise ValueError('Wrong bucket or points')
+    if bucket < 0:
+        raise ValueError('Wrong bucket or points')
+    return start, end, fields, bucket
+
+
+def raw_readings(session, gas_sensor_id, start, end, fields):
+    """Columnar readings of [start, end): t holds epoch seconds, a list per field"""
+    table = GasSensorReading.__table__
+    rows = session.execute(
+        select([table.c.taken_at] + [table.c[field] for field in fields])
+        .where(and_(table.c.gas_sensor_id == gas_sensor_id, table.c.taken_at >= start, table.c.taken_at < end))
+        .order_by(table.c.taken_at)
+        .limit(MAX_RAW_POINTS + 1)
+    ).fetchall()
+    if len(rows) > MAX_RAW_POINTS:
+        raise ValueError('More than {} readings, use a bucket'.format(MAX_RAW_POINTS))
+    data = {'t': [to_epoch(row[0]) for row in rows], 'bucket': 0}
+    for index, field in enumerate(fields, 1):
+        data[field] = [row[index] for row in rows]
+    return data
+
+
+def downsample(session, gas_sensor_id, start, end, fields, bucket):
+    """Columnar min, max and avg of the readings of [start, end) by buckets of bucket seconds.
+
+    Aggregated by the database, buckets start at start and t holds the epoch seconds starting each non empty one.
+    """
+    table = GasSensorReading.__table__
+    dialect_name = session.get_bind(GasSensorReading.__mapper__).dialect.name
+    # numbers are inlined so the grouped expression and the selected one are the same SQL
+    origin = to_epoch(start)
+    offset = epoch(table.c.taken_at, dialect_name) - literal_column(str(origin))
+    bucket_number = func.floor(offset / literal_column(str(int(bucket)))).label('bucket_number')
+    columns = [bucket_number, func.count().label('count')]
+    for field in fields:
+        columns += [func.min(table.c[field]), func.max(table.c[field]), func.avg(table.c[field])]
+    rows = session.execute(
+        select(columns)
+        .where(and_(table.c.gas_sensor_id == gas_sensor_id, table.c.taken_at >= start, table.c.taken_at < end))
+        .group_by(bucket_number)
+        .order_by(bucket_number)
+    ).fetchall()
+    data = {
+        't': [origin + int(row[0]) * bucket for row in rows],
+        'count': [row[1] for row in rows],
+        'bucket': bucket,
+    }
+    for index, field in enumerate(fields):
+        offset = 2 + 3 * index
+        data[field] = {
+            'min': [row[offset] for row in rows],
+            'max': [row[offset + 1] for row in rows],
+            'avg': [row[offset + 2] and float(row[offset + 2]) for row in rows],
+        }
+    return data
+
+
+def query_readings(session, gas_sensor_id, args):
+    """Raw or downsampled columnar readings of a sensor for the query string args (see range_args)"""
+    start, end, fields, bucket = range_args(args)
+    if not bucket:
+        return raw_readings(session, gas_sensor_id, start, end, fields)
+    return downsample(session, gas_sensor_id, start, end, fields, bucket)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Tests of the dissolved gas analysis rules, of the gas generation rates and of the norm flags  """
+
+import datetime
+import json
+import unittest
+import numpy as np
+from app.api import api, db
+from app.diagnostic import dga, gas_rates, norms
+from app.diagnostic.models import TestResult, DissolvedGasTest, Campaign, FluidTest, FuranTest, InsulationResistanceTest
+from app.diagnostic.models import NormPhysic, NormFuran, NormIsolation
+from app.tests import API, ApiTestCase, DGA_TYPE_ID
+
+NAN = float('nan')
+
+
+def make_samples(*rows):
+    """Samples as load_samples returns them, rows are dicts of gas: ppm, missing gases are 0 ppm"""
+    samples = {
+        'id': list(range(1, len(rows) + 1)),
+        'test_result_id': list(range(1, len(rows) + 1)),
+        'equipment_id': [1] * len(rows),
+        'date_analyse': [None] * len(rows),
+    }
+    for gas in dga.GASES:
+        samples[gas] = np.array([row.get(gas, 0.) for row in rows], dtype=float)
+    return samples
+
+
+def make_norm(conditions, **limits):
+    """Norm as load_norm returns it, gases without limits are not checked"""
+    gas_limits = {gas: np.zeros(len(conditions)) for gas in dga.COMBUSTIBLE_GASES + ('co2', 'tdcg')}
+    gas_limits.update((gas, np.array(values, dtype=float)) for gas, values in limits.items())
+    return np.array(conditions, dtype=int), gas_limits
+
+
+# thermal fault above 700C in Rogers and IEC
+THERMAL = {'h2': 100., 'ch4': 200., 'c2h2': 1., 'c2h4': 400., 'c2h6': 50.}
+
+
+class RatioMethodsTest(unittest.TestCase):
+
+    def test_rogers(self):
+        samples = make_samples(
+            {'h2': 100., 'ch4': 50., 'c2h4': 10., 'c2h6': 20.},
+            THERMAL,
+            {'h2': 100., 'ch4': 50., 'c2h2': 100., 'c2h4': 100., 'c2h6': 10.},
+            {'h2': NAN, 'ch4': 50., 'c2h4': 10., 'c2h6': 20.},
+        )
+        self.assertEqual(dga.rogers(samples).tolist(), [0, 5, 2, -1])
+
+    def test_doernenburg_needs_significant_gases(self):
+        samples = make_samples(
+            {'h2': 10., 'ch4': 50., 'c2h2': 1., 'c2h4': 10., 'c2h6': 20.},
+            {'h2': 500., 'ch4': 200., 'c2h2': 100., 'c2h4': 100., 'c2h6': 10.},
+            {'h2': 200., 'ch4': 400., 'c2h2': 2., 'c2h4': 300., 'c2h6': 100.},
+        )
+        self.assertEqual(dga.doernenburg(samples).tolist(), [0, 3, 1])
+
+    def test_iec(self):
+        samples = make_samples(
+            {'h2': 1000., 'ch4': 50., 'c2h4': 1., 'c2h6': 10.},
+            THERMAL,
+            dict(THERMAL, c2h6=200.),
+        )
+        self.assertEqual([dga.IEC[code] for code in dga.iec(samples)], ['PD', 'T3', 'T2'])
+
+    def test_duval(self):
+        samples = make_samples(
+            {'ch4': 100.},
+            {'ch4': 100., 'c2h4': 900.},
+            {'ch4': 40., 'c2h2': 50., 'c2h4': 10.},
+            {},
+        )
+        self.assertEqual(dga.duval(samples).tolist(), [0, 3, 4, -1])
+
+
+class ConditionLevelsTest(unittest.TestCase):
+
+    def test_worst_condition_of_the_limits(self):
+        samples = make_samples(*[{'h2': value} for value in (50., 100., 101., 5000., NAN)])
+        norm = make_norm([1, 2, 3], h2=[100., 700., 1800.])
+        self.assertEqual(dga.condition_levels(samples, norm).tolist(), [1, 1, 2, 4, 0])
+
+    def test_worst_gas_wins(self):
+        samples = make_samples({'h2': 50., 'co': 800.})
+        norm = make_norm([1, 2, 3], h2=[100., 700., 1800.], co=[350., 570., 1400.])
+        self.assertEqual(dga.condition_levels(samples, norm).tolist(), [3])
+
+    def test_empty_norm(self):
+        samples = make_samples({'h2': 5000.}, {})
+        self.assertEqual(dga.condition_levels(samples, make_norm([])).tolist(), [0, 0])
+
+
+class SerializeTest(unittest.TestCase):
+
+    def test_labels_and_json_values(self):
+        samples = make_samples(THERMAL, {})
+        data = dga.serialize(samples, dga.diagnose(samples))
+        self.assertEqual(data['id'], [1, 2])
+        self.assertEqual(data['rogers'], ['Thermal > 700C', None])
+        self.assertEqual(data['duval'][1], None)
+        self.assertEqual(data['tdcg'], [751., 0.])
+        self.assertEqual(data['ratios']['ch4_h2'], [2., None])
+        self.assertIsNone(data['condition'])
+
+
+class GasRatesTest(ApiTestCase):
+    """Rates kept up to date by the flushes of test results and dissolved gas tests"""
+
+    def add_sample(self, equipment_id, day, h2):
+        with api.app_context():
+            result = TestResult(equipment_id=equipment_id, date_analyse=datetime.datetime(2016, 1, day),
+                                lab_id=1, test_type_id=DGA_TYPE_ID)
+            test = DissolvedGasTest(test_result=result, h2=h2)
+            db.session.add(test)
+            db.session.commit()
+            return result.id, test.id
+
+    def change(self, test_result_id, **values):
+        with api.app_context():
+            result = db.session.query(TestResult).get(test_result_id)
+            for name, value in values.items():
+                setattr(result, name, value)
+            db.session.commit()
+
+    def rates(self, equipment_id):
+        """(test, previous test, h2 rate) of equipment by date"""
+        with api.app_context():
+            return [(rate.dissolved_gas_test_id, rate.previous_test_id, rate.h2)
+                    for rate in gas_rates.history(db.session, equipment_id)]
+
+    def test_insert(self):
+        equipment_id = self.add_equipment(1)[0]
+        first = self.add_sample(equipment_id, 6, 0.)
+        self.assertEqual(self.rates(equipment_id), [])
+        last = self.add_sample(equipment_id, 11, 100.)
+        self.assertEqual(self.rates(equipment_id), [(last[1], first[1], 20.)])
+        # before the others, the rate of the next one changes
+        earliest = self.add_sample(equipment_id, 1, 50.)
+        self.assertEqual(self.rates(equipment_id), [(first[1], earliest[1], -10.), (last[1], first[1], 20.)])
+        # samples of the same day have no rate
+        same_day = self.add_sample(equipment_id, 11, 50.)
+        self.assertEqual(self.rates(equipment_id), [
+            (first[1], earliest[1], -10.), (last[1], first[1], 20.), (same_day[1], last[1], None)])
+
+    def test_first_test_moved_to_another_equipment(self):
+        equipment_id, other_id = self.add_equipment(2)
+        first = self.add_sample(equipment_id, 1, 0.)
+        last = self.add_sample(equipment_id, 11, 100.)
+        self.change(first[0], equipment_id=other_id)
+        self.assertEqual(self.rates(equipment_id), [])
+        self.assertEqual(self.rates(other_id), [])
+        self.change(first[0], equipment_id=equipment_id)
+        self.assertEqual(self.rates(equipment_id), [(last[1], first[1], 10.)])
+
+    def test_first_test_moved_later(self):
+        equipment_id = self.add_equipment(1)[0]
+        first = self.add_sample(equipment_id, 1, 0.)
+        last = self.add_sample(equipment_id, 11, 100.)
+        self.change(first[0], date_analyse=datetime.datetime(2016, 1, 21))
+        self.assertEqual(self.rates(equipment_id), [(first[1], last[1], -10.)])
+
+    def test_delete(self):
+        equipment_id = self.add_equipment(1)[0]
+        first = self.add_sample(equipment_id, 1, 0.)
+        middle = self.add_sample(equipment_id, 6, 100.)
+        last = self.add_sample(equipment_id, 11, 100.)
+        with api.app_context():
+            db.session.delete(db.session.query(TestResult).get(middle[0]))
+            db.session.commit()
+        self.assertEqual(self.rates(equipment_id), [(last[1], first[1], 10.)])
+
+
+class NormsTest(ApiTestCase):
+    """Tests of a campaign on both sides of the bounds of their norms"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(NormsTest, cls).setUpClass()
+        cls.equipment_id, cls.other_id = cls.add_equipment(2)
+        cls.campaign_id = cls.add(Campaign, [{'created_by_id': cls.user_id}])[0]
+        cls.result_id, cls.other_result_id = cls.add(TestResult, [
+            {'campaign_id': cls.campaign_id, 'equipment_id': equipment_id, 'lab_id': 1,
+             'test_type_id': DGA_TYPE_ID, 'temperature': 30.}
+            for equipment_id in (cls.equipment_id, cls.other_id)
+        ])
+        # only equipment_id has a physic norm, viscosity is the last field of the matrices
+        cls.norm_id = cls.add(NormPhysic, [{'name': 'oil', 'equipment_id': cls.equipment_id,
+                                            'acid_max': .1, 'ift_min': 25., 'viscosity_max': 12.}])[0]
+        cls.add(NormFuran, [{'c1': 100., 'c2': 250., 'c3': 1000., 'c4': 2500.}])
+        cls.add(NormIsolation, [{'c': 20., 'notseal': 1000.}, {'c': 40., 'notseal': 500.}])
+        cls.fluid_ids = cls.add(FluidTest, [
+            {'test_result_id': cls.result_id, 'acidity': .05, 'ift': 20., 'viscosity': 15.},
+            {'test_result_id': cls.result_id, 'acidity': .2, 'ift': 30., 'viscosity': 12.},
+            {'test_result_id': cls.other_result_id, 'acidity': 5., 'ift': 1., 'viscosity': 100.},
+        ])
+        cls.furan_ids = cls.add(FuranTest, [
+            {'test_result_id': cls.result_id, 'fal': fal} for fal in (50., 100., 300., 3000.)
+        ])
+        # minimum of 750 megohms at 30C
+        cls.insulation_id = cls.add(InsulationResistanceTest, [
+            {'test_result_id': cls.result_id, 'resistance1': 800., 'resistance2': 700., 'resistance3': 750.}
+        ])[0]
+
+    def flags(self, evaluate=norms.cached_evaluate):
+        with api.app_context():
+            flags = evaluate(db.session, self.campaign_id)
+            db.session.commit()
+        return sorted((flag['test_table'], flag['test_id'], flag['field'], flag['low'], flag['high'],
+                       flag['condition']) for flag in flags)
+
+    def test_values_out_of_the_norms_are_flagged(self):
+        self.assertEqual(self.flags(norms.evaluate), [
+            ('fluid_test', self.fluid_ids[0], 'ift', 25., None, None),
+            ('fluid_test', self.fluid_ids[0], 'viscosity', None, 12., None),
+            ('fluid_test', self.fluid_ids[1], 'acidity', None, .1, None),
+            ('furan_test', self.furan_ids[2], 'fal', None, 100., 3),
+            ('furan_test', self.furan_ids[3], 'fal', None, 100., 5),
+            ('insulation_resistance_test', self.insulation_id, 'resistance2', 750., None, None),
+        ])
+
+    def test_norm_change_invalidates_the_evaluation(self):
+        flagged = ('fluid_test', self.fluid_ids[1], 'acidity', None, .1, None)
+        self.assertIn(flagged, self.flags())
+        with api.app_context():
+            db.session.query(NormPhysic).get(self.norm_id).acid_max = .3
+            db.session.commit()
+        try:
+            self.assertNotIn(flagged[:3], [flag[:3] for flag in self.flags()])
+        finally:
+            with api.app_context():
+                db.session.query(NormPhysic).get(self.norm_id).acid_max = .1
+                db.session.commit()
+        self.assertIn(flagged, self.flags())
+
+    def test_flags_are_stored_for_the_api(self):
+        response = self.client.post(API + '/campaign/{}/norm_flags'.format(self.campaign_id))
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(len(json.loads(response.data)['result']), 6)
+        response = self.client.get(API + '/campaign/{}/norm_flags'.format(self.campaign_id))
+        self.assertEqual([(flag['test_table'], flag['field']) for flag in json.loads(response.data)['result']], [
+            ('fluid_test', 'ift'), ('fluid_test', 'viscosity'), ('fluid_test', 'acidity'),
+            ('furan_test', 'fal'), ('furan_test', 'fal'), ('insulation_resistance_test', 'resistance2'),
+        ])
@@ -73,17 +73,45 @@ def on_identity_loaded(sender, identity):
         identity.provides.add(be_guest)
 
 
-# get all stored images
+# get stored images, a page at a time
+from sqlalchemy import func
 from app.admin.models import Image
+from app.admin.thumbnails import thumbnail_url
+from app.cache import get_versions
 
+IMAGE_PAGE_SIZE = 60
+MAX_IMAGE_PAGE_SIZE = 200
 
-def get_images():
+
+def get_images(after=None, limit=IMAGE_PAGE_SIZE, prefix=None):
+    """Return {'images': images ordered by id, 'next': id to pass as after for the next page or None}.
+
+    The page starts after the id after, prefix keeps the images whose name starts with it.
+    """
     try:
-        allImages = db.session().query(Image).all()
-        res = [img.serialize for img in allImages]
+        limit = max(1, min(limit or IMAGE_PAGE_SIZE, MAX_IMAGE_PAGE_SIZE))
+        query = db.session.query(Image)
+        if after is not None:
+            query = query.filter(Image.id > after)
+        if prefix:
+            pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            query = query.filter(Image.name.like(pattern, escape='\\'))
+        # one more row tells if there is a next page
+        rows = query.order_by(Image.id).limit(limit + 1).all()
+        images = [dict(img.serialize, thumbnail=thumbnail_url(img.path, 'small')) for img in rows[:limit]]
+        res = {
+            'images': images,
+            'next': images[-1]['id'] if len(rows) > limit else None
+        }
     except Exception as e:
         import logging
         logging.error(e)
         res = None
 
     return res
+
+
+def images_state():
+    """(max id, row count, table version) of the images, changed by any upload, edit or delete"""
+    max_id, count = db.session.query(func.max(Image.id), func.count(Image.id)).one()
+    return max_id, count, get_versions(db.session, [Image.__tablename__])
@@ -8,7 +8,7 @@ from flask import g, request
 from flask import current_app
 
 from app import babel
-from app.users.models import User
+from app.users.identity import load_user
 from app.home.models import _is_blogger, _get_news, _get_blog_meta
 import sqlalchemy_utils
 from flask_login import current_user
@@ -30,7 +30,7 @@ def before_request():
 
     if 'user_id' in session:
         if session['user_id'] is not None:
-            g.user = User.query.get(session['user_id'])
+            g.user = load_user(session['user_id'])
             if not g.user:
                 del session['user_id']
 
@@ -135,19 +135,55 @@ def wiki_devs():
     )
 
 
-from .models import get_images
+from .models import get_images, images_state
+import hashlib
 
 
-@mod.route('/images', methods=['POST'])
+@mod.route('/images', methods=['GET', 'POST'])
 def images():
+    """A page of the images for the image picker of the editors, ?after=<id>&limit=<n>&prefix=<name>"""
     if request.is_xhr:
-        images = get_images()
-        return jsonify({'images': images})
+        etag = None
+        if request.method == 'GET':
+            etag = hashlib.sha1(repr((request.query_string, images_state()))).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+        res = get_images(
+            after=request.values.get('after', type=int),
+            limit=request.values.get('limit', type=int),
+            prefix=request.values.get('prefix'),
+        )
+        if res is None:
+            abort(500)
+        response = jsonify(res)
+        if etag is not None:
+            response.set_etag(etag)
+            # the picker asks again each time it opens, the ETag makes it a 304
+            response.cache_control.no_cache = True
+        return response
     else:
         # redirect to home
         return redirect(url_for('home.home'))
 
 
+from flask import send_file
+from app.admin.thumbnails import variant, THUMBNAIL_MAX_AGE
+
+
+@mod.route('/thumbnail/<string:size>/<path:filename>', methods=['GET'])
+def thumbnail(size, filename):
+    """size variant of an uploaded image, generated on the first request"""
+    target = variant(filename, size)
+    if target is None:
+        abort(404)
+    response = send_file(target, conditional=True, cache_timeout=THUMBNAIL_MAX_AGE)
+    response.cache_control.public = True
+    return response
+
+
 from app.pages.storage import isblogger, process_page, get_page_by_tag_slug, get_pages_by_tag
 from app.pages.views import render
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Opt-in count and timing of the SQL statements of every request, enabled by SQL_INSTRUMENTATION  """
+
+import heapq
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+from flask import g, request, has_request_context, jsonify
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listen
+
+# slowest statements kept per request and per endpoint
+SLOWEST_COUNT = 5
+# requests listed by /_debug/queries
+RECENT_COUNT = 100
+
+logger = logging.getLogger('app.sql')
+_lock = threading.Lock()
+# endpoint -> totals of its requests, see record()
+_endpoints = {}
+_recent = deque(maxlen=RECENT_COUNT)
+_listening = False
+
+
+class RequestQueries(object):
+    """Statements run by one request, with their durations in ms"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.statements = []
+
+    def add(self, statement, duration):
+        self.statements.append((duration, statement))
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def duration(self):
+        return sum(duration for duration, statement in self.statements)
+
+    def slowest(self):
+        return heapq.nlargest(SLOWEST_COUNT, self.statements)
+
+    def repeated(self, threshold):
+        """Statements run more than threshold times, most repeated first: the N+1 pattern"""
+        counts = Counter(statement for duration, statement in self.statements)
+        return [(statement, count) for statement, count in counts.most_common() if count > threshold]
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and hasattr(g, 'sql_queries'):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and hasattr(g, 'sql_queries') and conn.info.get('query_start'):
+        g.sql_queries.add(statement, (time.time() - conn.info['query_start'].pop()) * 1000)
+
+
+def start_request():
+    g.sql_queries = RequestQueries()
+
+
+def record(info, queries, total):
+    """Add a request to the totals of its endpoint and to the recent requests"""
+    with _lock:
+        stats = _endpoints.setdefault(info['endpoint'], {
+            'requests': 0, 'queries': 0, 'max_queries': 0, 'db_ms': 0., 'total_ms': 0., 'slowest': [],
+        })
+        stats['requests'] += 1
+        stats['queries'] += queries.count
+        stats['max_queries'] = max(stats['max_queries'], queries.count)
+        stats['db_ms'] += queries.duration
+        stats['total_ms'] += total
+        stats['slowest'] = heapq.nlargest(SLOWEST_COUNT, stats['slowest'] + queries.slowest())
+        _recent.append(dict(info, queries=queries.count, db_ms=round(queries.duration, 3), total_ms=round(total, 3)))
+
+
+def report(info, queries, threshold):
+    """Record and log a finished request, return its duration in ms"""
+    total = (time.time() - queries.start) * 1000
+    record(info, queries, total)
+    data = dict(info, queries=queries.count, db_ms=round(queries.duration, 3), total_ms=round(total, 3))
+    logger.info(json.dumps(data))
+    repeated = queries.repeated(threshold)
+    if repeated:
+        data['repeated'] = [{'statement': statement, 'count': count} for statement, count in repeated]
+        logger.warning(json.dumps(dict(data, alarm='n+1')))
+    return total
+
+
+def finish_request(threshold):
+    def end_request(response):
+        queries = getattr(g, 'sql_queries', None)
+        if queries is None:
+            return response
+        info = {
+            'endpoint': request.endpoint or request.path,
+            'method': request.method,
+            'path': request.full_path,
+            'status': response.status_code,
+        }
+        if response.is_streamed:
+            # the body is generated after this hook, with stream_with_context its statements
+            # are still counted, the request is reported once the server closes the response
+            response.call_on_close(lambda: report(info, queries, threshold))
+            return response
+
+        total = report(info, queries, threshold)
+        response.headers['Server-Timing'] = 'db;desc="{} queries";dur={:.3f}, app;dur={:.3f}'.format(
+            queries.count, queries.duration, total)
+        return response
+    return end_request
+
+
+def debug_queries():
+    """Per endpoint totals and the latest requests of this process"""
+    with _lock:
+        endpoints = {}
+        for endpoint, stats in _endpoints.items():
+            endpoints[endpoint] = dict(
+                stats,
+                avg_queries=float(stats['queries']) / stats['requests'],
+                avg_db_ms=stats['db_ms'] / stats['requests'],
+                slowest=[{'ms': round(duration, 3), 'statement': statement}
+                         for duration, statement in stats['slowest']],
+            )
+        return jsonify({'endpoints': endpoints, 'recent': list(_recent)})
+
+
+def instrument(flask_app, permission=None):
+    """Count the statements of the requests of flask_app when its SQL_INSTRUMENTATION setting is on.
+
+    Adds a Server-Timing header to the responses, logs every request to the app.sql logger
+    and warns when a statement runs more than SQL_N_PLUS_ONE_THRESHOLD times in a request.
+    Streamed responses get no header, they are logged when they close.
+    The totals are served at /_debug/queries to the users with permission. Without a permission
+    they are only served when the SQL_DEBUG_QUERIES setting is on too, to anyone: the SQL text
+    is not public and DEBUG is on in the sample config.
+    """
+    global _listening
+    if not flask_app.config.get('SQL_INSTRUMENTATION'):
+        return
+    if not _listening:
+        # every engine: the Flask-SQLAlchemy ones and the blogging one
+        listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _listening = True
+    flask_app.before_request(start_request)
+    flask_app.after_request(finish_request(flask_app.config.get('SQL_N_PLUS_ONE_THRESHOLD', 20)))
+    if permission is not None:
+        flask_app.add_url_rule('/_debug/queries', 'debug_queries',
+                               permission.require(http_exception=403)(debug_queries))
+    elif flask_app.config.get('SQL_DEBUG_QUERIES'):
+        flask_app.add_url_rule('/_debug/queries', 'debug_queries', debug_queries)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Outbound mail spooled in the mail_outbox table and sent by a background worker  """
+
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import after_this_request
+from flask_mail import Message
+from sqlalchemy import and_
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from app import app, db, mail
+
+# messages claimed and sent over one SMTP connection
+MAIL_BATCH_SIZE = app.config.get('MAIL_BATCH_SIZE', 50)
+# attempts before a message is left with status failed
+MAIL_MAX_ATTEMPTS = app.config.get('MAIL_MAX_ATTEMPTS', 8)
+# seconds before the first retry, doubled after every failed attempt
+MAIL_RETRY_DELAY = app.config.get('MAIL_RETRY_DELAY', 60)
+# seconds between two looks at the outbox when no message was enqueued by this process
+MAIL_POLL_INTERVAL = app.config.get('MAIL_POLL_INTERVAL', 60)
+# seconds after which a message claimed by a process that died is sent again
+MAIL_SEND_TIMEOUT = 600
+
+logger = logging.getLogger('app.mail')
+_lock = threading.Lock()
+_wake = threading.Event()
+_worker = None
+
+
+class OutboxMessage(db.Model):
+    """Mail waiting to be sent, or sent, with its attempts"""
+    __tablename__ = 'mail_outbox'
+    __table_args__ = (
+        db.Index('ix_mail_outbox_status_next_attempt', 'status', 'next_attempt'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sender = db.Column(db.String(255))
+    # JSON list of addresses
+    recipients = db.Column(db.Text, nullable=False)
+    subject = db.Column(db.UnicodeText)
+    body = db.Column(db.UnicodeText)
+    html = db.Column(db.UnicodeText)
+    # pending, sending, sent or failed
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    sent = db.Column(db.DateTime)
+
+
+def enqueue(msg):
+    """Store a flask_mail Message in the outbox within the transaction of db.session, without committing.
+
+    The worker is woken once the transaction commits, the message is sent later.
+    """
+    table = OutboxMessage.__table__
+    now = datetime.utcnow()
+    db.session.execute(table.insert().values(
+        sender=msg.sender if not isinstance(msg.sender, tuple) else '{} <{}>'.format(*msg.sender),
+        recipients=json.dumps(list(msg.recipients)),
+        subject=msg.subject,
+        body=msg.body,
+        html=msg.html,
+        status='pending',
+        attempts=0,
+        next_attempt=now,
+        created=now,
+    ))
+    db.session.info['mail_enqueued'] = True
+
+
+def enqueue_security_mail(msg):
+    """send_mail_task of Flask-Security, the message is committed at the end of the request.
+
+    Not all the Flask-Security views commit after sending mail.
+    """
+    enqueue(msg)
+    after_this_request(commit)
+
+
+def commit(response):
+    db.session.commit()
+    return response
+
+
+@listens_for(Session, 'after_commit')
+def wake_worker(session):
+    # a savepoint leaves it to the commit of its transaction
+    if session.transaction.nested or not session.info.pop('mail_enqueued', False):
+        return
+    if app.config.get('MAIL_WORKER', True):
+        start_worker()
+        _wake.set()
+
+
+@listens_for(Session, 'after_transaction_end')
+def forget_enqueued(session, transaction):
+    # messages of a rolled back transaction are gone
+    if session.transaction is None:
+        session.info.pop('mail_enqueued', None)
+
+
+def claim(connection, now):
+    """Return the due messages this process could mark as sending, at most MAIL_BATCH_SIZE"""
+    table = OutboxMessage.__table__
+    # sending ones are due again when the process sending them died
+    rows = connection.execute(table.select().where(and_(
+        table.c.status.in_(['pending', 'sending']), table.c.next_attempt <= now,
+    )).order_by(table.c.id).limit(MAIL_BATCH_SIZE)).fetchall()
+    claimed = []
+    for row in rows:
+        # another process may claim the same row, the update tells which one got it
+        updated = connection.execute(table.update().where(and_(
+            table.c.id == row.id, table.c.status == row.status, table.c.next_attempt == row.next_attempt,
+        )).values(status='sending', next_attempt=now + timedelta(seconds=MAIL_SEND_TIMEOUT))).rowcount
+        if updated:
+            claimed.append(row)
+    return claimed
+
+
+def failed(connection, row, error):
+    """Schedule the next attempt of row, or give it up after MAIL_MAX_ATTEMPTS"""
+    table = OutboxMessage.__table__
+    attempts = row.attempts + 1
+    values = {'attempts': attempts, 'last_error': str(error)[:1000]}
+    if attempts >= MAIL_MAX_ATTEMPTS:
+        values['status'] = 'failed'
+        logger.error('mail {} to {} failed: {}'.format(row.id, row.recipients, error))
+    else:
+        values['status'] = 'pending'
+        values['next_attempt'] = datetime.utcnow() + timedelta(seconds=MAIL_RETRY_DELAY * 2 ** (attempts - 1))
+        logger.warning('mail {} to {} attempt {} failed: {}'.format(row.id, row.recipients, attempts, error))
+    connection.execute(table.update().where(table.c.id == row.id).values(**values))
+
+
+def deliver_pending():
+    """Send the due messages of the outbox, one SMTP connection per batch, return the number sent"""
+    table = OutboxMessage.__table__
+    count = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = claim(connection, datetime.utcnow())
+        if not rows:
+            return count
+        with db.engine.connect() as connection:
+            rows = list(rows)
+            try:
+                with mail.connect() as smtp:
+                    while rows:
+                        row = rows.pop(0)
+                        msg = Message(row.subject, sender=row.sender, recipients=json.loads(row.recipients),
+                                      body=row.body, html=row.html)
+                        try:
+                            smtp.send(msg)
+                        except Exception as e:
+                            failed(connection, row, e)
+                            # the SMTP session may be broken, the rest of the batch gets a new one
+                            break
+                        connection.execute(table.update().where(table.c.id == row.id).values(
+                            status='sent', sent=datetime.utcnow(), attempts=row.attempts + 1, last_error=None))
+                        count += 1
+            except Exception as e:
+                # server down, login refused: the whole batch waits for its next attempt
+                for row in rows:
+                    failed(connection, row, e)
+                rows = []
+            # due again right away, claimed by the next batch
+            for row in rows:
+                connection.execute(table.update().where(table.c.id == row.id).values(
+                    status='pending', next_attempt=row.next_attempt))
+
+
+def work():
+    while True:
+        _wake.wait(MAIL_POLL_INTERVAL)
+        _wake.clear()
+        try:
+            with app.app_context():
+                deliver_pending()
+        except Exception as e:
+            logger.exception(e)
+
+
+def start_worker():
+    """Start the mail thread of this process once, after the uWSGI fork since enqueue() starts it"""
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=work, name='mail-outbox')
+            _worker.daemon = True
+            _worker.start()
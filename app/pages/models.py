@@ -13,6 +13,10 @@ make_translatable( options = {'locales': ['en' , 'fr' , 'es']})
 
 class Pages(Translatable , db.Model):
     __tablename__ = 'pages'
+    __table_args__ = (
+        db.Index('ix_pages_slug', 'slug'),
+        db.Index('ix_pages_tag_slug', 'tag', 'slug'),
+    )
     __translatable__ = {
           'locales': ['en' , 'fr', 'es']
          ,'dynamic_source_locale': True
@@ -41,4 +45,7 @@ class PageTranslation(translation_base(Pages)):
     title = sqla.Column(sqla.Unicode(256))
     text = sqla.Column(sqla.UnicodeText())
 
+# __table_args__ of a translation class would replace the foreign key set by translation_base
+db.Index('ix_pages_translation_locale_title', PageTranslation.__table__.c.locale, PageTranslation.__table__.c.title)
+
 
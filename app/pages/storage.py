@@ -13,6 +13,8 @@ from flask import url_for
 import markdown
 from markdown.extensions.meta import MetaExtension
 from sqlalchemy.orm import joinedload
+from app import app
+from app.cache import LRUCache, get_versions
 
 class MathJaxPattern(markdown.inlinepatterns.Pattern):
 
@@ -34,6 +36,10 @@ class MathJaxExtension(markdown.Extension):
 
 _markdown_extensions = [MathJaxExtension(), MetaExtension()]
 
+# (page id, locale, updated_on, versions of the translations) -> (rendered html, markdown Meta),
+# a saved page gets a new updated_on, a translation changed on its own a new version
+rendered_pages = LRUCache(app.config.get('PAGE_RENDER_CACHE_SIZE', 256))
+
 
 def get_locale():
     if 'locale' in session:
@@ -45,10 +51,20 @@ def get_locale():
 def set_locale():
     sqlalchemy_utils.i18n.get_locale = get_locale
 
+FALLBACK_LOCALE = 'en'
+# slug -> page id, lets get_page_by_slug load the page by its primary key
+_slug_ids = {}
+
+
+def page_query():
+    """Pages with their translations loaded by the same query, so title and text don't lazy-load them"""
+    return db.session.query(Pages).options(joinedload(Pages._translations))
+
+
 # Get page by id
 def get_page_by_id(page_id):
     try:
-        res = Pages.query.filter_by(id = page_id).first()
+        res = page_query().filter(Pages.id == page_id).first()
     except Exception as e:
         import logging
         logging.error(e)
@@ -58,7 +74,7 @@ def get_page_by_id(page_id):
 
 def get_page_by_tag_slug(tag,slug):
     try:
-        res = Pages.query.filter_by(tag = tag ,slug = slug).first()
+        res = page_query().filter(Pages.tag == tag, Pages.slug == slug).first()
     except Exception as e:
         import logging
         logging.error(e)
@@ -68,7 +84,7 @@ def get_page_by_tag_slug(tag,slug):
 
 def get_pages_by_tag(tag):
     try:
-        res = Pages.query.filter_by(tag = tag)
+        res = page_query().filter(Pages.tag == tag)
     except Exception as e:
         import logging
         logging.error(e)
@@ -78,7 +94,19 @@ def get_pages_by_tag(tag):
 # get page by slug
 def get_page_by_slug(slug):
     try:
-        res = Pages.query.filter_by(slug=slug).first()
+        res = None
+        page_id = _slug_ids.get(slug)
+        if page_id is not None:
+            res = page_query().filter(Pages.id == page_id).first()
+            # renamed or deleted by another process
+            if res is None or res.slug != slug:
+                res = None
+        if res is None:
+            res = page_query().filter(Pages.slug == slug).first()
+        if res is not None:
+            _slug_ids[slug] = res.id
+        else:
+            _slug_ids.pop(slug, None)
     except Exception as e:
         import logging
         logging.error(e)
@@ -89,11 +117,12 @@ def get_page_by_slug(slug):
 
 # get page by title
 def get_page_by_title(title):
+    """Page whose title is title in the current locale, or in FALLBACK_LOCALE for a page without one"""
     try:
-        res = db.session.query(Pages).join(PageTranslation, (PageTranslation.id == Pages.id)).filter(Pages.title == title)\
-             .first()
-        # print(db.session.query(Pages).join(PageTranslation, (PageTranslation.id == Pages.id)).filter(Pages.title == title))
-        # print(res)
+        locale = get_locale()
+        res = page_query().join(PageTranslation, PageTranslation.id == Pages.id) \
+            .filter(PageTranslation.locale.in_([locale, FALLBACK_LOCALE]), PageTranslation.title == title) \
+            .order_by(PageTranslation.locale != locale).first()
     except Exception as e:
         import logging
         logging.error(e)
@@ -107,6 +136,7 @@ def delete_page_by_id(page_id):
         page = Pages.query.filter_by(id = page_id).first()
         db.session.delete(page)
         db.session.commit()
+        _slug_ids.pop(page.slug, None)
         res = page.id
     except Exception as e:
         import logging
@@ -175,8 +205,10 @@ def store_form_data(blog_form ,user ,page):
 def save_page(title, text, slug, tag, author_id, created_on, updated_on, page_id):
     try:
         if page_id is not None:
-            currentPage = Pages.query.filter_by(id = page_id).first()
+            currentPage = page_query().filter(Pages.id == page_id).first()
             page_id = page_id if currentPage else None
+            if currentPage:
+                _slug_ids.pop(currentPage.slug, None)
 
         if page_id is None:
             currentPage = Pages(
@@ -203,6 +235,8 @@ def save_page(title, text, slug, tag, author_id, created_on, updated_on, page_id
 
         db.session.add(currentPage)
         db.session.commit()
+        # the next views of the page only look it up
+        render_text(currentPage)
 
         page_id = currentPage.id \
                     if page_id is None else page_id
@@ -220,9 +254,13 @@ def construct_url(page_id):
 
 
 def render_text(page):
-    md = markdown.Markdown(extensions = _markdown_extensions)
-    page.rendered_text = md.convert(page.text)
-    page.meta = md.Meta
+    key = (page.id, get_locale(), page.updated_on, get_versions(db.session, [PageTranslation.__tablename__]))
+    rendered = rendered_pages.get(key)
+    if rendered is None:
+        md = markdown.Markdown(extensions = _markdown_extensions)
+        rendered = (md.convert(page.text or u''), md.Meta)
+        rendered_pages.set(key, rendered)
+    page.rendered_text, page.meta = rendered
 
 
 def process_page(page, render):
@@ -7,7 +7,7 @@ from .storage import *
 from .forms import PageEditor
 from flask.ext.principal import PermissionDenied
 from flask.ext.babel import gettext
-from app.users.models import User
+from app.users.identity import load_user
 
 mod = Blueprint('pages', __name__, url_prefix='/pages')
 #true for the moment
@@ -23,7 +23,7 @@ def before_request():
 
     if 'user_id' in session:
         if session['user_id'] is not None:
-            g.user = User.query.get(session['user_id'])
+            g.user = load_user(session['user_id'])
 
 @mod.route("/<int:page_id>/", defaults={"page_id": None} )
 @mod.route("/<int:page_id>/")
@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  Tests of the API and of the mail outbox, run by nosetests against a new SQLite database  """
+
+import datetime
+import json
+import os
+import tempfile
+import unittest
+from flask import Flask
+from flask_mail import Message
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.event import listen, remove
+from sqlalchemy.sql.expression import Update
+import app as site
+from app import outbox
+from app.api import api, db, response_cache
+from app.instrumentation import instrument
+from app.diagnostic.models import Equipment, EquipmentType, Location, Manufacturer, Norm, Lab, Campaign, TestResult
+from app.diagnostic.models import TestType, TestTypeResultTable, DissolvedGasTest, GasSensor, NormGas
+from app.diagnostic import models as diagnostic_models, lab_import, norms
+from app.users.models import User
+
+API = '/api/v1.0'
+DGA_TYPE_ID = 1
+
+
+class ApiTestCase(unittest.TestCase):
+    """Gives every test class its own database file, with the rows the tests share, and an API test client"""
+
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.database = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        cls.database_uris = []
+        # both apps, like benchmarks.endpoints
+        for flask_app, flask_db in ((api, db), (site.app, site.db)):
+            cls.database_uris.append(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+            flask_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + cls.database
+            # a session opened at import is bound to the configured database
+            flask_db.session.remove()
+        # kept per process under the table versions, which start again in every database
+        response_cache.items.clear()
+        norms._compiled = None
+        norms._evaluations.items.clear()
+        diagnostic_models.reset_test_models()
+        with api.app_context(), site.app.app_context():
+            site.db.create_all()
+            cls.user_id = add_common_rows()
+            db.session.commit()
+            db.session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        for (flask_app, flask_db), uri in zip(((api, db), (site.app, site.db)), cls.database_uris):
+            flask_db.session.remove()
+            flask_app.config['SQLALCHEMY_DATABASE_URI'] = uri
+        os.remove(cls.database)
+
+    def setUp(self):
+        self.client = api.test_client()
+
+    def get_json(self, url, status=200, **kwargs):
+        response = self.client.get(API + url, **kwargs)
+        self.assertEqual(response.status_code, status, response.data)
+        return json.loads(response.data)
+
+    @classmethod
+    def add(cls, model, rows):
+        """Insert rows of model, return their ids"""
+        with api.app_context():
+            items = [model(**row) for row in rows]
+            db.session.add_all(items)
+            db.session.commit()
+            return [item.id for item in items]
+
+    @classmethod
+    def add_equipment(cls, count, **values):
+        first = cls.count(Equipment) + 1
+        return cls.add(Equipment, [dict({
+            'name': u'equipment {}'.format(i), 'equipment_number': str(i), 'serial': u'S{:08d}'.format(i),
+            'equipment_type_id': 14, 'manufacturer_id': 1, 'location_id': 1, 'norm_id': 1,
+            'assigned_to_id': cls.user_id, 'visual_inspection_by_id': cls.user_id,
+        }, **values) for i in range(first, first + count)])
+
+    @classmethod
+    def add_results(cls, count):
+        """Add count dissolved gas test results, each one of its own equipment and campaign"""
+        equipment_ids = cls.add_equipment(count)
+        campaign_ids = cls.add(Campaign, [
+            {'created_by_id': cls.user_id, 'date_created': datetime.datetime(2016, 1, 1)} for _ in range(count)
+        ])
+        result_ids = cls.add(TestResult, [
+            {'campaign_id': campaign_id, 'equipment_id': equipment_id, 'lab_id': 1, 'test_type_id': DGA_TYPE_ID,
+             'date_analyse': datetime.datetime(2016, 1, 1) + datetime.timedelta(days=index)}
+            for index, (campaign_id, equipment_id) in enumerate(zip(campaign_ids, equipment_ids))
+        ])
+        cls.add(DissolvedGasTest, [{'test_result_id': result_id, 'h2': 10., 'ch4': 5.} for result_id in result_ids])
+        return result_ids
+
+    @classmethod
+    def count(cls, model):
+        with api.app_context():
+            return db.session.query(model).count()
+
+
+def add_common_rows():
+    """Rows every equipment and test result refers to, return the id of the user"""
+    user = User(name='test', alias='test', email='test@example.com', password='test')
+    db.session.add(user)
+    db.session.add_all([
+        Lab(id=1, name='lab'), EquipmentType(id=14, name='transfo'), Location(id=1, name='location'),
+        Manufacturer(id=1, name='manufacturer'), Norm(id=1, name='norm'),
+        TestType(id=DGA_TYPE_ID, name='dga', is_group=False),
+    ])
+    db.session.flush()
+    db.session.add(TestTypeResultTable(test_type_id=DGA_TYPE_ID, test_result_table_name='dissolved_gas_test'))
+    return user.id
+
+
+class StatementCounter(object):
+    """Count the SQL statements run while in the with block"""
+
+    def __enter__(self):
+        self.count = 0
+        listen(Engine, 'after_cursor_execute', self.executed)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove(Engine, 'after_cursor_execute', self.executed)
+
+    def executed(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+class QueryCountTest(ApiTestCase):
+
+    def statements(self, url):
+        with StatementCounter() as counter:
+            response = self.client.get(API + url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return counter.count, len(json.loads(response.data)['result'])
+
+    def test_test_result_list_runs_the_same_statements_for_any_number_of_rows(self):
+        self.add_results(2)
+        # the first request also loads the test type map kept by the process
+        self.statements('/test_result/')
+        few, rows = self.statements('/test_result/')
+        self.assertEqual(rows, 2)
+        self.add_results(10)
+        many, rows = self.statements('/test_result/')
+        self.assertEqual(rows, 12)
+        self.assertEqual(few, many)
+
+
+class KeysetPaginationTest(ApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(KeysetPaginationTest, cls).setUpClass()
+        cls.ids = cls.add_equipment(5)
+
+    def test_pages_follow_the_next_cursor_until_it_is_null(self):
+        ids = []
+        data = self.get_json('/equipment/?limit=2')
+        while True:
+            self.assertLessEqual(len(data['result']), 2)
+            ids.extend(item['id'] for item in data['result'])
+            if data['next'] is None:
+                break
+            self.assertEqual(data['next'], ids[-1])
+            data = self.get_json('/equipment/?limit=2&after={}'.format(data['next']))
+        self.assertEqual(ids, self.ids)
+
+    def test_last_full_page_has_no_next_cursor(self):
+        data = self.get_json('/equipment/?limit=5')
+        self.assertEqual([item['id'] for item in data['result']], self.ids)
+        self.assertIsNone(data['next'])
+
+    def test_after_alone_uses_the_default_page_size(self):
+        data = self.get_json('/equipment/?after={}'.format(self.ids[2]))
+        self.assertEqual([item['id'] for item in data['result']], self.ids[3:])
+        self.assertIsNone(data['next'])
+
+    def test_filters_apply_to_the_pages(self):
+        data = self.get_json('/equipment/?limit=1&id__ge={}'.format(self.ids[3]))
+        self.assertEqual([item['id'] for item in data['result']], [self.ids[3]])
+        self.assertEqual(data['next'], self.ids[3])
+
+    def test_without_limit_or_after_the_whole_list_is_returned(self):
+        data = self.get_json('/equipment/')
+        self.assertEqual(len(data['result']), 5)
+        self.assertNotIn('next', data)
+
+    def test_wrong_pages_are_rejected(self):
+        for query in ('limit=0', 'limit=x', 'after=x', 'limit=2&sort=-id'):
+            self.get_json('/equipment/?' + query, status=400)
+
+
+class FilterOperatorsTest(ApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(FilterOperatorsTest, cls).setUpClass()
+        cls.alpha, cls.beta, cls.gamma, cls.delta = [
+            cls.add_equipment(1, name=name, tension4=tension, validated=validated)[0]
+            for name, tension, validated in (
+                (u'alpha', 10., True), (u'beta', 20., False), (u'gamma', None, True), (u'Delta', 40., None),
+            )
+        ]
+        cls.add(Campaign, [{'created_by_id': cls.user_id, 'date_created': datetime.datetime(2016, 1, day)}
+                           for day in (1, 2, 3)])
+
+    def ids(self, url):
+        return sorted(item['id'] for item in self.get_json(url)['result'])
+
+    def test_eq_is_the_default_operator(self):
+        self.assertEqual(self.ids('/equipment/?name=beta'), [self.beta])
+        self.assertEqual(self.ids('/equipment/?name__eq=beta'), [self.beta])
+
+    def test_ne(self):
+        self.assertEqual(self.ids('/equipment/?name__ne=beta'), [self.alpha, self.gamma, self.delta])
+
+    def test_comparisons_coerce_to_the_column_type(self):
+        self.assertEqual(self.ids('/equipment/?tension4__gt=20'), [self.delta])
+        self.assertEqual(self.ids('/equipment/?tension4__ge=20'), [self.beta, self.delta])
+        self.assertEqual(self.ids('/equipment/?tension4__lt=20'), [self.alpha])
+        self.assertEqual(self.ids('/equipment/?tension4__le=20.0'), [self.alpha, self.beta])
+
+    def test_in(self):
+        self.assertEqual(self.ids('/equipment/?id__in={},{}'.format(self.gamma, self.alpha)), [self.alpha, self.gamma])
+
+    def test_like_and_ilike(self):
+        self.assertEqual(self.ids('/equipment/?name__like=%25mm%25'), [self.gamma])
+        self.assertEqual(self.ids('/equipment/?name__ilike=d%25'), [self.delta])
+
+    def test_isnull(self):
+        self.assertEqual(self.ids('/equipment/?tension4__isnull=true'), [self.gamma])
+        self.assertEqual(self.ids('/equipment/?tension4__isnull=0'), [self.alpha, self.beta, self.delta])
+
+    def test_booleans(self):
+        self.assertEqual(self.ids('/equipment/?validated=yes'), [self.alpha, self.gamma])
+        self.assertEqual(self.ids('/equipment/?validated=false'), [self.beta])
+
+    def test_dates(self):
+        dates = [item['date_created'] for item in self.get_json('/campaign/?date_created__ge=2016-01-02')['result']]
+        self.assertEqual(len(dates), 2)
+
+    def test_filters_are_combined(self):
+        self.assertEqual(self.ids('/equipment/?validated=1&tension4__isnull=0'), [self.alpha])
+
+    def test_wrong_filters_are_rejected(self):
+        for query in ('name__near=beta', 'nope=1', 'id=x', 'tension4__gt=x', 'tension4__isnull=maybe',
+                      'validated=perhaps', 'visual_date__ge=someday'):
+            self.get_json('/equipment/?' + query, status=400)
+
+
+class ConditionalGetTest(ApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ConditionalGetTest, cls).setUpClass()
+        cls.equipment_id = cls.add_equipment(1)[0]
+        cls.sensor_id = cls.add(GasSensor, [{'serial': 'S1'}])[0]
+
+    def get(self, url, etag=None):
+        headers = {'If-None-Match': '"{}"'.format(etag)} if etag else {}
+        return self.client.get(API + url, headers=headers)
+
+    def etag(self, url):
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.get_etag()[0]
+
+    def test_matching_etag_is_answered_with_304(self):
+        etag = self.etag('/equipment/')
+        self.assertTrue(etag)
+        response = self.get('/equipment/', etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.get_etag()[0], etag)
+
+    def test_etag_depends_on_the_url(self):
+        self.assertNotEqual(self.etag('/equipment/'), self.etag('/equipment/?limit=1'))
+        self.assertNotEqual(self.etag('/equipment/'), self.etag('/equipment/{}'.format(self.equipment_id)))
+
+    def test_write_gives_a_new_etag(self):
+        url = '/equipment/{}'.format(self.equipment_id)
+        etag = self.etag(url)
+        response = self.client.post(API + url, data=json.dumps({'name': u'renamed'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.data)
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_etag()[0], etag)
+        self.assertEqual(json.loads(response.data)['result']['name'], u'renamed')
+
+    def test_write_to_a_table_not_read_keeps_the_etag(self):
+        etag = self.etag('/equipment/')
+        self.add(Campaign, [{'created_by_id': self.user_id, 'date_created': datetime.datetime(2016, 1, 1)}])
+        self.assertEqual(self.get('/equipment/', etag).status_code, 304)
+
+    def test_readings_up_to_now_have_no_etag(self):
+        url = '/gas_sensor/{}/readings'.format(self.sensor_id)
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.get_etag(), (None, None))
+        self.assertTrue(self.etag(url + '?start=2016-01-01&end=2016-02-01'))
+
+
+class GasDiagnosisTest(ApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(GasDiagnosisTest, cls).setUpClass()
+        cls.result_ids = cls.add_results(2)
+        cls.add(NormGas, [{'name': 'ieee', 'condition': condition, 'h2': h2, 'tdcg': 0.}
+                          for condition, h2 in ((1, 5.), (2, 100.), (3, 700.))])
+
+    def test_columns_of_the_tests(self):
+        data = self.get_json('/dissolved_gas_test/diagnosis?norm=ieee')
+        self.assertEqual(data['result']['test_result_id'], self.result_ids)
+        self.assertEqual(data['result']['tdcg'], [15., 15.])
+        self.assertEqual(data['result']['condition'], [2, 2])
+        self.assertEqual(data['result']['ratios']['ch4_h2'], [.5, .5])
+        self.assertEqual(set(data['legend']), {'rogers', 'doernenburg', 'iec', 'duval'})
+
+    def test_tests_are_filtered(self):
+        data = self.get_json('/dissolved_gas_test/diagnosis?test_result_id={}'.format(self.result_ids[1]))
+        self.assertEqual(data['result']['test_result_id'], self.result_ids[1:])
+
+    def test_unknown_norm_is_rejected(self):
+        data = self.get_json('/dissolved_gas_test/diagnosis?norm=nope', status=400)
+        self.assertIn('ieee', data['error'])
+        self.get_json('/dissolved_gas_test/diagnosis?equipment_id=x', status=400)
+
+
+
+class LabImportTest(ApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(LabImportTest, cls).setUpClass()
+        # dated 2016-01-01 and 2016-01-02, of equipment with the serials S00000001 and S00000002
+        cls.result_ids = cls.add_results(2)
+
+    def setUp(self):
+        super(LabImportTest, self).setUp()
+        self.chunk_size = lab_import.IMPORT_CHUNK_SIZE
+        with api.app_context():
+            db.session.query(DissolvedGasTest).filter(DissolvedGasTest.h2 != 10.).delete()
+            db.session.commit()
+
+    def tearDown(self):
+        lab_import.IMPORT_CHUNK_SIZE = self.chunk_size
+
+    def post(self, url, lines, status=200):
+        response = self.client.post(API + url, data='\n'.join(lines) + '\n', content_type='text/csv')
+        self.assertEqual(response.status_code, status, response.data)
+        return json.loads(response.data)['result'] if status == 200 else None
+
+    def imported(self):
+        """h2 values of the dissolved gas tests added by the imports"""
+        with api.app_context():
+            return sorted(row.h2 for row in db.session.query(DissolvedGasTest).filter(DissolvedGasTest.h2 != 10.))
+
+    def test_rows_are_checked_one_by_one(self):
+        job = self.post('/dissolved_gas_test/_import?filename=lab.csv', [
+            'test_result_id,equipment_serial,date_analyse,h2,ch4',
+            '{},,,101,1'.format(self.result_ids[0]),
+            '999999,,,102,1',
+            ',S00000002,2016-01-02,103,1',
+            ',S99999999,2016-01-02,104,1',
+            ',S00000001,2016-03-01,105,1',
+            '{},,,x,1'.format(self.result_ids[1]),
+        ])
+        self.assertEqual((job['status'], job['filename'], job['line']), ('done', 'lab.csv', 7))
+        self.assertEqual((job['imported'], job['rejected']), (2, 4))
+        self.assertEqual(job['errors'], [
+            {'line': 3, 'errors': {'test_result_id': 'unknown test result: 999999'}},
+            {'line': 5, 'errors': {'equipment_serial': 'unknown serial: S99999999'}},
+            {'line': 6, 'errors': {'date_analyse': 'no test result'}},
+            {'line': 7, 'errors': {'h2': 'wrong value: x'}},
+        ])
+        self.assertEqual(self.imported(), [101., 103.])
+
+    def test_wrong_imports_are_rejected(self):
+        self.post('/import_job/_import', ['test_result_id,h2'], status=400)
+        response = self.client.post(API + '/dissolved_gas_test/_import', data='{}', content_type='text/plain')
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_import_is_resumed_without_importing_rows_twice(self):
+        lab_import.IMPORT_CHUNK_SIZE = 2
+        lines = ['test_result_id,h2'] + ['{},{}'.format(self.result_ids[0], 200 + i) for i in range(5)]
+        inserts = []
+
+        def fail_second_chunk(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO dissolved_gas_test'):
+                inserts.append(statement)
+                if len(inserts) == 2:
+                    raise OperationalError(statement, parameters, Exception('server closed the connection'))
+
+        listen(Engine, 'before_cursor_execute', fail_second_chunk)
+        try:
+            job = self.post('/dissolved_gas_test/_import', lines)
+        finally:
+            remove(Engine, 'before_cursor_execute', fail_second_chunk)
+        self.assertEqual((job['status'], job['line'], job['imported']), ('failed', 3, 2))
+        self.assertIn('server closed the connection', job['message'])
+        self.assertEqual(self.imported(), [200., 201.])
+
+        # the same file sent again goes on after the last committed line
+        job = self.post('/import_job/{}'.format(job['id']), lines)
+        self.assertEqual((job['status'], job['line'], job['imported'], job['rejected']), ('done', 6, 5, 0))
+        self.assertEqual(self.imported(), [200., 201., 202., 203., 204.])
+        self.post('/import_job/{}'.format(job['id']), lines, status=400)
+
+
+
+class DebugQueriesTest(unittest.TestCase):
+
+    def rules(self, **config):
+        flask_app = Flask(__name__)
+        flask_app.config.update(SQL_INSTRUMENTATION=True, DEBUG=True, **config)
+        instrument(flask_app)
+        return [rule.rule for rule in flask_app.url_map.iter_rules()]
+
+    def test_served_without_permission_only_when_asked(self):
+        self.assertNotIn('/_debug/queries', self.rules())
+        self.assertIn('/_debug/queries', self.rules(SQL_DEBUG_QUERIES=True))
+
+
+class FakeMail(object):
+    """Stands for flask_mail.Mail, records the messages sent and the SMTP connections opened"""
+
+    def __init__(self, failing=(), refused=False):
+        # subjects of the messages the server refuses
+        self.failing = set(failing)
+        # the server refuses the connection itself
+        self.refused = refused
+        self.connections = []
+
+    def connect(self):
+        if self.refused:
+            raise IOError('connection refused')
+        self.connections.append([])
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def send(self, msg):
+        if msg.subject in self.failing:
+            raise IOError('refused {}'.format(msg.subject))
+        self.connections[-1].append(msg.subject)
+
+
+class OutboxTest(ApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(OutboxTest, cls).setUpClass()
+        # deliver_pending is called by the tests, not by the thread
+        cls.mail_worker = site.app.config.get('MAIL_WORKER')
+        site.app.config['MAIL_WORKER'] = False
+
+    @classmethod
+    def tearDownClass(cls):
+        site.app.config['MAIL_WORKER'] = cls.mail_worker
+        super(OutboxTest, cls).tearDownClass()
+
+    def setUp(self):
+        super(OutboxTest, self).setUp()
+        self.context = site.app.app_context()
+        self.context.push()
+        site.db.session.query(outbox.OutboxMessage).delete()
+        site.db.session.commit()
+        self.mail = outbox.mail
+        self.batch_size = outbox.MAIL_BATCH_SIZE
+
+    def tearDown(self):
+        outbox.mail = self.mail
+        outbox.MAIL_BATCH_SIZE = self.batch_size
+        site.db.session.remove()
+        self.context.pop()
+
+    def enqueue(self, *subjects, **values):
+        for subject in subjects:
+            outbox.enqueue(Message(subject, sender='noreply@example.com', recipients=['user@example.com'],
+                                   body=subject))
+        site.db.session.commit()
+        if values:
+            site.db.session.query(outbox.OutboxMessage).update(values)
+            site.db.session.commit()
+
+    def deliver(self, mail):
+        outbox.mail = mail
+        before = datetime.datetime.utcnow()
+        count = outbox.deliver_pending()
+        return count, before, datetime.datetime.utcnow()
+
+    def messages(self):
+        """subject -> message row, as stored by deliver_pending"""
+        site.db.session.expire_all()
+        return {row.subject: row for row in site.db.session.query(outbox.OutboxMessage)}
+
+    def assertRetry(self, row, attempts, before, after):
+        delay = datetime.timedelta(seconds=outbox.MAIL_RETRY_DELAY * 2 ** (attempts - 1))
+        self.assertEqual((row.status, row.attempts), ('pending', attempts))
+        self.assertTrue(before + delay <= row.next_attempt <= after + delay, row.next_attempt)
+        self.assertTrue(row.last_error)
+
+    def test_batch_is_sent_over_one_connection(self):
+        self.enqueue('a', 'b', 'c')
+        mail = FakeMail()
+        self.assertEqual(self.deliver(mail)[0], 3)
+        self.assertEqual(mail.connections, [['a', 'b', 'c']])
+        for row in self.messages().values():
+            self.assertEqual((row.status, row.attempts, row.last_error), ('sent', 1, None))
+            self.assertIsNotNone(row.sent)
+        # nothing due any more
+        self.assertEqual(self.deliver(FakeMail())[0], 0)
+
+    def test_one_connection_per_batch(self):
+        outbox.MAIL_BATCH_SIZE = 2
+        self.enqueue('a', 'b', 'c')
+        mail = FakeMail()
+        self.assertEqual(self.deliver(mail)[0], 3)
+        self.assertEqual(mail.connections, [['a', 'b'], ['c']])
+
+    def test_rest_of_the_batch_is_sent_again_after_a_send_error(self):
+        self.enqueue('a', 'b', 'c')
+        mail = FakeMail(failing=['b'])
+        count, before, after = self.deliver(mail)
+        self.assertEqual(count, 2)
+        # c waits for a new connection, b for its retry
+        self.assertEqual(mail.connections, [['a'], ['c']])
+        messages = self.messages()
+        self.assertEqual([messages[subject].status for subject in 'ac'], ['sent', 'sent'])
+        self.assertEqual(messages['c'].attempts, 1)
+        self.assertRetry(messages['b'], 1, before, after)
+
+    def test_refused_connection_delays_the_whole_batch(self):
+        self.enqueue('a', 'b')
+        count, before, after = self.deliver(FakeMail(refused=True))
+        self.assertEqual(count, 0)
+        for row in self.messages().values():
+            self.assertRetry(row, 1, before, after)
+
+    def test_retry_delay_doubles(self):
+        self.enqueue('a', attempts=3)
+        count, before, after = self.deliver(FakeMail(failing=['a']))
+        self.assertRetry(self.messages()['a'], 4, before, after)
+
+    def test_given_up_after_the_last_attempt(self):
+        self.enqueue('a', attempts=outbox.MAIL_MAX_ATTEMPTS - 1)
+        self.deliver(FakeMail(failing=['a']))
+        row = self.messages()['a']
+        self.assertEqual((row.status, row.attempts), ('failed', outbox.MAIL_MAX_ATTEMPTS))
+        # never claimed again
+        mail = FakeMail()
+        self.assertEqual(self.deliver(mail)[0], 0)
+        self.assertEqual(mail.connections, [])
+
+    def test_claimed_messages_are_not_claimed_again(self):
+        self.enqueue('a', 'b')
+        now = datetime.datetime.utcnow()
+        with site.db.engine.begin() as connection:
+            self.assertEqual([row.subject for row in outbox.claim(connection, now)], ['a', 'b'])
+            self.assertEqual(outbox.claim(connection, now), [])
+        for row in self.messages().values():
+            self.assertEqual(row.status, 'sending')
+        # the process sending them died
+        later = now + datetime.timedelta(seconds=outbox.MAIL_SEND_TIMEOUT + 1)
+        with site.db.engine.begin() as connection:
+            self.assertEqual(len(outbox.claim(connection, later)), 2)
+
+    def test_claim_skips_rows_claimed_meanwhile(self):
+        self.enqueue('a', 'b')
+        table = outbox.OutboxMessage.__table__
+        claimed = []
+
+        def other_process(connection, clauseelement, multiparams, params):
+            # claims a between the select and the first update of claim
+            if not claimed and isinstance(clauseelement, Update):
+                claimed.append('a')
+                connection.execute(table.update().where(table.c.subject == 'a').values(status='sending'))
+
+        with site.db.engine.begin() as connection:
+            listen(connection, 'before_execute', other_process)
+            self.assertEqual([row.subject for row in outbox.claim(connection, datetime.datetime.utcnow())], ['b'])
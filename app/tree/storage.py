@@ -2,12 +2,22 @@ from flask import flash, g, session
 import sqlalchemy_utils
 from .models import *
 from app import db
-from sqlalchemy.orm import joinedload_all
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
 from app import app
+from app.cache import get_versions
 from sqlalchemy.orm.session import make_transient
+from collections import defaultdict
 import json
 from flask import jsonify
 
+ROOT_ID = 1
+FALLBACK_LOCALE = 'en'
+# a cached tree is reused while the versions of these tables don't change
+TREE_TABLES = ('tree', 'tree_translation')
+# locale -> (table versions, root node as nested dicts, get_tree() json)
+_tree_cache = {}
+
 
 def set_locale():
     sqlalchemy_utils.i18n.get_locale = get_locale
@@ -21,60 +31,76 @@ def get_locale():
     return 'en'
 
 
-# return all tree
+def invalidate_tree():
+    _tree_cache.clear()
+
+
+def load_tree(locale):
+    """Return the root node as nested dicts like TreeNode.serialize(), or None.
+
+    The nodes and their translations come from one flat query and are linked in memory,
+    a missing or empty text falls back to the FALLBACK_LOCALE one like sqlalchemy_i18n does.
+    """
+    current = aliased(TreeNodeTranslation)
+    fallback = aliased(TreeNodeTranslation)
+    rows = db.session.query(TreeNode.id, TreeNode.parent_id, TreeNode.icon, TreeNode.opened, TreeNode.disabled,
+                            TreeNode.view, TreeNode.type, TreeNode.status, TreeNode.equipment_id,
+                            current.text.label('text'), fallback.text.label('fallback_text')) \
+        .outerjoin(current, and_(current.id == TreeNode.id, current.locale == locale)) \
+        .outerjoin(fallback, and_(fallback.id == TreeNode.id, fallback.locale == FALLBACK_LOCALE)) \
+        .order_by(TreeNode.id)
+
+    nodes = {}
+    children = defaultdict(list)
+    for row in rows:
+        node = {
+            'id': row.id,
+            'text': row.text or row.fallback_text,
+            'icon': row.icon,
+            'opened': row.opened,
+            'disabled': row.disabled,
+            'view': row.view,
+            'type': row.type,
+            'status': row.status,
+            'equipment_id': row.equipment_id,
+            'children': None
+        }
+        nodes[row.id] = node
+        children[row.parent_id].append(node)
+    for node_id, node in nodes.items():
+        if node_id in children:
+            node['children'] = children[node_id]
+    return nodes.get(ROOT_ID)
+
+
+def get_cached_tree():
+    """Return (root node as nested dicts, get_tree() json) for the current locale"""
+    locale = get_locale()
+    versions = get_versions(db.session, TREE_TABLES)
+    cached = _tree_cache.get(locale)
+    if cached is None or cached[0] != versions:
+        root = load_tree(locale)
+        res = serialize([root], []) if root is not None else []
+        cached = (versions, root, json.dumps(res))
+        _tree_cache[locale] = cached
+    return cached[1], cached[2]
+
+
+# return the whole tree with its first branch, as expected by the admin page
 def get_tree():
-    # try:
-    #     # .options(joinedload_all("children", "children", "children", "children"))
-    #     tree = db.session.query(TreeNode).options(joinedload_all("children", "children", "children", "children")) \
-    #         .filter(TreeNode.text == u'Vision Diagnostic').first()
-    #     res = None
-    #     if tree is not None:
-    #         res = "<ul>"
-    #         res += create_tree(tree)
-    #         res += "</ul>"
-    # except Exception as e:
-    #     import logging
-    #     logging.error(e)
-    #     res = None
-
-    # try:
-    #     tree = db.session.query(TreeNode).options(joinedload_all("children", "children", "children", "children")) \
-    #         .filter(TreeNode.text == u'Vision Diagnostic').first()
-    # tree = db.session.query(TreeNode)\
-    #     .options(joinedload_all("children", "children", "children", "children"))\
-    #     .filter(TreeNode.text == u'Vision Diagnostic').first()
-
-    tree = db.session.query(TreeNode).options(joinedload_all("children", "children", "children", "children")).get(1) # get root
-
-    res = []
-    # res.insert(0,tree.serialize())
-
-    res.append(tree.serialize())
-
-    if tree.children:
-        res = serialize(tree.children, res)
-        # for item in tree.children:
-        #     res.append(item.serialize())
-        #     if item.children:
-    # print res
+    return get_cached_tree()[1]
 
-    response = json.dumps(res)
-    return response
 
-    # except Exception as e:
-    #     import logging
-    #     logging.error(e)
+# return the whole tree as nested nodes
+def get_tree_snapshot():
+    return get_cached_tree()[0]
 
 
 def serialize(tree, res):
-    if type(tree) == list:
-        for item in tree:
-            res.append(item.serialize())
-            if item.children:
-                return serialize(item.children, res)
-
-    # item = tree.serialize()
-    # res.append(item)
+    for item in tree:
+        res.append(item)
+        if item['children']:
+            return serialize(item['children'], res)
     return res
 
 # create generate tree
@@ -96,6 +122,7 @@ def create_node(parent, text, icon, type, tooltip):
         # parent.append(node)
         # parent.children[text + str(node.id)] = node
         db.session.commit()
+        invalidate_tree()
         res = node.id
     except Exception as e:
         import logging
@@ -111,6 +138,7 @@ def rename_node(id, text):
         node = db.session.query(TreeNode).filter(TreeNode.id == id).first()
         node.text = text
         db.session.commit()
+        invalidate_tree()
         res = True
     except Exception as e:
         import logging
@@ -125,6 +153,7 @@ def delete_node(id):
         node = db.session.query(TreeNode).filter(TreeNode.id == id).first()
         db.session.delete(node)
         db.session.commit()
+        invalidate_tree()
         res = node.id
     except Exception as e:
         import logging
@@ -154,6 +183,7 @@ def update_node(node_id, view, tooltip):
         node.view = view
         node.tooltip = tooltip
         db.session.commit()
+        invalidate_tree()
         res = True
     except Exception as e:
         import logging
@@ -168,6 +198,7 @@ def move_node(node_id, parent_id):
     try:
         db.session.query(TreeNode).filter(TreeNode.id == node_id).update({'parent_id': parent_id})
         db.session.commit()
+        invalidate_tree()
         res = True
     except Exception as e:
         import logging
@@ -201,6 +232,7 @@ def change_status(node_id, status):
             node.icon = node.icon.replace(to_rep, '_b.ico')
 
         db.session.commit()
+        invalidate_tree()
         res = node.icon
     except Exception as e:
         import logging
@@ -219,6 +251,7 @@ def join_node(node_id, to_join):
             node = db.session.query(TreeNode).filter(TreeNode.id == id).first()
             db.session.delete(node)
             db.session.commit()
+            invalidate_tree()
             res.append(id)
 
     except Exception as e:
@@ -245,6 +278,7 @@ def copy_node(node_id, parent_id):
 
         db.session.add(node)
         db.session.commit()
+        invalidate_tree()
         db.session.flush()
 
         res = node.id
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from flask import Blueprint, request, render_template
+from flask import Blueprint, request, render_template, abort
 from flask import flash, g, session
-from app.users.models import User
+from app.users.identity import load_user
 from .storage import *
 from flask import jsonify
 from .forms import TreeView
@@ -19,7 +19,14 @@ def before_request():
     g.user = None
     if 'user_id' in session:
         if session['user_id'] is not None:
-            g.user = User.query.get(session['user_id'])
+            g.user = load_user(session['user_id'])
+
+
+@mod.route("/snapshot/", methods=['GET'])
+def snapshot():
+    if not admin_per.require().can():
+        abort(403)
+    return jsonify({'tree': get_tree_snapshot()})
 
 
 @mod.route("/rename/", methods=['POST'])
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""  The user of a request, loaded once per request with its roles and cached by each process for a few seconds  """
+
+import threading
+import time
+from flask import g, has_request_context
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session, joinedload
+from app import app, db
+from app.users.models import User, Role
+
+# seconds a user loaded by a process is reused by its next requests, changes made by other processes
+# show after at most this delay
+USER_CACHE_TTL = app.config.get('USER_CACHE_TTL', 30)
+
+_lock = threading.Lock()
+# user id -> (time loaded, user detached with its roles)
+_users = {}
+
+
+def fetch_user(user_id):
+    """Return the user of user_id with its roles from one joined query, detached from any session"""
+    session = db.create_session({})
+    try:
+        return session.query(User).options(joinedload(User.roles)).get(user_id)
+    finally:
+        # closing detaches the objects with their loaded state
+        session.close()
+
+
+def cached_user(user_id):
+    """Return the detached user of user_id, loaded at most USER_CACHE_TTL seconds ago, or None"""
+    now = time.time()
+    with _lock:
+        cached = _users.get(user_id)
+    if cached is None or now - cached[0] > USER_CACHE_TTL:
+        cached = (now, fetch_user(user_id))
+        with _lock:
+            _users[user_id] = cached
+    return cached[1]
+
+
+def invalidate_users(user_ids=None):
+    """Forget the cached users of user_ids, all of them by default"""
+    with _lock:
+        if user_ids is None:
+            _users.clear()
+        for user_id in user_ids or ():
+            _users.pop(user_id, None)
+
+
+def load_user(user_id):
+    """Return the user of user_id in the session of the request, or None.
+
+    The same object is returned for the whole request, built without any query from the process cache.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    users = {}
+    if has_request_context():
+        if not hasattr(g, 'request_users'):
+            g.request_users = {}
+        users = g.request_users
+    if user_id not in users:
+        user = cached_user(user_id)
+        # a copy attached to the session of the request, roles included
+        users[user_id] = db.session.merge(user, load=False) if user is not None else None
+    return users[user_id]
+
+
+@listens_for(Session, 'after_flush')
+def collect_changed_users(session, flush_context):
+    changed = session.info.setdefault('changed_users', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.id)
+        elif isinstance(obj, Role):
+            # every user of the role
+            changed.add(None)
+
+
+@listens_for(Session, 'after_commit')
+def invalidate_changed_users(session):
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        invalidate_users(None if None in changed else changed)
+
+
+@listens_for(Session, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_users', None)
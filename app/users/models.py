@@ -82,6 +82,8 @@ class User(db.Model, UserMixin):
     country_id = db.Column(db.Integer, db.ForeignKey("country.id"))
     country = db.relationship('Country', backref='users_user')
 
+    serialize_graph = ('roles', 'country')
+
     def __unicode__(self):
         return u"%s" % (self.name)
 
@@ -9,10 +9,11 @@ from flask import current_app
 from flask_mail import Message
 from werkzeug import secure_filename
 from app import db
-from app import mail
+from app.outbox import enqueue
 from app.users.forms import RegisterForm, LoginForm, ProfileForm, ForgotForm
 from app.users.constants import UPLOAD_FOLDER
 from app.users.models import User, Role, users_roles
+from app.users.identity import load_user
 from app.users.utils import allowed_image_file
 from app.users.decorators import login_required, templated
 from itsdangerous import URLSafeTimedSerializer
@@ -40,7 +41,7 @@ def before_request():
     """
     g.user = None
     if 'user_id' in session:
-        g.user = User.query.get(session['user_id'])
+        g.user = load_user(session['user_id'])
 
 
 @mod.route('/dashboard')
@@ -132,7 +133,8 @@ def send_confirmation():
     msg.html += "<br>Thank you,"
     msg.html += "<br><br>Team."
 
-    mail.send(msg)
+    enqueue(msg)
+    db.session.commit()
 
 
 # @mod.route('/forgot-password', methods=['GET', 'POST'])
@@ -0,0 +1,78 @@
+"""Campaigns of an equipment: id set + IN (...) against the EXISTS semi-join of Campaign.equipment_id
+
+Campaigns with thousands of test results are added to the configured database
+inside a transaction which is rolled back at the end, nothing is kept.
+The database needs at least one user, lab and equipment.
+
+    python -m benchmarks.campaign_equipment --campaigns 50 --results 2000 --repeat 20
+"""
+import argparse
+import time
+from app.api import api, db, insert_rows
+from app.diagnostic.models import Campaign, TestResult, Equipment, Lab
+from app.users.models import User
+
+
+def fill(campaigns, results):
+    user_id = db.session.query(User.id).limit(1).scalar()
+    lab_id = db.session.query(Lab.id).limit(1).scalar()
+    equipment_ids = [row.id for row in db.session.query(Equipment.id)]
+    if not (user_id and lab_id and equipment_ids):
+        raise SystemExit('The database needs at least one user, lab and equipment')
+
+    campaign_ids = insert_rows(Campaign, [{'created_by_id': user_id} for _ in range(campaigns)])
+    rows = [
+        {'campaign_id': campaign_id, 'lab_id': lab_id, 'equipment_id': equipment_ids[i % len(equipment_ids)]}
+        for campaign_id in campaign_ids for i in range(results)
+    ]
+    insert_rows(TestResult, rows)
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ANALYZE test_result')
+    return equipment_ids[0]
+
+
+def set_lookup(equipment_id):
+    campaign_ids = {item.campaign_id for item in db.session.query(TestResult).filter_by(equipment_id=equipment_id)}
+    return db.session.query(Campaign).filter(Campaign.id.in_(campaign_ids)).all()
+
+
+def exists_lookup(equipment_id):
+    return db.session.query(Campaign).filter(Campaign.equipment_id == equipment_id).all()
+
+
+def timed(func, equipment_id, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.time()
+        func(equipment_id)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--campaigns', type=int, default=50)
+    parser.add_argument('--results', type=int, default=2000, help='test results per campaign')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with api.app_context():
+        try:
+            equipment_id = fill(args.campaigns, args.results)
+            assert {c.id for c in set_lookup(equipment_id)} == {c.id for c in exists_lookup(equipment_id)}
+            for name, func in (('id set + IN', set_lookup), ('EXISTS', exists_lookup)):
+                median, best = timed(func, equipment_id, args.repeat)
+                print('{:<12} median {:8.2f} ms  best {:8.2f} ms'.format(name, median * 1000, best * 1000))
+            if db.engine.dialect.name == 'postgresql':
+                query = db.session.query(Campaign.id).filter(Campaign.equipment_id == equipment_id)
+                sql = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+                for row in db.session.execute('EXPLAIN ANALYZE {}'.format(sql)):
+                    print(row[0])
+        finally:
+            db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
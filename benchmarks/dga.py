@@ -0,0 +1,61 @@
+"""Fleet-wide dissolved gas diagnosis: row by row against the columnar engine of app.diagnostic.dga
+
+Random samples are generated in memory, the database is only read for the norm_gas limits.
+
+    python -m benchmarks.dga --samples 100000 --norm IEEE
+"""
+import argparse
+import time
+import numpy as np
+from app.api import api, db
+from app.diagnostic import dga
+
+
+def random_samples(count):
+    random = np.random.RandomState(0)
+    samples = {
+        'id': list(range(count)),
+        'test_result_id': list(range(count)),
+        'equipment_id': [None] * count,
+        'date_analyse': [None] * count,
+    }
+    for gas in dga.GASES:
+        samples[gas] = random.lognormal(3., 2., count)
+    return samples
+
+
+def row_by_row(samples, norm):
+    """What a loop over the rows costs: the engine run on one sample at a time"""
+    for index in range(len(samples['id'])):
+        row = {gas: samples[gas][index:index + 1] for gas in dga.GASES}
+        row['id'] = samples['id'][index:index + 1]
+        dga.diagnose(row, norm)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--norm', help='norm_gas name, the first one by default')
+    parser.add_argument('--rows', type=int, default=2000, help='samples diagnosed one by one')
+    args = parser.parse_args()
+
+    with api.app_context():
+        norm = dga.load_norm(db.session, args.norm)
+    samples = random_samples(args.samples)
+
+    start = time.time()
+    columns = dga.diagnose(samples, norm)
+    dga.serialize(samples, columns)
+    elapsed = time.time() - start
+    print('{:<12} {:>8} samples {:10.1f} ms'.format('columnar', args.samples, elapsed * 1000))
+
+    subset = {name: values[:args.rows] for name, values in samples.items()}
+    start = time.time()
+    row_by_row(subset, norm)
+    elapsed = (time.time() - start) * args.samples / args.rows
+    print('{:<12} {:>8} samples {:10.1f} ms (extrapolated from {})'.format(
+        'row by row', args.samples, elapsed * 1000, args.rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Per request validation cost of the largest model_dict schemas, before and after compiling them
+
+    python -m benchmarks.validation --schemas 5 --number 2000
+"""
+import argparse
+import timeit
+from app.api_utility import MyValidator, model_dict, validators
+
+
+def sample_document(schema):
+    """Return a document valid for schema: every writable field with its smallest allowed value"""
+    values = {'integer': 0, 'float': 0.0, 'boolean': False, 'string': 'a'}
+    document = {}
+    for field, rules in schema.items():
+        if not isinstance(rules, dict) or rules.get('readonly') or not isinstance(rules.get('type'), basestring):
+            continue
+        value = values.get(rules['type'], 'a')
+        if 'allowed' in rules:
+            value = rules['allowed'][0]
+        elif 'min' in rules:
+            value = rules['min']
+        document[field] = value
+    return document
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--schemas', type=int, default=5, help='number of schemas, largest first')
+    parser.add_argument('--number', type=int, default=2000, help='validations per measure')
+    args = parser.parse_args()
+
+    paths = sorted(model_dict, key=lambda path: len(model_dict[path]['schema']), reverse=True)[:args.schemas]
+    print('{:<30} {:>6} {:>14} {:>14} {:>14}'.format('schema', 'fields', 'per request', 'compiled', 'fast path'))
+    for path in paths:
+        schema = model_dict[path]['schema']
+        document = sample_document(schema)
+        compiled = validators[path]
+        assert compiled.normalize(dict(document))[1] is None, compiled.normalize(dict(document))[1]
+
+        measures = (
+            lambda: MyValidator().validate(dict(document), schema),
+            lambda: compiled.validator().validate(dict(document)),
+            lambda: compiled.normalize(dict(document)),
+        )
+        timings = [min(timeit.repeat(func, number=args.number, repeat=3)) / args.number for func in measures]
+        print('{:<30} {:>6} {:>11.1f} us {:>11.1f} us {:>11.1f} us'.format(
+            path, len(schema), *[t * 1e6 for t in timings]) + ('' if compiled.fast else '  (no fast path)'))
+
+
+if __name__ == '__main__':
+    main()
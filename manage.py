@@ -14,5 +14,14 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def send_mail():
+    """Send the due messages of the mail outbox"""
+    from app import app as site
+    from app.outbox import deliver_pending
+    with site.app_context():
+        print('{} sent'.format(deliver_pending()))
+
+
 if __name__ == '__main__':
     manager.run()
@@ -1,4 +1,10 @@
-from app.api import api as app
+import sys
+from app.api import api as app, db
+from app.diagnostic.gas_rates import refresh_rates
+from app.diagnostic.lab_import import start as start_import, run as run_import
+from app.diagnostic.models import ImportJob
+from app.api_filters import index_report
+from app.api_utility import model_dict
 from flask.ext.script import Manager
 from flask_apidoc.commands import GenerateApiDoc
 
@@ -7,5 +13,45 @@ manager = Manager(app)
 manager.add_command('apidoc', GenerateApiDoc(input_path=None, output_path='/home/vision/www/app/static/docs', template_path=None))
 
 
+@manager.command
+def index_advisor():
+    """List date and foreign key columns of the API models which no index starts with"""
+    for path, column, column_type in index_report(model_dict):
+        print('{:<40} {:<50} {}'.format(path, column, column_type))
+
+
+@manager.command
+def gas_rates():
+    """Recompute the gas generation rates of all the equipment"""
+    refresh_rates(db.session.connection())
+    db.session.commit()
+
+
+@manager.option('-t', '--table', dest='table', help='test table, e.g. dissolved_gas_test')
+@manager.option('-f', '--file', dest='filename', help='.csv file with a header line or .ndjson file, the file of the job by default when resuming')
+@manager.option('-j', '--job', dest='job_id', type=int, help='id of a failed import to resume')
+def import_results(table=None, filename=None, job_id=None):
+    """Import a file of lab results into a test table, or resume a failed import of the same file"""
+    job = None
+    if job_id is not None:
+        job = db.session.query(ImportJob).get(job_id)
+        if job is None:
+            sys.exit('No import job {}'.format(job_id))
+        filename = filename or job.filename
+    if not filename:
+        sys.exit('A file is required, see --file')
+    mimetype = 'text/csv' if filename.lower().endswith('.csv') else 'application/x-ndjson'
+    try:
+        with open(filename) as lines:
+            if job is not None:
+                job = run_import(db.session, job, lines, mimetype)
+            else:
+                job = start_import(db.session, table, lines, mimetype, filename)
+    except (IOError, ValueError) as e:
+        sys.exit(str(e))
+    print('import {}: {}, line {}, {} imported, {} rejected {}'.format(
+        job.id, job.status, job.line, job.imported, job.rejected, job.message or ''))
+
+
 if __name__ == '__main__':
     manager.run()
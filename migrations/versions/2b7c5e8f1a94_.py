@@ -0,0 +1,32 @@
+"""empty message
+
+Revision ID: 2b7c5e8f1a94
+Revises: 9f4b1d7e2a63
+Create Date: 2016-09-06 10:12:41.208317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7c5e8f1a94'
+down_revision = '9f4b1d7e2a63'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE INDEX ix_pages_slug ON public.pages (slug);
+        CREATE INDEX ix_pages_tag_slug ON public.pages (tag, slug);
+        CREATE INDEX ix_pages_translation_locale_title ON public.pages_translation (locale, title);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP INDEX IF EXISTS public.ix_pages_slug;
+        DROP INDEX IF EXISTS public.ix_pages_tag_slug;
+        DROP INDEX IF EXISTS public.ix_pages_translation_locale_title;
+    """
+    op.execute(sql=sql)
@@ -0,0 +1,33 @@
+"""empty message
+
+Revision ID: 2e9d41c6a7f3
+Revises: 5a1e7c2d9b40
+Create Date: 2016-08-24 16:42:09.551720
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e9d41c6a7f3'
+down_revision = '5a1e7c2d9b40'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE TABLE public.table_version (
+          table_name VARCHAR(100) NOT NULL PRIMARY KEY,
+          version BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO public.table_version (table_name, version)
+        SELECT tablename, 1 FROM pg_tables WHERE schemaname = 'public' AND tablename <> 'table_version';
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP TABLE IF EXISTS public.table_version;
+    """
+    op.execute(sql=sql)
@@ -0,0 +1,42 @@
+"""empty message
+
+Revision ID: 3b8e2f6d0c17
+Revises: 7c3f5e1b8a24
+Create Date: 2016-08-29 09:48:21.633104
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b8e2f6d0c17'
+down_revision = '7c3f5e1b8a24'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE TABLE public.norm_flag (
+          test_table VARCHAR(50) NOT NULL,
+          test_id INTEGER NOT NULL,
+          field VARCHAR(50) NOT NULL,
+          campaign_id INTEGER REFERENCES public.campaign (id) ON DELETE CASCADE,
+          test_result_id INTEGER REFERENCES public.test_result (id) ON DELETE CASCADE,
+          value DOUBLE PRECISION,
+          low DOUBLE PRECISION,
+          high DOUBLE PRECISION,
+          condition INTEGER,
+          PRIMARY KEY (test_table, test_id, field)
+        );
+        CREATE INDEX ix_norm_flag_campaign_id ON public.norm_flag (campaign_id);
+        INSERT INTO public.table_version (table_name, version) VALUES ('norm_flag', 1);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP TABLE IF EXISTS public.norm_flag;
+        DELETE FROM public.table_version WHERE table_name = 'norm_flag';
+    """
+    op.execute(sql=sql)
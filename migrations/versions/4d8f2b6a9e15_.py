@@ -0,0 +1,28 @@
+"""empty message
+
+Revision ID: 4d8f2b6a9e15
+Revises: 7c3e9a1f4d52
+Create Date: 2016-09-08 12:05:37.916204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d8f2b6a9e15'
+down_revision = '7c3e9a1f4d52'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE INDEX ix_image_name ON public.image (name varchar_pattern_ops);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP INDEX IF EXISTS public.ix_image_name;
+    """
+    op.execute(sql=sql)
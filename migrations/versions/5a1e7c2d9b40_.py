@@ -0,0 +1,28 @@
+"""empty message
+
+Revision ID: 5a1e7c2d9b40
+Revises: 10faa0bd5c60
+Create Date: 2016-08-22 10:14:51.402118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a1e7c2d9b40'
+down_revision = '10faa0bd5c60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE INDEX ix_test_result_equipment_id_campaign_id ON public.test_result (equipment_id, campaign_id);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP INDEX IF EXISTS public.ix_test_result_equipment_id_campaign_id;
+    """
+    op.execute(sql=sql)
@@ -0,0 +1,47 @@
+"""empty message
+
+Revision ID: 6d2a9c4e5f81
+Revises: 3b8e2f6d0c17
+Create Date: 2016-08-30 15:12:44.918205
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d2a9c4e5f81'
+down_revision = '3b8e2f6d0c17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # rows go to monthly tables inheriting from this one, created on demand by app.diagnostic.readings
+    sql = """
+        CREATE TABLE public.gas_sensor_reading (
+          gas_sensor_id INTEGER NOT NULL REFERENCES public.gas_sensor (id) ON DELETE CASCADE,
+          taken_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+          cap_gaz DOUBLE PRECISION,
+          h2 DOUBLE PRECISION,
+          ch4 DOUBLE PRECISION,
+          c2h2 DOUBLE PRECISION,
+          c2h4 DOUBLE PRECISION,
+          c2h6 DOUBLE PRECISION,
+          co DOUBLE PRECISION,
+          co2 DOUBLE PRECISION,
+          o2 DOUBLE PRECISION,
+          n2 DOUBLE PRECISION,
+          water DOUBLE PRECISION,
+          oil_temperature DOUBLE PRECISION,
+          PRIMARY KEY (gas_sensor_id, taken_at)
+        );
+        INSERT INTO public.table_version (table_name, version) VALUES ('gas_sensor_reading', 1);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP TABLE IF EXISTS public.gas_sensor_reading CASCADE;
+        DELETE FROM public.table_version WHERE table_name = 'gas_sensor_reading';
+    """
+    op.execute(sql=sql)
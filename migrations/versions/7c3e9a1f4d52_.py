@@ -0,0 +1,44 @@
+"""empty message
+
+Revision ID: 7c3e9a1f4d52
+Revises: 2b7c5e8f1a94
+Create Date: 2016-09-07 15:48:19.502734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c3e9a1f4d52'
+down_revision = '2b7c5e8f1a94'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE TABLE public.mail_outbox (
+          id SERIAL PRIMARY KEY,
+          sender VARCHAR(255),
+          recipients TEXT NOT NULL,
+          subject TEXT,
+          body TEXT,
+          html TEXT,
+          status VARCHAR(20) NOT NULL DEFAULT 'pending',
+          attempts INTEGER NOT NULL DEFAULT 0,
+          next_attempt TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+          last_error TEXT,
+          created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'),
+          sent TIMESTAMP WITHOUT TIME ZONE
+        );
+        CREATE INDEX ix_mail_outbox_status_next_attempt ON public.mail_outbox (status, next_attempt);
+        INSERT INTO public.table_version (table_name, version) VALUES ('mail_outbox', 1);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP TABLE IF EXISTS public.mail_outbox;
+        DELETE FROM public.table_version WHERE table_name = 'mail_outbox';
+    """
+    op.execute(sql=sql)
@@ -0,0 +1,93 @@
+"""empty message
+
+Revision ID: 7c3f5e1b8a24
+Revises: 2e9d41c6a7f3
+Create Date: 2016-08-26 11:05:37.204816
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c3f5e1b8a24'
+down_revision = '2e9d41c6a7f3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE TABLE public.gas_generation_rate (
+          dissolved_gas_test_id INTEGER NOT NULL PRIMARY KEY
+            REFERENCES public.dissolved_gas_test (id) ON DELETE CASCADE,
+          previous_test_id INTEGER REFERENCES public.dissolved_gas_test (id) ON DELETE CASCADE,
+          equipment_id INTEGER NOT NULL REFERENCES public.equipment (id) ON DELETE CASCADE,
+          date_analyse TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+          days DOUBLE PRECISION,
+          h2 DOUBLE PRECISION,
+          ch4 DOUBLE PRECISION,
+          c2h2 DOUBLE PRECISION,
+          c2h4 DOUBLE PRECISION,
+          c2h6 DOUBLE PRECISION,
+          co DOUBLE PRECISION,
+          co2 DOUBLE PRECISION,
+          tdcg DOUBLE PRECISION
+        );
+        CREATE INDEX ix_gas_generation_rate_equipment_id_date_analyse
+          ON public.gas_generation_rate (equipment_id, date_analyse);
+
+        WITH sample AS (
+          SELECT g.id, r.equipment_id, r.date_analyse,
+                 CASE WHEN g.h2_flag THEN 0 ELSE g.h2 END AS h2,
+                 CASE WHEN g.ch4_flag THEN 0 ELSE g.ch4 END AS ch4,
+                 CASE WHEN g.c2h2_flag THEN 0 ELSE g.c2h2 END AS c2h2,
+                 CASE WHEN g.c2h4_flag THEN 0 ELSE g.c2h4 END AS c2h4,
+                 CASE WHEN g.c2h6_flag THEN 0 ELSE g.c2h6 END AS c2h6,
+                 CASE WHEN g.co_flag THEN 0 ELSE g.co END AS co,
+                 CASE WHEN g.co2_flag THEN 0 ELSE g.co2 END AS co2
+          FROM public.dissolved_gas_test g
+          JOIN public.test_result r ON r.id = g.test_result_id
+          WHERE r.equipment_id IS NOT NULL AND r.date_analyse IS NOT NULL
+        ), pair AS (
+          SELECT s.*,
+                 COALESCE(h2, 0) + COALESCE(ch4, 0) + COALESCE(c2h2, 0) + COALESCE(c2h4, 0)
+                   + COALESCE(c2h6, 0) + COALESCE(co, 0) AS tdcg,
+                 LAG(id) OVER w AS previous_id,
+                 EXTRACT(EPOCH FROM date_analyse - LAG(date_analyse) OVER w) / 86400 AS days,
+                 LAG(h2) OVER w AS previous_h2,
+                 LAG(ch4) OVER w AS previous_ch4,
+                 LAG(c2h2) OVER w AS previous_c2h2,
+                 LAG(c2h4) OVER w AS previous_c2h4,
+                 LAG(c2h6) OVER w AS previous_c2h6,
+                 LAG(co) OVER w AS previous_co,
+                 LAG(co2) OVER w AS previous_co2,
+                 LAG(COALESCE(h2, 0) + COALESCE(ch4, 0) + COALESCE(c2h2, 0) + COALESCE(c2h4, 0)
+                   + COALESCE(c2h6, 0) + COALESCE(co, 0)) OVER w AS previous_tdcg
+          FROM sample s
+          WINDOW w AS (PARTITION BY equipment_id ORDER BY date_analyse, id)
+        )
+        INSERT INTO public.gas_generation_rate
+          (dissolved_gas_test_id, previous_test_id, equipment_id, date_analyse, days,
+           h2, ch4, c2h2, c2h4, c2h6, co, co2, tdcg)
+        SELECT id, previous_id, equipment_id, date_analyse, days,
+               (h2 - previous_h2) / NULLIF(days, 0),
+               (ch4 - previous_ch4) / NULLIF(days, 0),
+               (c2h2 - previous_c2h2) / NULLIF(days, 0),
+               (c2h4 - previous_c2h4) / NULLIF(days, 0),
+               (c2h6 - previous_c2h6) / NULLIF(days, 0),
+               (co - previous_co) / NULLIF(days, 0),
+               (co2 - previous_co2) / NULLIF(days, 0),
+               (tdcg - previous_tdcg) / NULLIF(days, 0)
+        FROM pair
+        WHERE previous_id IS NOT NULL;
+
+        INSERT INTO public.table_version (table_name, version) VALUES ('gas_generation_rate', 1);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP TABLE IF EXISTS public.gas_generation_rate;
+        DELETE FROM public.table_version WHERE table_name = 'gas_generation_rate';
+    """
+    op.execute(sql=sql)
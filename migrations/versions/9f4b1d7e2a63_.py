@@ -0,0 +1,42 @@
+"""empty message
+
+Revision ID: 9f4b1d7e2a63
+Revises: 6d2a9c4e5f81
+Create Date: 2016-09-02 11:27:05.614392
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9f4b1d7e2a63'
+down_revision = '6d2a9c4e5f81'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    sql = """
+        CREATE TABLE public.import_job (
+          id SERIAL PRIMARY KEY,
+          table_name VARCHAR(100) NOT NULL,
+          filename VARCHAR(255),
+          status VARCHAR(20) NOT NULL DEFAULT 'running',
+          line INTEGER NOT NULL DEFAULT 0,
+          imported INTEGER NOT NULL DEFAULT 0,
+          rejected INTEGER NOT NULL DEFAULT 0,
+          errors TEXT,
+          message TEXT,
+          created TIMESTAMP WITHOUT TIME ZONE DEFAULT now(),
+          updated TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
+        );
+        INSERT INTO public.table_version (table_name, version) VALUES ('import_job', 1);
+    """
+    op.execute(sql=sql)
+
+
+def downgrade():
+    sql = """
+        DROP TABLE IF EXISTS public.import_job;
+        DELETE FROM public.table_version WHERE table_name = 'import_job';
+    """
+    op.execute(sql=sql)